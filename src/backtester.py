@@ -1,63 +1,181 @@
-from data import BitcoinFromCSV, CoinbaseSandboxStream
-#from strategy import BuyAndHoldStrategy
-import Queue
-import cPickle as pickle
-#from signals import MovingAverage
-from strategy import TestStrategy
+"""
+Runs a backtest described by a JSON config:
+
+    python backtester.py [config.json] [--output DIR] [--log-level INFO] [--timing]
+
+A config only needs the sections it changes from DEFAULT_CONFIG, e.g.
+
+    {"data": {"csv_path": "../data/other.csv"},
+     "signals": {"EMA": {"type": "ExponentialMovingAverage", "span": 24}},
+     "broker": {"commission": 0.002, "slippage": {"type": "FixedBpsSlippage", "bps": 5}}}
+
+Components are given by their class name ("type") and keyword arguments;
+an argument written as {"days": 3} (any of days/hours/minutes/seconds)
+is passed as a datetime.timedelta. The Coinbase client and the plotting
+helpers are only imported when the config uses them.
+"""
+import argparse
+import copy
 import datetime
-from broker import BacktestingBroker, CoinbaseSandboxBroker
-from nose.tools import set_trace
-from simulator import Simulator, Order
-from portfolio import Portfolio as TestPortfolio
-from position import Position
-from signals import SignalCollector, MovingAverage
-import plotting_helper as ph
+import json
+import logging
+import os
+import sys
 
-from coinbase.wallet.client import Client
+import costs
+import portfolio
+import signals
+import strategy
+from broker import BacktestingBroker
+from data import BitcoinFromCSV, PartitionedBarStream
+from event import EventHandler
+from runlog import LOGGER_NAME, RunLog
+from simulator import Simulator
+from timing import Timer
 
-def print_results():
-    while global_event_queue.qsize() > 0:
-        try:
-            event = global_event_queue.get()
-            print type(event), event.price, event.side
-        except AttributeError:
-            pass
+DEFAULT_CONFIG = {
+    'data': {'source': 'csv', 'csv_path': '../data/bitcoin_6_months_hourly.csv', 'spread': 0.3},
+    'signals': {'Moving Average': {'type': 'MovingAverage', 'lookback_period': {'days': 3}}},
+    'precompute': False,
+    'strategy': {'type': 'TestStrategy'},
+    'broker': {'type': 'BacktestingBroker', 'commission': 0.01},
+    'portfolio': {'type': 'Portfolio', 'cash': 100},
+    'output': '../results/tmp_results',
+    'plot': False,
+}
 
+TIMEDELTA_KEYS = set(['days', 'hours', 'minutes', 'seconds'])
 
-if __name__ == "__main__":
-    global_event_queue = Queue.Queue()
+LOG_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING,
+              'ERROR': logging.ERROR}
+
+
+def load_config(path=None):
     """
-    coinbase_client = Client(api_key = API_KEY, 
-                                api_secret = API_SECRET,
-                                base_api_uri='https://api.coinbase.com/')
-    account_id = coinbase_client.get_accounts()['data'][0]['id']
-    dataStream = CoinbaseSandboxStream(global_event_queue, update_rate = 1, client = coinbase_client)
+    DEFAULT_CONFIG updated section by section with the JSON config at path.
+    The 'signals' section replaces the default signals as a whole.
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is None:
+        return config
+    with open(path) as fp:
+        overrides = json.load(fp)
+    for section, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(section), dict) and section != 'signals':
+            config[section].update(value)
+        else:
+            config[section] = value
+    return config
 
-    broker = CoinbaseSandboxBroker(dataStream, global_event_queue, commission=0.01, account_id=account_id)
-    a = coinbase_client.buy(account_id, amount='1', currency='BTC')
 
-    #for i in d._data_streamer():
-    #    print i
+def _arguments(spec):
+    """
+    The keyword arguments of a component spec (everything but 'type').
     """
-    
-    dataStream = BitcoinFromCSV(
-                            events=global_event_queue, 
-                            csv_path='../data/bitcoin_6_months_hourly.csv',
-                            spread = 0.3)
-    broker = BacktestingBroker(
-        dataStream=dataStream, event_queue=global_event_queue, commission=0.01)
-    testOrder = Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=10,
-                      side='B', posted_at=datetime.datetime.now())
-    fill_event = broker.execute_order(testOrder)
-    strategy = TestStrategy(global_event_queue)
-    portfolio = TestPortfolio(broker, 100)
-    signals = SignalCollector({"Moving Average": MovingAverage(lookback_period = datetime.timedelta(days=3))})
-    simulator = Simulator(dataStream, broker, strategy, portfolio, signals)
+    kwargs = {}
+    for key, value in spec.items():
+        if key == 'type':
+            continue
+        if isinstance(value, dict) and value and set(value) <= TIMEDELTA_KEYS:
+            value = datetime.timedelta(**value)
+        kwargs[str(key)] = value
+    return kwargs
+
+
+def _component(module, spec, *args):
+    cls = getattr(module, spec['type'], None)
+    if cls is None:
+        raise ValueError("{} has no component {}".format(module.__name__, spec['type']))
+    return cls(*args, **_arguments(spec))
+
+
+def _coinbase_client(config):
+    # only needed for live runs, so only imported for them
+    from coinbase.wallet.client import Client
+    return Client(api_key=config.get('api_key', os.environ.get('COINBASE_API_KEY')),
+                  api_secret=config.get('api_secret', os.environ.get('COINBASE_API_SECRET')),
+                  base_api_uri=config.get('base_api_uri', 'https://api.coinbase.com/'))
 
+
+def build_data(config, events):
+    source = config['source']
+    if source == 'csv':
+        return BitcoinFromCSV(events=events, csv_path=config['csv_path'], spread=config['spread'],
+                              use_cache=config.get('use_cache', True))
+    elif source == 'partitions':
+        return PartitionedBarStream(events, config['root'])
+    elif source == 'coinbase':
+        from live import CoinbaseSandboxStream
+        return CoinbaseSandboxStream(events, update_rate=config.get('update_rate', 1),
+                                     client=_coinbase_client(config))
+    raise ValueError("unknown data source {}".format(source))
+
+
+def build_broker(config, dataStream, events):
+    if config['type'] == 'CoinbaseSandboxBroker':
+        from broker import CoinbaseSandboxBroker
+        account_id = config.get('account_id')
+        if account_id is None:
+            account_id = dataStream.client.get_accounts()['data'][0]['id']
+        return CoinbaseSandboxBroker(dataStream, events, commission=config['commission'],
+                                     account_id=account_id)
+    elif config['type'] != 'BacktestingBroker':
+        raise ValueError("unknown broker {}".format(config['type']))
+    slippage = _component(costs, config['slippage']) if config.get('slippage') else None
+    fees = _component(costs, config['fees']) if config.get('fees') else None
+    return BacktestingBroker(dataStream=dataStream, event_queue=events, commission=config['commission'],
+                             slippage=slippage, fees=fees)
+
+
+def build_simulator(config, log=None, timer=None):
+    """
+    Wires up the components of a config into a Simulator.
+    """
+    events = EventHandler()
+    dataStream = build_data(config['data'], events)
+    broker = build_broker(config['broker'], dataStream, events)
+    collector = signals.SignalCollector(
+        dict((name, _component(signals, spec)) for name, spec in config['signals'].items()),
+        precompute=config['precompute'])
+    trader = _component(strategy, config['strategy'], events)
+    spec = dict(config['portfolio'])
+    cash = spec.pop('cash')
+    book = _component(portfolio, spec, broker, cash)
+    return Simulator(dataStream, broker, trader, book, collector, events=events, log=log, timer=timer)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs a backtest described by a JSON config.")
+    parser.add_argument('config', nargs='?', help="JSON run config (see DEFAULT_CONFIG)")
+    parser.add_argument('--output', help="results directory (overrides the config)")
+    parser.add_argument('--log-level', default='WARNING', type=str.upper, choices=sorted(LOG_LEVELS),
+                        help="DEBUG, INFO, WARNING or ERROR")
+    parser.add_argument('--progress', type=int, help="log progress every PROGRESS bars")
+    parser.add_argument('--timing', action='store_true', help="print the time spent per stage")
+    args = parser.parse_args(argv)
+
+    level = LOG_LEVELS[args.log_level]
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logging.getLogger(LOGGER_NAME).setLevel(level)
+
+    config = load_config(args.config)
+    if args.output is not None:
+        config['output'] = args.output
+    timer = Timer() if args.timing else None
+    simulator = build_simulator(config, log=RunLog(level=level, progress_every=args.progress),
+                                timer=timer)
     simulator.run()
-    simulator.save_results('../results/tmp_results.pkl')
+    if config['output']:
+        simulator.save_results(config['output'])
+    print "realised PnL {:.2f}, unrealised PnL {:.2f}, {} fills".format(
+        simulator.portfolio.realised_pnl, simulator.portfolio.unrealised_pnl, len(simulator.trade_log))
+    if timer is not None:
+        print timer.table()
+    if config['plot']:
+        import plotting_helper as ph
+        ph.plot_loaded_results(config['output'])
+    return 0
 
-    #ph.plot_loaded_results('../results/tmp_results.pkl')
 
-    #print_results()
-    set_trace()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
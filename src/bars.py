@@ -0,0 +1,347 @@
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS_FILE = 'columns.json'
+PARTITIONS_FILE = 'partitions.json'
+
+
+class BarStore(object):
+    """
+    Columnar store for historical bars.
+
+    Every column is kept as one contiguous NumPy array: 'Datetime' holds
+    int64 nanoseconds since the epoch and all other columns (Bid, Ask, ...)
+    are float64. Bars and windows handed out by the store are views on
+    these arrays, so streaming over the store never builds pandas objects.
+    """
+
+    def __init__(self, columns):
+        """
+        Parameters:
+        columns - dict (or list of (name, array) pairs) of column arrays.
+                  Must contain a 'Datetime' column; all columns must have
+                  the same length.
+        """
+        if isinstance(columns, dict):
+            columns = [('Datetime', columns['Datetime'])] + sorted(
+                (k, v) for k, v in columns.items() if k != 'Datetime')
+        self.columns = []
+        self.data = {}
+        for name, values in columns:
+            if name == 'Datetime':
+                values = _to_int64_datetime(values)
+            else:
+                values = np.ascontiguousarray(values, dtype=np.float64)
+            self.columns.append(name)
+            self.data[name] = values
+        assert('Datetime' in self.data), "a BarStore needs a 'Datetime' column"
+        self.datetime = self.data['Datetime']
+        lengths = set(len(v) for v in self.data.values())
+        assert(len(lengths) == 1), "all columns must have the same length"
+
+    @classmethod
+    def from_frame(cls, frame, columns=None):
+        """
+        Builds a store from a DataFrame with a 'Datetime' column.
+
+        Parameters:
+        frame - a pandas DataFrame.
+        columns - optional list of columns to keep (defaults to all).
+        """
+        if columns is None:
+            columns = list(frame.columns)
+        if 'Datetime' not in columns:
+            columns = ['Datetime'] + list(columns)
+        else:
+            columns = ['Datetime'] + [c for c in columns if c != 'Datetime']
+        return cls([(c, frame[c].values) for c in columns])
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Loads a store written by save(). By default the columns are
+        memory-mapped read-only, so only the pages that are actually
+        touched get read into memory.
+        """
+        with open(os.path.join(directory, COLUMNS_FILE)) as fp:
+            columns = json.load(fp)
+        return cls([(c, np.load(os.path.join(directory, c + '.npy'), mmap_mode=mmap_mode))
+                    for c in columns])
+
+    def save(self, directory):
+        """
+        Writes every column to <directory>/<column>.npy.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.columns:
+            np.save(os.path.join(directory, name + '.npy'), self.data[name])
+        with open(os.path.join(directory, COLUMNS_FILE), 'w') as fp:
+            json.dump(self.columns, fp)
+
+    def __len__(self):
+        return len(self.datetime)
+
+    def column(self, name):
+        return self.data[name]
+
+    def slice(self, start, stop):
+        """
+        Returns a new store over the rows [start, stop) that shares
+        its arrays with this one.
+        """
+        return BarStore([(c, self.data[c][start:stop]) for c in self.columns])
+
+    def bar(self, idx):
+        return Bar(self, idx)
+
+    def window(self, start, stop, columns=None):
+        return BarWindow(self, start, stop, columns)
+
+    def with_spread(self, spread):
+        """
+        Returns a store with the same mid prices but Bid and Ask set
+        `spread` below and above them (the other columns are shared).
+        """
+        mid = (self.data['Bid'] + self.data['Ask']) / 2.
+        replaced = {'Bid': mid - spread, 'Ask': mid + spread}
+        return BarStore([(c, replaced.get(c, self.data[c])) for c in self.columns])
+
+    def to_frame(self, start=0, stop=None):
+        """
+        Returns a (copied) pandas DataFrame of the rows in [start, stop).
+        """
+        return self.window(start, len(self) if stop is None else stop).to_frame()
+
+
+def publish_bars(store, path=None):
+    """
+    Publishes a BarStore for other processes to attach to with
+    attach_bars. The columns are written once as .npy files (under
+    /dev/shm when it is available, so they live in shared memory); every
+    process that attaches maps the same pages read-only instead of keeping
+    its own copy. Returns the path to attach to; remove it with
+    unpublish_bars once no process needs it any more.
+
+    Parameters:
+    store - the BarStore to publish.
+    path - where to publish it (a new directory is created if omitted);
+        it must not exist or be an empty directory.
+    """
+    if path is None:
+        shm = '/dev/shm'
+        path = tempfile.mkdtemp(prefix='bars-', dir=shm if os.path.isdir(shm) else None)
+    # write next to the target and rename over it so that no one attaches to a
+    # half written store; the rename replaces the empty directory made above,
+    # so its name is never free for someone else to take in between
+    tmp_path = tempfile.mkdtemp(prefix='.bars-', suffix='.tmp',
+                                dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        store.save(tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return path
+
+
+def attach_bars(path):
+    """
+    Attaches read-only and without copying to a store published with
+    publish_bars.
+    """
+    return BarStore.load(path, mmap_mode='r')
+
+
+def unpublish_bars(path):
+    shutil.rmtree(path)
+
+
+def write_partitions(store, root, freq='M'):
+    """
+    Splits a BarStore into time partitions (one per month by default) and
+    saves each of them under root/<partition>/, together with a manifest
+    listing the partitions in time order and their lengths.
+
+    Parameters:
+    store - the BarStore to write; must be sorted by Datetime.
+    root - directory that will hold the partitions.
+    freq - a NumPy datetime unit to partition by ('Y', 'M', 'D', ...).
+    """
+    writer = PartitionWriter(root, freq)
+    writer.append(store)
+    return writer.close()
+
+
+class PartitionWriter(object):
+    """
+    Writes a partitioned store like write_partitions, from bars that
+    arrive in time-ordered chunks (e.g. a csv read piece by piece), so
+    that histories larger than memory can be ingested. Only the bars of
+    the partition that is still open are held; it is saved as soon as
+    a chunk reaches the next one.
+    """
+
+    def __init__(self, root, freq='M'):
+        """
+        Parameters:
+        root - directory that will hold the partitions.
+        freq - a NumPy datetime unit to partition by ('Y', 'M', 'D', ...).
+        """
+        self.root = root
+        self.freq = freq
+        self.partitions = []
+        self.open_chunks = []
+        self.key = None
+        self.last = None
+
+    def append(self, store):
+        """
+        Adds a BarStore of bars that follow the ones appended so far.
+        """
+        if not len(store):
+            return
+        datetimes = store.datetime
+        if np.any(datetimes[1:] < datetimes[:-1]) or (self.last is not None and datetimes[0] < self.last):
+            raise ValueError("bars must be appended in time order")
+        keys = datetimes.view('M8[ns]').astype('M8[{}]'.format(self.freq))
+        boundaries = np.concatenate(
+            [[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(store)]])
+        for start, stop in zip(boundaries[:-1], boundaries[1:]):
+            if self.key is not None and keys[start] != self.key:
+                self._flush()
+            self.key = keys[start]
+            self.open_chunks.append(store.slice(start, stop))
+        self.last = datetimes[-1]
+
+    def _flush(self):
+        if not self.open_chunks:
+            return
+        columns = self.open_chunks[0].columns
+        assert(all(chunk.columns == columns for chunk in self.open_chunks)), \
+            "all chunks must have the same columns"
+        partition = BarStore([(c, np.concatenate([chunk.data[c] for chunk in self.open_chunks]))
+                              for c in columns])
+        name = str(self.key)
+        partition.save(os.path.join(self.root, name))
+        self.partitions.append({'name': name, 'length': len(partition)})
+        self.open_chunks = []
+
+    def close(self):
+        """
+        Saves the last partition and the manifest; returns the partitions.
+        """
+        self._flush()
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, PARTITIONS_FILE), 'w') as fp:
+            json.dump({'freq': self.freq, 'partitions': self.partitions}, fp)
+        return self.partitions
+
+
+def read_partitions(root):
+    """
+    Returns the partition list written by write_partitions.
+    """
+    with open(os.path.join(root, PARTITIONS_FILE)) as fp:
+        return json.load(fp)['partitions']
+
+
+class Bar(object):
+    """
+    A lightweight view on a single row of a BarStore. Supports the
+    bar['Bid'] style access that strategies and signals use on pandas rows.
+    """
+    __slots__ = ('store', 'index', '_datetime')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self._datetime = None
+
+    def __getitem__(self, key):
+        if key == 'Datetime':
+            if self._datetime is None:
+                self._datetime = pd.Timestamp(self.store.datetime[self.index])
+            return self._datetime
+        return self.store.data[key][self.index]
+
+    def __contains__(self, key):
+        return key in self.store.data
+
+    def get(self, key, default=None):
+        if key in self.store.data:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.store.columns)
+
+    def to_series(self):
+        return pd.Series(dict((k, self[k]) for k in self.store.columns),
+                         index=self.store.columns, name=self.index)
+
+    def __repr__(self):
+        return "Bar({})".format(", ".join(
+            "{}={}".format(k, self[k]) for k in self.store.columns))
+
+
+class BarWindow(object):
+    """
+    A zero-copy window over the rows [start, stop) of a BarStore.
+
+    window['Bid'] returns a NumPy view on the underlying column ('Datetime'
+    is returned as datetime64[ns]); window[['Bid', 'Ask']] narrows the window
+    to those columns. Use to_frame() where a real DataFrame is needed.
+    """
+    __slots__ = ('store', 'start', 'stop', 'columns')
+
+    def __init__(self, store, start, stop, columns=None):
+        self.store = store
+        self.start = start
+        self.stop = stop
+        self.columns = list(store.columns) if columns is None else list(columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return BarWindow(self.store, self.start, self.stop, key)
+        values = self.store.data[key][self.start:self.stop]
+        if key == 'Datetime':
+            return values.view('M8[ns]')
+        return values
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def empty(self):
+        return self.stop <= self.start
+
+    @property
+    def values(self):
+        """
+        2-d array of the selected columns (this one is a copy).
+        """
+        return np.column_stack([self[c] for c in self.columns])
+
+    def to_frame(self):
+        return pd.DataFrame(
+            dict((c, self[c]) for c in self.columns), columns=self.columns,
+            index=np.arange(self.start, self.stop))
+
+
+def _to_int64_datetime(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return np.ascontiguousarray(values.astype('M8[ns]').view(np.int64))
+    if values.dtype.kind in 'iu':
+        return np.ascontiguousarray(values, dtype=np.int64)
+    return np.ascontiguousarray(
+        pd.to_datetime(values).values.astype('M8[ns]').view(np.int64))
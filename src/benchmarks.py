@@ -0,0 +1,253 @@
+"""
+Throughput benchmarks on synthetic market data.
+
+    python benchmarks.py --bars 100000 --save
+    python benchmarks.py --bars 100000
+
+The first run stores the rates as a JSON baseline, later runs compare
+against it and exit with status 1 if a benchmark got slower than the
+tolerance allows. Rates depend on the machine, so baselines are only
+comparable when taken on the same one.
+"""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from bars import BarStore
+from broker import BacktestingBroker
+from data import BitcoinFromCSV, HistoricBarStream
+from event import FillEvent
+from portfolio import Portfolio
+from signals import MovingAverage
+from simulator import Order
+from sweep import build_simulator
+
+DEFAULT_BASELINE = '../results/benchmark_baseline.json'
+
+
+def synthetic_bars(n_bars, volatility=0.8, drift=0., price=1000., spread=0.3,
+                   start='2017-01-01', freq='H', seed=0):
+    """
+    A BarStore of Bid/Ask quotes around a geometric Brownian motion.
+
+    Parameters:
+    n_bars - the number of bars.
+    volatility, drift - annualised volatility and drift of the mid price.
+    price - the first mid price.
+    spread - Bid/Ask are this far below/above the mid price.
+    start, freq - the datetime of the first bar and the bar frequency.
+    seed - the seed of the random numbers, so runs are reproducible.
+    """
+    dt = pd.Timedelta(pd.tseries.frequencies.to_offset(freq)).total_seconds() / (365. * 24 * 3600)
+    rng = np.random.RandomState(seed)
+    returns = (drift - 0.5 * volatility ** 2) * dt + volatility * np.sqrt(dt) * rng.randn(n_bars)
+    returns[0] = 0.
+    mid = price * np.exp(np.cumsum(returns))
+    datetimes = pd.date_range(start, periods=n_bars, freq=freq).values.view(np.int64)
+    return BarStore([('Datetime', datetimes), ('Bid', mid - spread), ('Ask', mid + spread)])
+
+
+def write_csv(bars, path):
+    """
+    Writes the mid prices of bars as a csv that BitcoinFromCSV can read.
+    """
+    mid = (bars.column('Bid') + bars.column('Ask')) / 2.
+    pd.DataFrame({'Timestamp': pd.to_datetime(bars.datetime),
+                  'Weighted Price': mid}).to_csv(path, index=False)
+
+
+class _Sink(object):
+    """
+    An event queue that drops what is put on it.
+    """
+
+    def put(self, event):
+        pass
+
+
+def _best_time(func, repeat):
+    """
+    The shortest of `repeat` timings; func sets up its own run and
+    returns the seconds the timed part took.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        elapsed = func()
+        best = min(best, elapsed)
+    return best
+
+
+def bench_simulator(bars):
+    """
+    A full run of the default pipeline (see sweep.build_simulator).
+    """
+    simulator = build_simulator(bars)
+    with warnings.catch_warnings():
+        # the moving average warns until it has enough history
+        warnings.simplefilter('ignore')
+        start = time.time()
+        simulator.run()
+        return time.time() - start
+
+
+def bench_stream(bars):
+    """
+    Only streaming the bars; the other component benchmarks include it.
+    """
+    stream = HistoricBarStream(_Sink(), bars)
+    start = time.time()
+    for _ in stream._data_streamer():
+        pass
+    return time.time() - start
+
+
+def bench_csv_load(path, use_cache):
+    start = time.time()
+    BitcoinFromCSV(_Sink(), path, spread=0.3, use_cache=use_cache)
+    return time.time() - start
+
+
+def bench_moving_average(bars):
+    stream = HistoricBarStream(_Sink(), bars)
+    ma = MovingAverage(lookback_period=datetime.timedelta(days=3))
+    update = ma.update
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        start = time.time()
+        for bar in stream._data_streamer():
+            update(bar)
+        return time.time() - start
+
+
+def bench_execute_order(bars):
+    stream = HistoricBarStream(_Sink(), bars)
+    broker = BacktestingBroker(stream, _Sink(), commission=0.01)
+    orders = [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=1,
+                    side='B' if i % 2 else 'S', posted_at=bars.datetime[i]) for i in xrange(len(bars))]
+    execute_order = broker.execute_order
+    start = time.time()
+    for bar, order in zip(stream._data_streamer(), orders):
+        execute_order(order)
+    return time.time() - start
+
+
+def bench_portfolio_update(bars):
+    stream = HistoricBarStream(_Sink(), bars)
+    broker = BacktestingBroker(stream, _Sink(), commission=0.01)
+    portfolio = Portfolio(broker, 1000)
+    bid, ask = bars.column('Bid'), bars.column('Ask')
+    fills = []
+    for i in xrange(len(bars)):
+        side = 'B' if i % 3 else 'S'
+        price = ask[i] if side == 'B' else bid[i]
+        fills.append([FillEvent(timeindex=bars.datetime[i], symbol='BTC', exchange='TestExchange',
+                                volume=1, side=side, fill_cost=price, commission=0.01, price=price)])
+    update = portfolio.update
+    start = time.time()
+    for bar, fill in zip(stream._data_streamer(), fills):
+        update(fill)
+    return time.time() - start
+
+
+def run_benchmarks(n_bars=100000, repeat=3, volatility=0.8, seed=0):
+    """
+    Runs every benchmark on n_bars synthetic bars and returns an
+    OrderedDict of name -> bars per second (best of `repeat` runs).
+    """
+    bars = synthetic_bars(n_bars, volatility=volatility, seed=seed)
+    directory = tempfile.mkdtemp(prefix='benchmarks')
+    try:
+        csv_path = os.path.join(directory, 'bars.csv')
+        write_csv(bars, csv_path)
+        benchmarks = [('simulator', lambda: bench_simulator(bars)),
+                      ('stream', lambda: bench_stream(bars)),
+                      ('csv_load', lambda: bench_csv_load(csv_path, use_cache=False)),
+                      ('csv_load_cached', lambda: bench_csv_load(csv_path, use_cache=True)),
+                      ('moving_average_update', lambda: bench_moving_average(bars)),
+                      ('broker_execute_order', lambda: bench_execute_order(bars)),
+                      ('portfolio_update', lambda: bench_portfolio_update(bars))]
+        # the cached load needs a cache to read
+        BitcoinFromCSV(_Sink(), csv_path, spread=0.3)
+        rates = OrderedDict()
+        for name, func in benchmarks:
+            elapsed = _best_time(func, repeat)
+            rates[name] = n_bars / elapsed if elapsed > 0 else float('inf')
+        return rates
+    finally:
+        shutil.rmtree(directory)
+
+
+def save_baseline(rates, path, n_bars=None):
+    """
+    Writes the rates, with the machine they were measured on, as JSON.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fp:
+        json.dump({'rates': rates, 'bars': n_bars, 'python': platform.python_version(),
+                   'machine': platform.node(), 'saved_at': datetime.datetime.now().isoformat()},
+                  fp, indent=2)
+
+
+def load_baseline(path):
+    with open(path) as fp:
+        return json.load(fp)['rates']
+
+
+def compare(rates, baseline, tolerance=0.2):
+    """
+    Compares rates to a baseline. Returns a DataFrame with one row per
+    benchmark and a 'regression' column that is True where the rate fell
+    by more than `tolerance` (a fraction) below the baseline's.
+    """
+    rows = []
+    for name, rate in rates.items():
+        base = baseline.get(name)
+        ratio = rate / base if base else np.nan
+        rows.append({'benchmark': name, 'bars_per_s': rate, 'baseline': base, 'ratio': ratio,
+                     'regression': bool(base) and ratio < 1. - tolerance})
+    return pd.DataFrame(rows, columns=['benchmark', 'bars_per_s', 'baseline', 'ratio', 'regression'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the backtester on synthetic bars.")
+    parser.add_argument('--bars', type=int, default=100000, help="number of bars")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark (the best counts)")
+    parser.add_argument('--volatility', type=float, default=0.8, help="annualised volatility")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+    rates = run_benchmarks(args.bars, args.repeat, args.volatility, args.seed)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            saved = json.load(fp)
+        baseline = saved['rates']
+        if saved.get('bars') != args.bars:
+            print "baseline was measured on {} bars, not {}".format(saved.get('bars'), args.bars)
+    comparison = compare(rates, baseline, args.tolerance)
+    print comparison.to_string(index=False, float_format=lambda x: '{:.3g}'.format(x))
+    if args.save:
+        save_baseline(rates, args.baseline, args.bars)
+        return 0
+    return 1 if comparison['regression'].any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
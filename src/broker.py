@@ -1,6 +1,11 @@
+import numpy as np
+import pandas as pd
+
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
 from event import FillEvent
+from pending import PendingOrders
+from costs import PerUnitFee
 
 
 class BasicBroker(object):
@@ -22,67 +27,206 @@ class BasicBroker(object):
     def get_best_bid_ask(self, ticker, exchange):
         return self.dataStream.get_latest_bars(N=1)[['Bid','Ask']]
 
+    @property
+    def quotes(self):
+        """
+        The data stream's QuoteSnapshot, if it publishes one.
+        """
+        return getattr(self.dataStream, 'quotes', None)
+
+    def get_bid_ask(self, ticker, exchange):
+        """
+        The current (bid, ask) as scalars, read from the stream's quote
+        snapshot if it publishes one and from its latest bar otherwise.
+        """
+        quotes = self.quotes
+        if quotes is not None:
+            return quotes.bid_ask(ticker, exchange)
+        data = self.get_best_bid_ask(ticker, exchange)
+        return np.asarray(data['Bid'])[-1], np.asarray(data['Ask'])[-1]
+
     def get_last_close(self, ticker, exchange):
-        return self.dataStream.get_latest_bars(N=1)['Close'].values[0]
+        return np.asarray(self.dataStream.get_latest_bars(N=1)['Close'])[0]
 
 
 class BacktestingBroker(BasicBroker):
     """
     this broker should be used in conjunction with the historical backtester
+
+    By default orders fill in full at the current bar's Bid/Ask. For
+    instruments with recorded depth (books) orders are instead filled by
+    walking the replayed order book, level by level, up to the order's
+    volume (and limit price).
+
+    Limit orders that aren't marketable when they arrive rest in a
+    pending-order book per instrument (see pending.PendingOrders) and are
+    filled at their limit price by on_bar once the quotes cross them.
+
+    Market orders filled at the bar's prices can be charged slippage by a
+    costs.SlippageModel, and the commission of every fill is computed by a
+    costs.FeeModel (a fixed commission per unit by default).
     """
-    def __init__(self, dataStream, event_queue, commission):
+    def __init__(self, dataStream, event_queue, commission, books=None, slippage=None, fees=None):
+        """
+        Parameters:
+        dataStream - the data stream providing the bars.
+        event_queue - where fills are put.
+        commission - commission per unit of volume (used if no fee model
+                     is given).
+        books - optional dict of (symbol, exchange) -> orderbook.BookReplay.
+        slippage - optional costs.SlippageModel for market orders.
+        fees - optional costs.FeeModel.
+        """
         self.dataStream = dataStream
         self.event_queue = event_queue
         self.commission = commission
+        self.books = {} if books is None else books
+        self.slippage = slippage
+        self.fees = PerUnitFee(commission) if fees is None else fees
+        self.pending = {}
 
     def execute_order(self, order):        
+        if self.books and (order.symbol, order.exchange) in self.books:
+            return self._book_order(order)
         if order.order_type == 'MKT':
             return self._market_order(order)
         elif order.order_type == 'LMT':
             return self._limit_order(order)
 
-    def get_market_price(self, exchange, side):
-        data = self.dataStream.get_latest_bars(N=10)
+    def get_market_price(self, exchange, side, symbol='BTC'):
         assert(side=='B' or side=='S'), "side must be 'S' or 'B'"
+        bid, ask = self.get_bid_ask(symbol, exchange)
         if side=='B':
-            return data['Ask'].values[-1]
+            return ask
         elif side=='S':
-            return data[['Bid']].values[-1]        
+            return bid
 
 
     def _market_order(self, order):
         """
         executes a market order
         """
-        market_price = self.get_market_price(order.exchange, order.side)
+        market_price = self.get_market_price(order.exchange, order.side, order.symbol)
         volume = order.volume
+        if self.slippage is not None:
+            bar_volume = self._bar_volume() if self.slippage.needs_volume else None
+            market_price = self.slippage.fill_price(market_price, volume, order.side, bar_volume)
         fill_cost = volume * market_price
-        fill_event = FillEvent(timeindex=order.posted_at, symbol='BTC', exchange='TestExchange',
+        fill_event = FillEvent(timeindex=self._execution_time(order), symbol=order.symbol,
+                               exchange=order.exchange,
                                volume=volume, side=order.side, fill_cost=fill_cost,
-                               commission=volume * self.commission, price=market_price)
+                               commission=self.fees.fee(market_price, volume), price=market_price)
         self.event_queue.put(fill_event)
         return fill_event
 
     def _limit_order(self, order):
         """
-        executes a limit order
+        executes a limit order, or rests it if it isn't marketable
         """
         volume = order.volume        
-        market_price = self.get_market_price(order.exchange, order.side)
+        market_price = self.get_market_price(order.exchange, order.side, order.symbol)
         fill_cost = volume * order.price
-        if order.side=='B' and order.price>=market_price:
-            fill_event = FillEvent(timeindex=order.posted_at, symbol='BTC', exchange='TestExchange',
-                                   volume=volume, side=order.side, fill_cost=fill_cost,
-                                   commission=volume * self.commission, price=order.price)
-            self.event_queue.put(fill_event)
-            return fill_event
-        elif order.side=='S' and order.price<=market_price:
-            fill_event = FillEvent(timeindex=order.posted_at, symbol='BTC', exchange='TestExchange',
-                                   volume=volume, side=order.side, fill_cost=fill_cost,
-                                   commission=volume * self.commission, price=order.price)
-            self.event_queue.put(fill_event)
-            return fill_event
+        if not self._is_marketable(order, market_price):
+            self._pending_orders(order.symbol, order.exchange).add(order)
+            return None
+        fill_event = FillEvent(timeindex=self._execution_time(order), symbol=order.symbol,
+                               exchange=order.exchange,
+                               volume=volume, side=order.side, fill_cost=fill_cost,
+                               commission=self.fees.fee(order.price, volume), price=order.price)
+        self.event_queue.put(fill_event)
+        return fill_event
 
+    def _bar_volume(self):
+        window = self.dataStream.get_latest_bars(N=1)
+        if 'Volume' not in window.columns:
+            return None
+        return np.asarray(window['Volume'])[-1]
+
+    def _execution_time(self, order):
+        """
+        When an order executes: the time of the quotes it is filled at
+        (with order latency a later bar than the one it was posted at),
+        else the current time of the event loop, else its posting time.
+        """
+        quotes = self.quotes
+        if quotes is not None and quotes.timestamp is not None:
+            return pd.Timestamp(quotes.timestamp)
+        now = getattr(self.event_queue, 'now', None)
+        if now is not None:
+            return pd.Timestamp(now)
+        return order.posted_at
+
+    @staticmethod
+    def _is_marketable(order, market_price):
+        if order.side == 'B':
+            return order.price >= market_price
+        return order.price <= market_price
+
+    def _pending_orders(self, symbol, exchange):
+        pending = self.pending.get((symbol, exchange))
+        if pending is None:
+            pending = self.pending[(symbol, exchange)] = PendingOrders()
+        return pending
+
+    def cancel_order(self, order):
+        """
+        Cancels a resting limit order; returns False if it isn't resting
+        (any more).
+        """
+        pending = self.pending.get((order.symbol, order.exchange))
+        return pending is not None and pending.cancel(order.order_id) is not None
+
+    def replace_order(self, order, price=None, volume=None):
+        """
+        Changes the price and/or volume of a resting limit order, which
+        then queues behind the orders already resting at its new price.
+        """
+        return self.pending[(order.symbol, order.exchange)].replace(order.order_id, price, volume)
+
+    def on_bar(self, timestamp):
+        """
+        Called on every new bar: fills the resting limit orders that the
+        current quotes have crossed (and drops expired ones). Returns the
+        fills, which are also put on the event queue.
+        """
+        fills = []
+        for (symbol, exchange), pending in self.pending.items():
+            if not pending:
+                continue
+            try:
+                bid, ask = self.get_bid_ask(symbol, exchange)
+            except IndexError:
+                continue
+            for order in pending.match(bid, ask, timestamp):
+                fill_event = FillEvent(timeindex=timestamp, symbol=symbol, exchange=exchange,
+                                       volume=order.volume, side=order.side,
+                                       fill_cost=order.volume * order.price,
+                                       commission=self.fees.fee(order.price, order.volume),
+                                       price=order.price)
+                self.event_queue.put(fill_event)
+                fills.append(fill_event)
+        return fills
+
+    def _book_order(self, order):
+        """
+        executes an order against the replayed order book of its
+        instrument, as of the current time of the event loop (or the
+        time the order was posted). The liquidity taken is removed from
+        the book until the next depth update overwrites those levels.
+        """
+        now = getattr(self.event_queue, 'now', None)
+        executed_at = order.posted_at if now is None else pd.Timestamp(now)
+        book = self.books[(order.symbol, order.exchange)].advance_to(executed_at)
+        limit = order.price if order.order_type == 'LMT' else None
+        filled, fill_cost = book.walk(order.side, order.volume, limit, consume=True)
+        if not filled:
+            return None
+        fill_event = FillEvent(timeindex=executed_at, symbol=order.symbol, exchange=order.exchange,
+                               volume=filled, side=order.side, fill_cost=fill_cost,
+                               commission=self.fees.fee(fill_cost / filled, filled),
+                               price=fill_cost / filled)
+        self.event_queue.put(fill_event)
+        return fill_event
 
     def istick(self):
         return True
@@ -107,7 +251,7 @@ class CoinbaseSandboxBroker(BasicBroker):
     def _market_order(self, order, market_price):
         volume = order.volume
         fill_cost = volume * market_price
-        fill_event = FillEvent(timeindex=datetime.now(), symbol='BTC', exchange='Coinbase',
+        fill_event = FillEvent(timeindex=datetime.now(), symbol=order.symbol, exchange='Coinbase',
                                volume=volume, side=order.side, fill_cost=fill_cost,
                                commission=volume * self.commission, price=market_price)
         self.event_queue.put(fill_event)
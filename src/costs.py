@@ -0,0 +1,161 @@
+import numpy as np
+
+
+class SlippageModel(object):
+    """
+    Base class of slippage/market impact models.
+
+    slippage(price, volume, bar_volume) returns how much worse than
+    `price` an order of `volume` fills, per unit (buys pay price +
+    slippage, sells get price - slippage). It works elementwise on NumPy
+    arrays as well as on scalars, so the broker can evaluate a model per
+    order and vectorized.run_vectorized over all trades at once.
+    """
+
+    # whether the model needs the traded volume of the bar
+    needs_volume = False
+
+    def slippage(self, price, volume, bar_volume=None):
+        raise NotImplementedError("Should implement slippage()")
+
+    def fill_price(self, price, volume, side, bar_volume=None):
+        """
+        The fill price of an order on `side`: 'B' or 'S', or for arrays
+        the signed volumes (positive for buys).
+        """
+        if isinstance(side, basestring):
+            sign = 1. if side == 'B' else -1.
+        else:
+            sign = np.sign(side)
+        return price + sign * self.slippage(price, volume, bar_volume)
+
+
+class FixedBpsSlippage(SlippageModel):
+    """
+    A fixed number of basis points of the price.
+    """
+
+    def __init__(self, bps):
+        self.bps = bps
+
+    def slippage(self, price, volume, bar_volume=None):
+        return price * self.bps * 1e-4
+
+
+class ParticipationSlippage(SlippageModel):
+    """
+    Slippage proportional to the order's share of the bar's volume:
+    price * coefficient * volume / bar_volume.
+    """
+
+    needs_volume = True
+
+    def __init__(self, coefficient):
+        self.coefficient = coefficient
+
+    def slippage(self, price, volume, bar_volume=None):
+        return price * self.coefficient * _participation(volume, bar_volume)
+
+
+class SquareRootImpact(SlippageModel):
+    """
+    The square-root market impact law:
+    price * coefficient * volatility * sqrt(volume / bar_volume),
+    with volatility the standard deviation of returns over the horizon
+    that bar_volume is measured over.
+    """
+
+    needs_volume = True
+
+    def __init__(self, volatility, coefficient=1.):
+        self.volatility = volatility
+        self.coefficient = coefficient
+
+    def slippage(self, price, volume, bar_volume=None):
+        return price * self.coefficient * self.volatility * np.sqrt(_participation(volume, bar_volume))
+
+
+def _participation(volume, bar_volume):
+    if bar_volume is None:
+        raise ValueError("this slippage model needs the bars' Volume")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.asarray(bar_volume) > 0, np.abs(volume) / bar_volume, np.inf)
+
+
+class FeeModel(object):
+    """
+    Base class of exchange fee models.
+
+    fees(price, volume) returns the fees of a sequence of fills (arrays,
+    in the order they happen) and fee(price, volume) the fee of the next
+    single fill, so that fee models which depend on the volume traded so
+    far can keep track of it.
+    """
+
+    def fees(self, price, volume):
+        raise NotImplementedError("Should implement fees()")
+
+    def fee(self, price, volume):
+        return float(self.fees(np.asarray([price], dtype=float), np.asarray([volume], dtype=float))[0])
+
+
+class PerUnitFee(FeeModel):
+    """
+    A fixed fee per unit traded (the broker's `commission`).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def fees(self, price, volume):
+        return np.abs(volume) * self.rate
+
+    def fee(self, price, volume):
+        return abs(volume) * self.rate
+
+
+class BpsFee(FeeModel):
+    """
+    A fixed number of basis points of the notional.
+    """
+
+    def __init__(self, bps):
+        self.bps = bps
+
+    def fees(self, price, volume):
+        return np.abs(volume) * price * self.bps * 1e-4
+
+
+class TieredFee(FeeModel):
+    """
+    Exchange fee tiers: the fee rate (in basis points of the notional)
+    drops as the notional traded so far passes each tier's threshold.
+    """
+
+    def __init__(self, tiers):
+        """
+        Parameters:
+        tiers - list of (notional threshold, bps), starting at threshold 0.
+        """
+        tiers = sorted(tiers)
+        assert(tiers and tiers[0][0] == 0), "the first tier must start at 0"
+        self.thresholds = np.array([threshold for threshold, _ in tiers], dtype=float)
+        self.rates = np.array([bps for _, bps in tiers], dtype=float) * 1e-4
+        self.traded = 0.
+
+    def _rates(self, traded_before):
+        return self.rates[np.searchsorted(self.thresholds, traded_before, side='right') - 1]
+
+    def fees(self, price, volume):
+        """
+        The fees of a sequence of fills, starting from no traded notional.
+        """
+        notional = np.abs(volume) * price
+        traded_before = np.cumsum(notional) - notional
+        return notional * self._rates(traded_before)
+
+    def fee(self, price, volume):
+        notional = abs(volume) * price
+        fee = notional * float(self._rates(self.traded))
+        self.traded += notional
+        return fee
@@ -1,12 +1,19 @@
-import datetime
-import time
 import os
 import os.path
+import zipfile
+import zlib
+import numpy as np
 import pandas as pd
 
 from abc import ABCMeta, abstractmethod
 
 from event import MarketEvent
+from bars import BarStore, Bar, BarWindow, PartitionWriter, read_partitions, attach_bars
+from quotes import QuoteSnapshot
+from runlog import get_logger
+
+log = get_logger('data')
+
 
 class DataHandler(object):
     """
@@ -43,144 +50,323 @@ class DataHandler(object):
         raise NotImplementedError("Should implement _data_streamer()")
 
 
-class BitcoinFromCSV(DataHandler):
+class HistoricBarStream(DataHandler):
+    """
+    Streams historical bars out of a columnar BarStore.
+
+    Bars are handed out as lightweight views and get_latest_bars returns
+    zero-copy windows onto the store's arrays, so no pandas objects are
+    built while a backtest is running. The Bid/Ask of every bar is
+    published to self.quotes (a QuoteSnapshot) as it is streamed.
+    """
+
+    def __init__(self, events, bars, start=0, stop=None, symbol='BTC', exchange='TestExchange'):
+        """
+        Parameters:
+        events - The Event Queue.
+        bars - A BarStore holding the historical data.
+        start, stop - Only stream the rows [start, stop) of the store.
+                      Earlier rows stay visible to get_latest_bars.
+        symbol, exchange - The instrument the bars are quotes of.
+        """
+        self.events = events
+        self.bars = bars
+        self.start = start
+        self.stop = len(bars) if stop is None else stop
+        self.continue_backtest = True
+        self.current_idx = start
+        self.symbol = symbol
+        self.exchange = exchange
+        self.quotes = QuoteSnapshot()
+        self.instrument_id = self.quotes.instrument_id(symbol, exchange)
+
+    @property
+    def symbol_data(self):
+        """
+        The streamed bars as a pandas DataFrame (built on demand).
+        """
+        return self.bars.to_frame(self.start, self.stop)
+
+    def _data_streamer(self):
+        bars = self.bars
+        bid, ask, datetimes = bars.data['Bid'], bars.data['Ask'], bars.datetime
+        publish, instrument_id = self.quotes.publish, self.instrument_id
+        for row_idx in xrange(self.start, self.stop):
+            self.current_idx = row_idx + 1
+            publish(instrument_id, bid[row_idx], ask[row_idx], datetimes[row_idx])
+            yield Bar(bars, row_idx)
+
+    def get_latest_bars(self, N=1):
+        """
+        Returns the last N bars up to and including the current one,
+        or N-k if less available.
+        """
+        return BarWindow(self.bars, max(self.current_idx - N, 0), self.current_idx)
+
+    def update_bars(self):
+        """
+        Pushes the next bar onto the latest bars window.
+        """
+        if self.current_idx >= self.stop:
+            self.continue_backtest = False
+            return
+        self.current_idx += 1
+        row_idx = self.current_idx - 1
+        self.quotes.publish(self.instrument_id, self.bars.data['Bid'][row_idx],
+                            self.bars.data['Ask'][row_idx], self.bars.datetime[row_idx])
+        bar = Bar(self.bars, row_idx)
+        self.events.put(MarketEvent(bar['Datetime'], bar))
+
+
+class SharedBarStream(HistoricBarStream):
+    """
+    Streams bars that another process published with bars.publish_bars.
+    The columns are memory-mapped read-only, so any number of backtest
+    processes can attach to one copy of the history.
+    """
+
+    def __init__(self, events, path):
+        """
+        Parameters:
+        events - The Event Queue.
+        path - The path returned by publish_bars.
+        """
+        self.path = path
+        super(SharedBarStream, self).__init__(events, attach_bars(path))
+
+
+class BitcoinFromCSV(HistoricBarStream):
     """
     Reads historical BTC prices from a csv file
     """
 
-    def __init__(self, events, csv_path, spread):
+    CACHE_VERSION = 1
+
+    def __init__(self, events, csv_path, spread, use_cache=True):
         """
         Initialises the historic data handler by requesting
         the location of the CSV files and an event queue.
 
         Parameters:
         events - The Event Queue.
-        csv_dir - Absolute directory path to the CSV files.
-        symbol_list - A list of symbol strings.
+        csv_path - Path to the CSV file.
+        spread - Half the spread added around the weighted price.
+        use_cache - Keep a binary copy of the parsed prices next to the
+                    csv (<csv_path>.bars.npz) and load from it while the
+                    csv's size and mtime are unchanged.
         """
-        self.events = events
         self.csv_path = csv_path
         self.spread = spread
-
-        self.symbol_data = pd.DataFrame()
-        self.latest_symbol_data = pd.DataFrame()
-        self.continue_backtest = True
-
-        self._open_convert_csv_files()
-        self.length = 0
-        self.current_idx = 1        
+        self.use_cache = use_cache
+        self.cache_path = csv_path + '.bars.npz'
+        super(BitcoinFromCSV, self).__init__(events, self._open_convert_csv_files())
 
     def _open_convert_csv_files(self):
         """
-        Opens the CSV file from the data directory, converting
-        it into pandas DataFrames within a symbol dictionary.
-
-        """
-        symbol_data = pd.read_csv(self.csv_path)
-        symbol_data['Datetime'] = symbol_data[
-            'Timestamp'].apply(lambda x: pd.to_datetime(x))
-        symbol_data = symbol_data.sort_values(by='Datetime')
-        self.symbol_data = symbol_data
-        #self.current_time = symbol_data['Datetime'].min()
-        self.latest_symbol_data = pd.DataFrame(
-            dict([(c, {}) for c in self.symbol_data.columns]))
-        self.symbol_data['Weighted Price'] = pd.to_numeric(
-            self.symbol_data['Weighted Price'], errors='coerce')
-        self.symbol_data['Bid'] = self.symbol_data['Weighted Price'] - self.spread
-        self.symbol_data['Ask'] = self.symbol_data['Weighted Price'] + self.spread
-        print self.symbol_data.columns
-        self.symbol_data = self.symbol_data[['Datetime','Bid','Ask']]
-
-    def _data_streamer(self):
-        for row_idx in xrange(len(self.symbol_data)):
-            self.current_idx += 1
-            yield self.symbol_data.iloc[row_idx]
+        Loads the weighted prices (from the cache if it is still valid,
+        otherwise from the csv) and converts them into a columnar BarStore
+        with Datetime, Bid and Ask columns.
+        """
+        prices = self._load_cache() if self.use_cache else None
+        if prices is None:
+            prices = self._parse_csv()
+            if self.use_cache:
+                self._write_cache(*prices)
+        datetimes, weighted_price = prices
+        return BarStore([('Datetime', datetimes),
+                         ('Bid', weighted_price - self.spread),
+                         ('Ask', weighted_price + self.spread)])
 
-    def _get_new_bar(self):
+    def _parse_csv(self):
         """
-        Returns the latest bar from the data feed as a tuple of
-        (sybmbol, datetime, open, low, high, close, volume).
+        Parses the csv into sorted arrays of int64 datetimes and
+        float64 weighted prices.
         """
-        yield self.symbol_data.iloc[self.length:(self.length + 1)]
+        symbol_data = pd.read_csv(self.csv_path, usecols=['Timestamp', 'Weighted Price'])
+        log.debug("columns of %s: %s", self.csv_path, list(symbol_data.columns))
+        datetimes, weighted_price = _weighted_prices(symbol_data)
+        order = np.argsort(datetimes, kind='mergesort')
+        return datetimes[order], weighted_price[order]
 
-    def get_latest_bars(self, N=1):
+    def _source_signature(self):
+        stat = os.stat(self.csv_path)
+        return np.array([self.CACHE_VERSION, stat.st_size, int(stat.st_mtime * 1e9)],
+                        dtype=np.int64)
+
+    def _load_cache(self):
         """
-        Returns the last N bars from the latest_symbol list,
-        or N-k if less available.
+        Returns the cached (datetimes, weighted_price) arrays, or None if
+        there is no cache, it was written for a different csv or it can't
+        be read (e.g. a truncated or corrupt file, which is then replaced
+        like a stale one).
         """
-        return self.symbol_data.iloc[max([self.current_idx - N, 0]):self.current_idx]
+        if not os.path.exists(self.cache_path):
+            return None
+        if not zipfile.is_zipfile(self.cache_path):
+            log.warning("ignoring unreadable cache %s", self.cache_path)
+            return None
+        try:
+            with np.load(self.cache_path) as cache:
+                if not np.array_equal(cache['signature'], self._source_signature()):
+                    return None
+                return cache['Datetime'], cache['Weighted Price']
+        except (IOError, KeyError, ValueError, EOFError, zipfile.BadZipfile, zlib.error) as e:
+            log.warning("ignoring unreadable cache %s: %s", self.cache_path, e)
+            return None
 
-    def update_bars(self):
+    def _write_cache(self, datetimes, weighted_price):
         """
-        Pushes the latest bar to the latest_symbol_data structure
-        for all symbols in the symbol list.
+        Writes the cache atomically so that concurrent runs never
+        see a half written file.
         """
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
         try:
-            bar = self._get_new_bar().next()
-        except StopIteration:
-            self.continue_backtest = False
-        else:
-            if bar is not None:
-                self.latest_symbol_data = pd.concat(
-                    [self.latest_symbol_data, bar])
-        self.length += 1
-        self.events.put(MarketEvent())
+            with open(tmp_path, 'wb') as fp:
+                np.savez(fp, **{'signature': self._source_signature(),
+                                'Datetime': datetimes,
+                                'Weighted Price': weighted_price})
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
 
+def _weighted_prices(symbol_data):
+    """
+    int64 datetimes and float64 weighted prices of a frame read from a
+    csv in the BitcoinFromCSV format.
+    """
+    datetimes = pd.to_datetime(symbol_data['Timestamp']).values.view(np.int64)
+    weighted_price = pd.to_numeric(
+        symbol_data['Weighted Price'], errors='coerce').values.astype(np.float64)
+    return datetimes, weighted_price
 
 
-class CoinbaseSandboxStream(DataHandler):
-    def __init__(self, events, update_rate, client):
-        """
-        Uses the Coinbase sandbox API to livestream BTC prices and place orders.
+def partition_csv(csv_path, root, spread, freq='M', chunksize=100000):
+    """
+    Converts a csv in the BitcoinFromCSV format into a partitioned store
+    for PartitionedBarStream, reading it `chunksize` rows at a time, so
+    memory use is bounded by the chunk and partition size rather than by
+    the length of the csv. The rows must be in time order.
+
+    Parameters:
+    csv_path - Path to the CSV file.
+    root - directory that will hold the partitions.
+    spread - Half the spread added around the weighted price.
+    freq - a NumPy datetime unit to partition by ('Y', 'M', 'D', ...).
+    chunksize - number of csv rows read at a time.
+    """
+    writer = PartitionWriter(root, freq)
+    for symbol_data in pd.read_csv(csv_path, usecols=['Timestamp', 'Weighted Price'],
+                                   chunksize=chunksize):
+        datetimes, weighted_price = _weighted_prices(symbol_data)
+        writer.append(BarStore([('Datetime', datetimes),
+                                ('Bid', weighted_price - spread),
+                                ('Ask', weighted_price + spread)]))
+    return writer.close()
+
 
+class PartitionedBarStream(DataHandler):
+    """
+    Streams bars from an on-disk, time-partitioned store written by
+    bars.write_partitions (one directory of .npy columns per month).
+
+    Partitions are memory-mapped one at a time as the stream reaches them,
+    and only the current and the previous partition are kept open, so
+    resident memory is bounded by the partition size rather than by the
+    length of the history. Quotes are published to self.quotes as in
+    HistoricBarStream.
+    """
+
+    def __init__(self, events, root, symbol='BTC', exchange='TestExchange'):
+        """
         Parameters:
         events - The Event Queue.
-        update_rate - The frequency of API calls
-        client - An instance of the coinbase client
+        root - Directory holding the partitions and their manifest.
+        symbol, exchange - The instrument the bars are quotes of.
         """
         self.events = events
-        self.update_rate = update_rate
-
-        self.symbol_data = pd.DataFrame()
-        self.latest_symbol_data = pd.DataFrame()
+        self.root = root
+        self.partitions = read_partitions(root)
         self.continue_backtest = True
-        self.client = client
+        self.current_idx = 0
+        self._chunks = {}
+        self._chunk_idx = 0
+        self._row_idx = -1
+        self._streamer = None
+        self.symbol = symbol
+        self.exchange = exchange
+        self.quotes = QuoteSnapshot()
+        self.instrument_id = self.quotes.instrument_id(symbol, exchange)
 
-    def _api_listener(self):
-        while True:
-            time.sleep(self.update_rate)
-            buy_price = self.client.get_buy_price(currency_pair = 'BTC-USD')
-            sell_price = self.client.get_sell_price(currency_pair = 'BTC-USD')
-            date_time = datetime.datetime.strptime(self.client.get_time()['iso'],"%Y-%m-%dT%H:%M:%SZ")
-            yield pd.DataFrame({'buy':buy_price, "sell":sell_price, "datetime":date_time})
+    def _open_chunk(self, chunk_idx):
+        chunk = self._chunks.get(chunk_idx)
+        if chunk is None:
+            chunk = BarStore.load(os.path.join(
+                self.root, self.partitions[chunk_idx]['name']), mmap_mode='r')
+            self._chunks[chunk_idx] = chunk
+        return chunk
+
+    def _advance_to_chunk(self, chunk_idx):
+        """
+        Opens a partition and closes everything older than its predecessor.
+        """
+        self._chunk_idx = chunk_idx
+        for idx in list(self._chunks):
+            if idx < chunk_idx - 1:
+                del self._chunks[idx]
+        return self._open_chunk(chunk_idx)
 
     def _data_streamer(self):
-        while True:
-            time.sleep(self.update_rate)
-            buy_price = self.client.get_buy_price(currency_pair = 'BTC-USD')
-            sell_price = self.client.get_sell_price(currency_pair = 'BTC-USD')
-            date_time = datetime.datetime.strptime(self.client.get_time()['iso'],"%Y-%m-%dT%H:%M:%SZ")
-            yield pd.DataFrame({"datetime": [date_time], 'buy':[buy_price['amount']], "sell": [sell_price['amount']]})
+        for chunk_idx in xrange(len(self.partitions)):
+            chunk = self._advance_to_chunk(chunk_idx)
+            bid, ask, datetimes = chunk.data['Bid'], chunk.data['Ask'], chunk.datetime
+            for row_idx in xrange(len(chunk)):
+                self._row_idx = row_idx
+                self.current_idx += 1
+                self.quotes.publish(self.instrument_id, bid[row_idx], ask[row_idx],
+                                    datetimes[row_idx])
+                yield Bar(chunk, row_idx)
+        self.continue_backtest = False
 
     def get_latest_bars(self, N=1):
         """
-        Returns the last N bars from the latest_symbol list,
-        or N-k if less available.
+        Returns the last N bars up to and including the current one,
+        or N-k if less available. Windows that stay inside the current
+        partition are zero-copy views; windows that reach back into
+        earlier partitions are assembled into a small temporary store.
         """
-        return self.symbol_data.iloc[max([self.current_idx - N, 0]):self.current_idx]
+        chunk = self._open_chunk(self._chunk_idx)
+        stop = self._row_idx + 1
+        if N <= stop or self._chunk_idx == 0:
+            return BarWindow(chunk, max(stop - N, 0), stop)
+        pieces = [(chunk, 0, stop)]
+        missing = N - stop
+        chunk_idx = self._chunk_idx - 1
+        while missing > 0 and chunk_idx >= 0:
+            if chunk_idx in self._chunks:
+                previous = self._chunks[chunk_idx]
+            else:
+                previous = BarStore.load(os.path.join(
+                    self.root, self.partitions[chunk_idx]['name']), mmap_mode='r')
+            start = max(len(previous) - missing, 0)
+            pieces.append((previous, start, len(previous)))
+            missing -= len(previous) - start
+            chunk_idx -= 1
+        pieces.reverse()
+        window = BarStore([(c, np.concatenate([p.data[c][start:stop] for p, start, stop in pieces]))
+                           for c in chunk.columns])
+        return BarWindow(window, 0, len(window))
 
     def update_bars(self):
         """
-        Pushes the latest bar to the latest_symbol_data structure
-        for all symbols in the symbol list.
+        Pushes the next bar onto the latest bars window.
         """
+        if self._streamer is None:
+            self._streamer = self._data_streamer()
         try:
-            bar = self._get_new_bar().next()
+            bar = next(self._streamer)
         except StopIteration:
             self.continue_backtest = False
         else:
-            if bar is not None:
-                self.latest_symbol_data = pd.concat(
-                    [self.latest_symbol_data, bar])
-        self.length += 1
-        self.events.put(MarketEvent())
\ No newline at end of file
+            self.events.put(MarketEvent(bar['Datetime'], bar))
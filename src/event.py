@@ -1,3 +1,9 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
 # bitcoin trading backtesting code
 class Event(object):
     """
@@ -6,8 +12,30 @@ class Event(object):
     trading infrastructure.
 
     Would it make sense to use a timestamp as an attribute?
+
+    Events are created for every bar and every fill, so all of them use
+    __slots__ instead of a per-instance __dict__; the event type is a
+    class attribute.
     """
-    pass
+    __slots__ = ()
+
+    def __getstate__(self):
+        # slotted objects have no __dict__ for pickle to save
+        return dict((name, getattr(self, name)) for name in _slot_names(type(self))
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def _slot_names(cls):
+    names = []
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if name not in names:
+                names.append(name)
+    return names
 
 
 class MarketEvent(Event):
@@ -16,11 +44,19 @@ class MarketEvent(Event):
     corresponding bars.
     """
 
-    def __init__(self):
+    type = 'MARKET'
+    __slots__ = ('timestamp', 'bar')
+
+    def __init__(self, timestamp=None, bar=None):
         """
         Initialises the MarketEvent.
+
+        Parameters:
+        timestamp - The time of the update.
+        bar - The new bar.
         """
-        self.type = 'MARKET'
+        self.timestamp = timestamp
+        self.bar = bar
 
 
 class SignalEvent(Event):
@@ -29,6 +65,9 @@ class SignalEvent(Event):
     This is received by a Portfolio object and acted upon.
     """
 
+    type = 'SIGNAL'
+    __slots__ = ('symbol', 'datetime', 'signal_type', 'data')
+
     def __init__(self, symbol, datetime, signal_type, data=None):
         """
         Initialises the SignalEvent.
@@ -39,13 +78,16 @@ class SignalEvent(Event):
         signal_type - 'LONG' or 'SHORT'.
         """
 
-        self.type = 'SIGNAL'
         self.symbol = symbol
         self.datetime = datetime
         self.signal_type = signal_type
         if data is not None:
             self.data = data
 
+    @property
+    def timestamp(self):
+        return self.datetime
+
 
 class OrderEvent(Event):
     """
@@ -54,6 +96,9 @@ class OrderEvent(Event):
     quantity and a direction.
     """
 
+    type = 'ORDER'
+    __slots__ = ('symbol', 'order_type', 'quantity', 'direction')
+
     def __init__(self, symbol, order_type, quantity, direction):
         """
         Initialises the order type, setting whether it is
@@ -68,7 +113,6 @@ class OrderEvent(Event):
         direction - 'BUY' or 'SELL' for long or short.
         """
 
-        self.type = 'ORDER'
         self.symbol = symbol
         self.order_type = order_type
         self.quantity = quantity
@@ -90,6 +134,10 @@ class FillEvent(Event):
     the commission of the trade from the brokerage.
     """
 
+    type = 'FILL'
+    __slots__ = ('timeindex', 'symbol', 'exchange', 'volume', 'side',
+                 'fill_cost', 'commission', 'price')
+
     def __init__(self, timeindex, symbol, exchange, volume,
                  side, fill_cost, price, commission=None):
         """
@@ -111,7 +159,6 @@ class FillEvent(Event):
         commission - An optional commission sent from IB.
         """
 
-        self.type = 'FILL'
         self.timeindex = timeindex
         self.symbol = symbol
         self.exchange = exchange
@@ -121,23 +168,107 @@ class FillEvent(Event):
         self.commission = commission
         self.price = price
 
+    @property
+    def timestamp(self):
+        return self.timeindex
+
     def __str__(self):
         return "Filled Order for Symbol {}; {} {} at price {}".format(self.symbol, self.side, self.volume, self.price)
 
 
 class EventHandler(object):
+    """
+    A single-threaded event loop.
+
+    Events are kept in a heap ordered by timestamp (ties are dispatched in
+    the order they were put) and handed to the handlers registered for
+    their type ('MARKET', 'SIGNAL', 'ORDER', 'FILL', ...). Components put
+    events on it like on a Queue.Queue, but without any locking, and
+    events can be scheduled for later, e.g. to model order latency.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.handlers = {}
+        self.sequence = 0
+        self.now = None
+
+    def register(self, event_type, handler):
+        """
+        Calls handler(event) for every dispatched event of event_type.
+        """
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    def put(self, event, timestamp=None, delay=None):
+        """
+        Schedules an event.
+
+        Parameters:
+        event - the Event.
+        timestamp - when to dispatch it; defaults to the event's own
+                    timestamp, or to the current time of the loop.
+        delay - an optional timedelta added to the timestamp.
+        """
+        if timestamp is None:
+            timestamp = getattr(event, 'timestamp', None)
+        key = self.now if timestamp is None else _to_ns(timestamp)
+        if key is None:
+            key = _EARLIEST
+        if delay is not None:
+            key += _to_ns_delta(delay)
+        heapq.heappush(self.heap, (key, self.sequence, event))
+        self.sequence += 1
+
+    def get(self):
+        """
+        Removes and returns the next event (without dispatching it).
+        """
+        key, _, event = heapq.heappop(self.heap)
+        self.now = key
+        return event
+
+    def empty(self):
+        return not self.heap
+
+    def qsize(self):
+        return len(self.heap)
+
+    def dispatch(self, event):
+        for handler in self.handlers.get(event.type, ()):
+            handler(event)
+
+    def run(self, until=None):
+        """
+        Dispatches events in timestamp order until the heap is empty or
+        the next event is scheduled after `until`. Handlers may put new
+        events, which are dispatched in the same run if they are due.
+        """
+        limit = None if until is None else _to_ns(until)
+        heap = self.heap
+        while heap and (limit is None or heap[0][0] <= limit):
+            key, _, event = heapq.heappop(heap)
+            self.now = key
+            self.dispatch(event)
+        if limit is not None and (self.now is None or self.now < limit):
+            self.now = limit
+
+
+_EARLIEST = -2 ** 63
+
+
+def _to_ns(timestamp):
+    """
+    nanoseconds since the epoch of a datetime, pd.Timestamp or
+    datetime64 (integers are taken to be nanoseconds already)
+    """
+    if isinstance(timestamp, (int, long, np.integer)):
+        return int(timestamp)
+    if isinstance(timestamp, pd.Timestamp):
+        return timestamp.value
+    return pd.Timestamp(timestamp).value
+
 
-    def __init__(self, event_queue):
-        self.event_queue = event_queue
-
-    def update(self, data_stream, signal_collection, strategy, broker, portfolio):
-        if not self.event_queue.empty():
-            event = event.get()
-        if event.type == 'MARKET':
-            signals.update()
-        if event.type == "SIGNAL":
-            strategy.update()
-        if event.type == "ORDER":
-            broker.update()
-        if event.type == "FILL":
-            portfolio.update()
+def _to_ns_delta(delay):
+    if isinstance(delay, (int, long, np.integer)):
+        return int(delay)
+    return pd.Timedelta(delay).value
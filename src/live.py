@@ -0,0 +1,301 @@
+import collections
+import datetime
+import json
+import threading
+import time
+import urllib2
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+
+from data import DataHandler
+from event import MarketEvent
+from quotes import QuoteSnapshot
+from runlog import get_logger
+
+log = get_logger('live')
+
+# put on a stream's inbox to end it
+_STOP = object()
+
+
+class Cadence(object):
+    """
+    Ticks on a fixed schedule start, start + interval, start + 2 interval,
+    ... . wait() sleeps until the next tick, so the time spent between two
+    calls (e.g. on requests) doesn't shift the schedule. Ticks that have
+    already passed completely are skipped (and counted in self.skipped)
+    instead of firing in a burst.
+    """
+
+    def __init__(self, interval, clock=time.time, sleep=time.sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.next_tick = None
+        self.skipped = 0
+
+    def wait(self):
+        """
+        Waits for the next tick and returns its scheduled time.
+        """
+        now = self.clock()
+        if self.next_tick is None:
+            self.next_tick = now
+        elif now < self.next_tick:
+            self.sleep(self.next_tick - now)
+        else:
+            missed = int((now - self.next_tick) // self.interval)
+            self.skipped += missed
+            self.next_tick += missed * self.interval
+        tick = self.next_tick
+        self.next_tick += self.interval
+        return tick
+
+
+class HTTPQuoteClient(object):
+    """
+    A minimal client for the public price endpoints of the Coinbase API
+    (or a stand-in server with the same paths), with the same methods as
+    coinbase.wallet.client.Client uses for quotes:
+
+        GET <base_url>/v2/prices/<pair>/buy  -> {"data": {"amount": ...}}
+        GET <base_url>/v2/prices/<pair>/sell -> {"data": {"amount": ...}}
+        GET <base_url>/v2/time               -> {"data": {"iso": ...}}
+
+    Every call is a separate request, so calls can run in parallel.
+    """
+
+    def __init__(self, base_url='https://api.coinbase.com', timeout=5.):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path):
+        response = urllib2.urlopen(self.base_url + path, timeout=self.timeout)
+        try:
+            return json.load(response)['data']
+        finally:
+            response.close()
+
+    def get_buy_price(self, currency_pair='BTC-USD'):
+        return self._get('/v2/prices/{}/buy'.format(currency_pair))
+
+    def get_sell_price(self, currency_pair='BTC-USD'):
+        return self._get('/v2/prices/{}/sell'.format(currency_pair))
+
+    def get_time(self):
+        return self._get('/v2/time')
+
+
+class CoinbaseQuoteSource(object):
+    """
+    Polls the buy price, sell price and server time of a Coinbase client
+    (coinbase.wallet.client.Client or HTTPQuoteClient) concurrently, so a
+    quote takes one round trip instead of three.
+    """
+
+    def __init__(self, client, currency_pair='BTC-USD', timeout=10.):
+        """
+        Parameters:
+        client - the client.
+        currency_pair - the product to quote.
+        timeout - seconds to wait for all three answers.
+        """
+        self.client = client
+        self.currency_pair = currency_pair
+        self.timeout = timeout
+        self.pool = None
+
+    def fetch(self):
+        """
+        Returns (datetime, bid, ask): the sell price is the bid and the
+        buy price the ask.
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(3)
+        client = self.client
+        calls = [self.pool.apply_async(client.get_buy_price, kwds={'currency_pair': self.currency_pair}),
+                 self.pool.apply_async(client.get_sell_price, kwds={'currency_pair': self.currency_pair}),
+                 self.pool.apply_async(client.get_time)]
+        buy, sell, server_time = [call.get(self.timeout) for call in calls]
+        date_time = datetime.datetime.strptime(server_time['iso'], "%Y-%m-%dT%H:%M:%SZ")
+        return date_time, float(sell['amount']), float(buy['amount'])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+class HTTPStreamFeed(object):
+    """
+    A push feed: reads newline-delimited JSON quotes
+    {"time": <iso datetime>, "bid": ..., "ask": ...} from a streaming
+    HTTP response on a background thread and pushes each one to a stream.
+    """
+
+    def __init__(self, url, timeout=30.):
+        self.url = url
+        self.timeout = timeout
+        self.response = None
+        self.thread = None
+        self.closed = False
+
+    def subscribe(self, push):
+        self.thread = threading.Thread(target=self._read, args=(push,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self, push):
+        try:
+            self.response = urllib2.urlopen(self.url, timeout=self.timeout)
+            for line in iter(self.response.readline, ''):
+                if self.closed:
+                    break
+                if line.strip():
+                    quote = json.loads(line)
+                    push(quote['time'], float(quote['bid']), float(quote['ask']))
+        except Exception as e:
+            if not self.closed:
+                log.warning("feed %s failed: %s", self.url, e)
+        finally:
+            push(None, None, None)
+
+    def close(self):
+        self.closed = True
+        if self.response is not None:
+            self.response.close()
+
+
+class LiveQuoteStream(DataHandler):
+    """
+    Streams live quotes as bars ({'Datetime', 'Bid', 'Ask'}), either by
+    polling a quote source or from a push feed.
+
+    Polling: source.fetch() returns (datetime, bid, ask) and is called on
+    a fixed cadence of `interval` seconds (see Cadence). A failed fetch is
+    logged and the tick skipped.
+
+    Pushing: quotes are handed to push(), from any thread, e.g. by a feed
+    such as HTTPStreamFeed that is subscribed when streaming starts; the
+    stream yields them in arrival order.
+
+    The latest quote is published to self.quotes like in the historic
+    streams, and the last `history` bars are kept for get_latest_bars.
+    """
+
+    def __init__(self, events, source=None, interval=1., feed=None, symbol='BTC', exchange='Coinbase',
+                 history=1000, max_ticks=None):
+        """
+        Parameters:
+        events - The Event Queue.
+        source - a quote source to poll (or None to take pushed quotes).
+        interval - seconds between polls.
+        feed - optional push feed with subscribe(push) and close().
+        symbol, exchange - The instrument the quotes are of.
+        history - the number of recent bars kept.
+        max_ticks - end the stream after this many bars.
+        """
+        self.events = events
+        self.source = source
+        self.cadence = Cadence(interval)
+        self.feed = feed
+        self.symbol = symbol
+        self.exchange = exchange
+        self.max_ticks = max_ticks
+        self.quotes = QuoteSnapshot()
+        self.instrument_id = self.quotes.instrument_id(symbol, exchange)
+        self.recent = collections.deque(maxlen=history)
+        self.inbox = Queue.Queue()
+        self.continue_backtest = True
+        self.ticks = 0
+        self.errors = 0
+        self._streamer = None
+
+    def push(self, timestamp, bid, ask):
+        """
+        Hands a quote to the stream; push(None, None, None) ends it.
+        """
+        self.inbox.put(_STOP if timestamp is None else (timestamp, bid, ask))
+
+    def stop(self):
+        self.continue_backtest = False
+        self.inbox.put(_STOP)
+
+    def _quotes(self):
+        if self.source is not None:
+            while self.continue_backtest:
+                self.cadence.wait()
+                try:
+                    yield self.source.fetch()
+                except Exception as e:
+                    self.errors += 1
+                    log.warning("quote fetch failed: %s", e)
+        else:
+            if self.feed is not None:
+                self.feed.subscribe(self.push)
+            while True:
+                # a timeout keeps the wait interruptible
+                try:
+                    quote = self.inbox.get(timeout=1.)
+                except Queue.Empty:
+                    continue
+                if quote is _STOP:
+                    break
+                yield quote
+
+    def _data_streamer(self):
+        try:
+            for timestamp, bid, ask in self._quotes():
+                timestamp = pd.Timestamp(timestamp)
+                self.quotes.publish(self.instrument_id, bid, ask, timestamp.value)
+                bar = {'Datetime': timestamp, 'Bid': bid, 'Ask': ask}
+                self.recent.append(bar)
+                self.ticks += 1
+                yield bar
+                if self.max_ticks is not None and self.ticks >= self.max_ticks:
+                    break
+        finally:
+            self.continue_backtest = False
+            if self.feed is not None:
+                self.feed.close()
+            if hasattr(self.source, 'close'):
+                self.source.close()
+
+    def get_latest_bars(self, N=1):
+        """
+        Returns the last N bars, or N-k if less available.
+        """
+        return pd.DataFrame(list(self.recent)[-N:], columns=['Datetime', 'Bid', 'Ask'])
+
+    def update_bars(self):
+        """
+        Waits for the next quote and puts a MarketEvent for it.
+        """
+        if self._streamer is None:
+            self._streamer = self._data_streamer()
+        try:
+            bar = next(self._streamer)
+        except StopIteration:
+            self.continue_backtest = False
+            return
+        self.events.put(MarketEvent(bar['Datetime'], bar))
+
+
+class CoinbaseSandboxStream(LiveQuoteStream):
+    """
+    Live BTC prices from the Coinbase API, polled every update_rate
+    seconds with the three requests of a quote made concurrently.
+    """
+
+    def __init__(self, events, update_rate, client, **kwargs):
+        """
+        Parameters:
+        events - The Event Queue.
+        update_rate - The frequency of API calls
+        client - An instance of the coinbase client (or HTTPQuoteClient)
+        """
+        self.client = client
+        super(CoinbaseSandboxStream, self).__init__(events, source=CoinbaseQuoteSource(client),
+                                                    interval=update_rate, **kwargs)
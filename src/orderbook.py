@@ -0,0 +1,187 @@
+import bisect
+
+import numpy as np
+
+from bars import BarStore
+from event import _to_ns
+
+
+BID = 1
+ASK = -1
+
+
+class OrderBook(object):
+    """
+    A level 2 order book: the total size resting at every price level.
+
+    Each side is a dict of price -> size together with a sorted list of its
+    prices (kept sorted with bisect), so changing the size of an existing
+    level is a dict assignment and adding or removing a level is a binary
+    search plus one list insert/delete. The best bid is the last bid
+    price, the best ask the first ask price.
+    """
+
+    def __init__(self):
+        self.bids = {}
+        self.asks = {}
+        self.bid_prices = []
+        self.ask_prices = []
+        self.timestamp = None
+
+    def clear(self):
+        self.bids.clear()
+        self.asks.clear()
+        del self.bid_prices[:]
+        del self.ask_prices[:]
+
+    def update(self, side, price, size):
+        """
+        Sets the size of a price level; a size of 0 removes the level.
+
+        Parameters:
+        side - BID or ASK.
+        price - the price of the level.
+        size - the new total size at that price.
+        """
+        if side > 0:
+            levels, prices = self.bids, self.bid_prices
+        else:
+            levels, prices = self.asks, self.ask_prices
+        if size > 0:
+            if price not in levels:
+                bisect.insort(prices, price)
+            levels[price] = size
+        elif price in levels:
+            del levels[price]
+            del prices[bisect.bisect_left(prices, price)]
+
+    def apply_snapshot(self, bids, asks, timestamp=None):
+        """
+        Replaces the book with a depth snapshot.
+
+        Parameters:
+        bids, asks - iterables of (price, size).
+        """
+        self.clear()
+        for price, size in bids:
+            self.update(BID, price, size)
+        for price, size in asks:
+            self.update(ASK, price, size)
+        self.timestamp = timestamp
+
+    def apply_diff(self, updates, timestamp=None):
+        """
+        Applies depth updates, an iterable of (side, price, size).
+        """
+        update = self.update
+        for side, price, size in updates:
+            update(side, price, size)
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+    @property
+    def best_bid(self):
+        return self.bid_prices[-1] if self.bid_prices else None
+
+    @property
+    def best_ask(self):
+        return self.ask_prices[0] if self.ask_prices else None
+
+    def depth(self, side, levels=10):
+        """
+        The best `levels` (price, size) pairs of a side, best first.
+        """
+        if side > 0:
+            return [(price, self.bids[price]) for price in self.bid_prices[::-1][:levels]]
+        return [(price, self.asks[price]) for price in self.ask_prices[:levels]]
+
+    def walk(self, side, volume, limit=None, consume=False):
+        """
+        Fills an order of `volume` against the book, taking the best
+        levels first: a buy ('B') walks up the asks, a sell ('S') down the
+        bids. Levels priced worse than `limit` are not touched.
+
+        Parameters:
+        side - 'B' or 'S', the side of the order.
+        volume - the volume to fill.
+        limit - an optional limit price.
+        consume - if True, the filled size is taken out of the book.
+
+        Returns (filled volume, total cost); the filled volume is less
+        than `volume` if the book (within the limit) is too thin.
+        """
+        assert(side=='B' or side=='S'), "side must be 'S' or 'B'"
+        if side == 'B':
+            levels, prices, book_side = self.asks, self.ask_prices, ASK
+            ordered = iter(prices)
+        else:
+            levels, prices, book_side = self.bids, self.bid_prices, BID
+            ordered = reversed(prices)
+        filled = 0.
+        cost = 0.
+        touched = []
+        for price in ordered:
+            if filled >= volume:
+                break
+            if limit is not None and (price > limit if side == 'B' else price < limit):
+                break
+            size = min(levels[price], volume - filled)
+            filled += size
+            cost += size * price
+            touched.append((price, levels[price] - size))
+        if consume:
+            for price, left in touched:
+                self.update(book_side, price, left)
+        return filled, cost
+
+
+class BookReplay(object):
+    """
+    Replays recorded depth updates into an OrderBook.
+
+    The updates are kept as columns of a BarStore: Datetime, Side (BID or
+    ASK), Price, Size and optionally Reset, which is 1 on the first row of
+    a full snapshot (the book is cleared before that row is applied).
+    advance_to(timestamp) applies everything up to that time, so the book
+    can be moved forward together with the bars of a backtest.
+    """
+
+    def __init__(self, updates):
+        """
+        Parameters:
+        updates - a BarStore of depth updates, sorted by Datetime.
+        """
+        self.updates = updates
+        self.datetime = updates.datetime
+        self.book = OrderBook()
+        self.position = 0
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(BarStore.from_frame(frame))
+
+    def advance_to(self, timestamp):
+        """
+        Applies all updates at or before timestamp and returns the book.
+        """
+        stop = int(np.searchsorted(self.datetime, _to_ns(timestamp), side='right'))
+        start = self.position
+        if stop > start:
+            data = self.updates.data
+            sides = data['Side'][start:stop].tolist()
+            prices = data['Price'][start:stop].tolist()
+            sizes = data['Size'][start:stop].tolist()
+            book = self.book
+            update = book.update
+            if 'Reset' in data:
+                resets = data['Reset'][start:stop].tolist()
+                for side, price, size, reset in zip(sides, prices, sizes, resets):
+                    if reset:
+                        book.clear()
+                    update(side, price, size)
+            else:
+                for side, price, size in zip(sides, prices, sizes):
+                    update(side, price, size)
+            book.timestamp = self.datetime[stop - 1]
+            self.position = stop
+        return self.book
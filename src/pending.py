@@ -0,0 +1,116 @@
+import heapq
+
+from event import _to_ns
+
+
+class PendingOrders(object):
+    """
+    The resting limit orders of one instrument.
+
+    Buys and sells are kept in one heap per side, ordered by price (best
+    first) and then by arrival, so checking them against a new quote pops
+    only the orders that fill: O(log n) per fill plus a look at the top of
+    each heap. Cancelled and expired orders are only dropped from the live
+    set and are discarded when they reach the top of their heap (the heaps
+    are rebuilt if too many of them pile up). Orders with an expiry time (expires_at)
+    are dropped once it has passed; all others are good till cancelled.
+    """
+
+    def __init__(self):
+        self.buys = []
+        self.sells = []
+        self.expiries = []
+        self.live = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, order_id):
+        return order_id in self.live
+
+    def add(self, order):
+        """
+        Rests a limit order. Sets and returns its order_id.
+        """
+        order_id = self.sequence
+        self.sequence += 1
+        order.order_id = order_id
+        if order.side == 'B':
+            heapq.heappush(self.buys, (-order.price, order_id, order))
+        else:
+            heapq.heappush(self.sells, (order.price, order_id, order))
+        if order.expires_at is not None:
+            heapq.heappush(self.expiries, (_to_ns(order.expires_at), order_id))
+        self.live[order_id] = order
+        return order_id
+
+    def cancel(self, order_id):
+        """
+        Cancels a resting order; returns it (None if it isn't resting).
+        """
+        order = self.live.pop(order_id, None)
+        self._maybe_compact()
+        return order
+
+    def replace(self, order_id, price=None, volume=None):
+        """
+        Changes the price and/or volume of a resting order. The order
+        loses its time priority and gets a new order_id, which is
+        returned. Raises a KeyError if the order isn't resting.
+        """
+        order = self.cancel(order_id)
+        if order is None:
+            raise KeyError("order {} is not resting".format(order_id))
+        if price is not None:
+            order.price = price
+        if volume is not None:
+            order.volume = volume
+        return self.add(order)
+
+    def expire(self, now):
+        """
+        Drops the orders whose expiry time is at or before now.
+        """
+        now = _to_ns(now)
+        expiries = self.expiries
+        if not expiries or expiries[0][0] > now:
+            return
+        while expiries and expiries[0][0] <= now:
+            self.live.pop(heapq.heappop(expiries)[1], None)
+        self._maybe_compact()
+
+    def match(self, bid, ask, now=None):
+        """
+        Removes and returns the orders that fill at the given quote: buys
+        priced at or above the ask and sells at or below the bid, best
+        price first. Expired orders are dropped first if now is given.
+        """
+        if now is not None:
+            self.expire(now)
+        live = self.live
+        filled = []
+        buys = self.buys
+        while buys and -buys[0][0] >= ask:
+            _, order_id, order = heapq.heappop(buys)
+            if live.pop(order_id, None) is not None:
+                filled.append(order)
+        sells = self.sells
+        while sells and sells[0][0] <= bid:
+            _, order_id, order = heapq.heappop(sells)
+            if live.pop(order_id, None) is not None:
+                filled.append(order)
+        return filled
+
+    def _maybe_compact(self):
+        if len(self.buys) + len(self.sells) > 2 * len(self.live) + 64:
+            self._compact()
+
+    def _compact(self):
+        live = self.live
+        self.buys = [entry for entry in self.buys if entry[1] in live]
+        self.sells = [entry for entry in self.sells if entry[1] in live]
+        self.expiries = [entry for entry in self.expiries if entry[1] in live]
+        heapq.heapify(self.buys)
+        heapq.heapify(self.sells)
+        heapq.heapify(self.expiries)
@@ -1,5 +1,9 @@
-import copy
+import numpy as np
+import pandas as pd
 from position import Position
+from runlog import get_logger
+
+log = get_logger('portfolio')
 
 class Portfolio(object):
 
@@ -21,6 +25,16 @@ class Portfolio(object):
         self.realised_pnl = 0
         self.unrealised_pnl = 0
 
+    def _get_bid_ask(self, ticker, exchange):
+        """
+        Returns the current (bid, ask) for a ticker. For price handlers
+        that don't provide ticks both are set to the last close.
+        """
+        if self.price_handler.istick():
+            return self.price_handler.get_bid_ask(ticker, exchange)
+        close_price = self.price_handler.get_last_close(ticker, exchange)
+        return close_price, close_price
+
     def _update_portfolio(self):
         """
         Updates the value of all positions that are currently open.
@@ -29,19 +43,9 @@ class Portfolio(object):
         self.unrealised_pnl = 0
         self.equity = self.realised_pnl
         self.equity += self.init_cash
-        exchange = "TestExchange"
         for ticker in self.positions:
             pt = self.positions[ticker]
-            if self.price_handler.istick():
-                market_price = self.price_handler.get_best_bid_ask(
-                    ticker, exchange)
-                bid = market_price['Bid'].values[0]
-                ask = market_price['Ask'].values[0]
-            else:
-                close_price = self.price_handler.get_last_close(
-                    ticker, exchange)
-                bid = close_price
-                ask = close_price            
+            bid, ask = self._get_bid_ask(ticker, pt.exchange)
             pt.update_market_value(bid, ask)
             self.unrealised_pnl += pt.unrealised_pnl
             pnl_diff = pt.realised_pnl - pt.unrealised_pnl
@@ -59,16 +63,7 @@ class Portfolio(object):
         are updated.
         """
         if fill_event.symbol not in self.positions:
-            if self.price_handler.istick():
-                market_price = self.price_handler.get_best_bid_ask(
-                    fill_event.symbol, fill_event.exchange)
-                bid = market_price['Bid'].values[0]
-                ask = market_price['Ask'].values[0]
-            else:
-                close_price = self.price_handler.get_last_close(
-                    fill_event.symbol, fill_event.exchange)
-                bid = close_price
-                ask = close_price
+            bid, ask = self._get_bid_ask(fill_event.symbol, fill_event.exchange)
             position = Position(symbol=fill_event.symbol, side=fill_event.side,
                                 init_volume=fill_event.volume, exchange=fill_event.exchange,
                                 init_price=fill_event.price, init_commission=fill_event.commission,
@@ -76,28 +71,27 @@ class Portfolio(object):
             self.positions[fill_event.symbol] = position
             self._update_portfolio()
         else:
-            print(
-                "Ticker %s is already in the positions list. "
-                "Could not add a new position." % fill_event.symbol
-            )
+            log.warning("Ticker %s is already in the positions list. "
+                        "Could not add a new position.", fill_event.symbol)
 
-    def _get_closed_and_diff(self, fill_event):
-        """ 
-        gets called if the volume of a fill event closes the active position
-        and converts from buy-side to sell-side (or reversed)
-        """        
-        diff_fill_event = copy.deepcopy(fill_event)
-        closed_fill_event = copy.deepcopy(fill_event)
-        closed_volume = self.positions[fill_event.symbol].volume
-        diff_volume = fill_event.volume - self.positions[fill_event.symbol].volume
-        diff_fill_event.fill_cost = fill_event.fill_cost / float(fill_event.volume) * diff_volume
-        closed_fill_event.fill_cost = fill_event.fill_cost / float(fill_event.volume) * closed_volume
-        closed_fill_event.volume = closed_volume
-        diff_fill_event.volume = diff_volume
-        assert(diff_fill_event.volume>0), 'got a negative volume: {}'.format(diff_fill_event.volume)
-        assert(closed_fill_event.volume>0), 'got a negative volume: {}'.format(closed_fill_event.volume)        
-        return closed_fill_event, diff_fill_event
+    def _split_flip(self, position, fill_event):
+        """
+        Splits a fill into the part that closes the open position and the
+        part that is left over. The left over part is non-zero if the fill
+        is on the other side of the position and larger than it (i.e. it
+        flips the position from long to short or vice versa). Both parts
+        carry the fill's full commission.
 
+        Returns (closing volume, closing commission, opening volume,
+        opening commission).
+        """
+        # net is signed, whereas volume is only negative for short
+        # positions that have been transacted since they were opened
+        open_volume = abs(position.net)
+        if position.side == fill_event.side or fill_event.volume <= open_volume:
+            return fill_event.volume, fill_event.commission, 0, 0
+        return (open_volume, fill_event.commission,
+                fill_event.volume - open_volume, fill_event.commission)
 
     def _modify_position(self, fill_event):
         """
@@ -105,49 +99,37 @@ class Portfolio(object):
         This requires getting the best bid/ask price from the
         price handler in order to calculate a reasonable
         "market value".
+        A fill that flips the position closes it and reopens the same
+        Position on the other side with the remaining volume.
         Once the Position is modified, the Portfolio values
         are updated.
-        """             
-        exchange = 'TestExchange'
-        if fill_event.symbol in self.positions:
-            if (self.positions[fill_event.symbol].volume < fill_event.volume) and (
-                self.positions[fill_event.symbol].side != fill_event.side):
-                fill_event, diff_fill_event = self._get_closed_and_diff(fill_event)
-                self.positions[fill_event.symbol].transact_shares(fill_event)
-                SURPLUS_FLAG = True                
-            else:                
-                self.positions[fill_event.symbol].transact_shares(fill_event)
-                SURPLUS_FLAG = False
-            try:                
-                if self.price_handler.istick():
-                    market_price = self.price_handler.get_best_bid_ask(
-                        fill_event.symbol, exchange)                
-                    bid = market_price['Bid'].values[0]
-                    ask = market_price['Ask'].values[0]
-                else:
-                    close_price = self.price_handler.get_last_close(
-                        fill_event.symbol, exchange)
-                    bid = close_price
-                    ask = close_price            
-                self.positions[fill_event.symbol].update_market_value(bid, ask)
-            
-                if self.positions[fill_event.symbol].volume == 0:
-                    closed = self.positions.pop(fill_event.symbol)                    
-                    self.realised_pnl += closed.realised_pnl
-                    self.closed_positions.append(closed)                
-
-                if SURPLUS_FLAG:                    
-                    self._add_position(diff_fill_event)
-                    self.positions[diff_fill_event.symbol].update_market_value(bid, ask)
+        """
+        exchange = fill_event.exchange
+        symbol = fill_event.symbol
+        if symbol in self.positions:
+            position = self.positions[symbol]
+            volume, commission, opening_volume, opening_commission = \
+                self._split_flip(position, fill_event)
+            position.transact(fill_event.side, volume, fill_event.price, commission)
+            try:
+                bid, ask = self._get_bid_ask(symbol, exchange)
+                position.update_market_value(bid, ask)
+
+                if position.volume == 0:
+                    self.realised_pnl += position.realised_pnl
+                    self.closed_positions.append(position.closed())
+                    if opening_volume:
+                        position.reopen(fill_event.side, opening_volume, fill_event.price,
+                                        opening_commission, bid, ask)
+                    else:
+                        del self.positions[symbol]
 
                 self._update_portfolio()
             except IndexError:
-                print("Market Price for ticker %s is not available." % fill_event.symbol)
+                log.warning("Market Price for ticker %s is not available.", symbol)
         else:
-            print(
-                "Ticker %s not in the current position list. "
-                "Could not modify a current position." % fill_event.symbol
-            )
+            log.warning("Ticker %s not in the current position list. "
+                        "Could not modify a current position.", symbol)
 
     # def transact_position(self, action, ticker,
     #                        volume, price, commission):
@@ -179,3 +161,139 @@ class Portfolio(object):
         for order in executed_order:
             if order is not None:
                 self.transact_position(order)
+
+
+class ArrayPortfolio(object):
+    """
+    A portfolio of positions in any number of instruments, where an
+    instrument is a (symbol, exchange) pair.
+
+    Every instrument gets an integer id and its signed volume, cost basis,
+    last mid price and PnL are kept in NumPy arrays at that index, so that
+    marking all positions to market is a handful of array operations.
+    Positions use average-cost accounting like vectorized.run_vectorized:
+    the cost basis is volume * average entry price, reducing a position
+    realises (price - average price) on the closed volume, a fill that
+    flips the position opens the remainder at the fill price, and
+    commissions are charged to realised PnL.
+    """
+
+    def __init__(self, price_handler, cash, capacity=16):
+        """
+        Parameters:
+        price_handler - the broker, which provides get_bid_ask and
+                        possibly a quote snapshot (broker.quotes).
+        cash - the initial cash.
+        capacity - the number of instruments to allocate room for.
+        """
+        self.price_handler = price_handler
+        self.init_cash = cash
+        self.cur_cash = cash
+        self.equity = cash
+        self.realised_pnl = 0
+        self.unrealised_pnl = 0
+        self.ids = {}
+        self.instruments = []
+        self.volume = np.zeros(capacity)
+        self.cost_basis = np.zeros(capacity)
+        self.mid = np.full(capacity, np.nan)
+        self.realised = np.zeros(capacity)
+        self.unrealised = np.zeros(capacity)
+        self.quote_ids = np.zeros(capacity, dtype=np.intp)
+
+    def instrument_id(self, symbol, exchange):
+        """
+        The id of (symbol, exchange), which is registered if it is new.
+        """
+        key = (symbol, exchange)
+        instrument_id = self.ids.get(key)
+        if instrument_id is None:
+            instrument_id = len(self.instruments)
+            if instrument_id == len(self.volume):
+                self._grow()
+            self.ids[key] = instrument_id
+            self.instruments.append(key)
+            quotes = getattr(self.price_handler, 'quotes', None)
+            if quotes is not None:
+                self.quote_ids[instrument_id] = quotes.instrument_id(symbol, exchange)
+        return instrument_id
+
+    def _grow(self):
+        for name in ['volume', 'cost_basis', 'mid', 'realised', 'unrealised', 'quote_ids']:
+            values = getattr(self, name)
+            grown = np.full(2 * len(values), np.nan if name == 'mid' else 0, dtype=values.dtype)
+            grown[:len(values)] = values
+            setattr(self, name, grown)
+
+    def transact_position(self, fill_event):
+        """
+        Applies a fill to the cash and to the position in its instrument.
+        """
+        idx = self.instrument_id(fill_event.symbol, fill_event.exchange)
+        price = fill_event.price
+        commission = fill_event.commission or 0.
+        volume = fill_event.volume if fill_event.side == 'B' else -fill_event.volume
+        self.cur_cash -= volume * price + commission
+        self.realised[idx] -= commission
+        old = self.volume[idx]
+        new = old + volume
+        if old == 0 or (old > 0) == (volume > 0):
+            self.cost_basis[idx] += volume * price
+        else:
+            avg_price = self.cost_basis[idx] / old
+            closed = min(abs(volume), abs(old))
+            self.realised[idx] += closed * (price - avg_price) * (1 if old > 0 else -1)
+            if abs(volume) <= abs(old):
+                self.cost_basis[idx] = new * avg_price
+            else:
+                self.cost_basis[idx] = new * price
+        self.volume[idx] = new
+
+    def mark_to_market(self):
+        """
+        Revalues all positions at the current mid prices. With a quote
+        snapshot this is a gather from its arrays; otherwise the price
+        handler is asked for the instruments with open positions. The
+        last known mid is kept for instruments without a current quote.
+        """
+        n = len(self.instruments)
+        quotes = getattr(self.price_handler, 'quotes', None)
+        if quotes is not None:
+            ids = self.quote_ids[:n]
+            mid = (quotes.bid[ids] + quotes.ask[ids]) / 2.
+            self.mid[:n] = np.where(np.isnan(mid), self.mid[:n], mid)
+        else:
+            for idx in np.flatnonzero(self.volume[:n]):
+                try:
+                    bid, ask = self.price_handler.get_bid_ask(*self.instruments[idx])
+                except IndexError:
+                    continue
+                self.mid[idx] = (bid + ask) / 2.
+        volume = self.volume[:n]
+        market_value = np.where(volume != 0, volume * self.mid[:n], 0.)
+        self.unrealised[:n] = np.where(volume != 0, market_value - self.cost_basis[:n], 0.)
+        self.unrealised_pnl = float(self.unrealised[:n].sum())
+        self.realised_pnl = float(self.realised[:n].sum())
+        self.equity = self.init_cash + self.realised_pnl + self.unrealised_pnl
+
+    def update(self, executed_order):
+        for order in executed_order:
+            if order is not None:
+                self.transact_position(order)
+        self.mark_to_market()
+
+    def positions_frame(self):
+        """
+        One row per instrument with its volume, cost basis, mid price
+        and PnL.
+        """
+        n = len(self.instruments)
+        return pd.DataFrame({'Symbol': [symbol for symbol, _ in self.instruments],
+                             'Exchange': [exchange for _, exchange in self.instruments],
+                             'Volume': self.volume[:n],
+                             'Cost Basis': self.cost_basis[:n],
+                             'Mid': self.mid[:n],
+                             'Realised_PnL': self.realised[:n],
+                             'Unrealised_PnL': self.unrealised[:n]},
+                            columns=['Symbol', 'Exchange', 'Volume', 'Cost Basis', 'Mid',
+                                     'Realised_PnL', 'Unrealised_PnL'])
@@ -1,3 +1,11 @@
+from collections import namedtuple
+
+
+# what is kept of a position once it is closed
+ClosedPosition = namedtuple('ClosedPosition', ['symbol', 'exchange', 'side', 'buys', 'sells', 'avg_bot',
+                                               'avg_sld', 'total_commission', 'realised_pnl'])
+
+
 class Position(object):
 
     def __init__(self, symbol, side, init_volume, exchange,
@@ -10,12 +18,19 @@ class Position(object):
         Then calculate the initial values and finally update the
         market value of the transaction.
         """
-        self.side = side
         self.symbol = symbol
+        self.exchange = exchange
+        self.reopen(side, init_volume, init_price, init_commission, bid, ask)
+
+    def reopen(self, side, init_volume, init_price, init_commission, bid, ask):
+        """
+        Resets the account of the Position to a new initial
+        purchase/sale, e.g. when a fill flips it to the other side.
+        """
+        self.side = side
         self.volume = init_volume
         self.init_price = init_price
         self.init_commission = init_commission
-        self.exchange = exchange
 
         self.realised_pnl = 0
         self.unrealised_pnl = 0
@@ -58,6 +73,13 @@ class Position(object):
         self.net_total = self.total_sld - self.total_bot
         self.net_incl_comm = self.net_total - self.init_commission
 
+    def closed(self):
+        """
+        The ClosedPosition record of this (closed) position.
+        """
+        return ClosedPosition(self.symbol, self.exchange, self.side, self.buys, self.sells, self.avg_bot,
+                              self.avg_sld, self.total_commission, self.realised_pnl)
+
     def update_market_value(self, bid, ask):
         """
         The market value is tricky to calculate as we only have
@@ -84,28 +106,37 @@ class Position(object):
         bought/sold, the cost basis and PnL calculations,
         as carried out through Interactive Brokers TWS.
         """
-        self.total_commission += fill_event.commission
+        self.transact(fill_event.side, fill_event.volume,
+                      fill_event.price, fill_event.commission)
+
+    def transact(self, side, volume, price, commission):
+        """
+        transact_shares for a fill given as plain values, so that
+        part of a fill can be applied without building a FillEvent
+        for it.
+        """
+        self.total_commission += commission
 
         # Adjust total bought and sold
-        if fill_event.side == "B":
-            self.avg_bot = (self.avg_bot * self.buys + fill_event.price * fill_event.volume) \
-                // (self.buys + fill_event.volume)
+        if side == "B":
+            self.avg_bot = (self.avg_bot * self.buys + price * volume) \
+                // (self.buys + volume)
             if self.side != "S":
                 self.avg_price = (self.avg_price * self.buys +
-                                  fill_event.price * fill_event.volume + fill_event.commission)\
-                    // (self.buys + fill_event.volume)
-            self.buys += fill_event.volume
+                                  price * volume + commission)\
+                    // (self.buys + volume)
+            self.buys += volume
             self.total_bot = self.buys * self.avg_bot
 
         # action == "SLD"
         else:
-            self.avg_sld = (self.avg_sld * self.sells + fill_event.price * fill_event.volume) \
-                // (self.sells + fill_event.volume)
+            self.avg_sld = (self.avg_sld * self.sells + price * volume) \
+                // (self.sells + volume)
             if self.side != "B":
                 self.avg_price = (self.avg_price * self.sells +
-                                  fill_event.price * fill_event.volume - fill_event.commission) \
-                    // (self.sells + fill_event.volume)
-            self.sells += fill_event.volume
+                                  price * volume - commission) \
+                    // (self.sells + volume)
+            self.sells += volume
             self.total_sld = self.sells * self.avg_sld
 
         # Adjust net values, including commissions
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class QuoteSnapshot(object):
+    """
+    The current best bid and ask of every instrument.
+
+    Data streams publish into it once per bar and the broker and portfolio
+    read scalar quotes from it, instead of each of them slicing the latest
+    bars again. Instruments are identified by (symbol, exchange) and get an
+    integer id, which indexes the bid and ask arrays; readers that look up
+    the same instrument over and over can keep the id.
+    """
+
+    def __init__(self, capacity=4):
+        self.ids = {}
+        self.instruments = []
+        self.bid = np.full(capacity, np.nan)
+        self.ask = np.full(capacity, np.nan)
+        self.timestamp = None
+
+    def __len__(self):
+        return len(self.instruments)
+
+    def __contains__(self, instrument):
+        return instrument in self.ids
+
+    def instrument_id(self, symbol, exchange):
+        """
+        The id of (symbol, exchange), which is registered if it is new.
+        """
+        key = (symbol, exchange)
+        instrument_id = self.ids.get(key)
+        if instrument_id is None:
+            instrument_id = len(self.instruments)
+            if instrument_id == len(self.bid):
+                self.bid = np.concatenate([self.bid, np.full(len(self.bid), np.nan)])
+                self.ask = np.concatenate([self.ask, np.full(len(self.ask), np.nan)])
+            self.ids[key] = instrument_id
+            self.instruments.append(key)
+        return instrument_id
+
+    def publish(self, instrument_id, bid, ask, timestamp=None):
+        """
+        Sets the quote of an instrument (by id).
+        """
+        self.bid[instrument_id] = bid
+        self.ask[instrument_id] = ask
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+    def update(self, symbol, exchange, bid, ask, timestamp=None):
+        self.publish(self.instrument_id(symbol, exchange), bid, ask, timestamp)
+
+    def bid_ask(self, symbol, exchange):
+        """
+        Returns the current (bid, ask) of an instrument. Raises an
+        IndexError if there is no quote for it yet, like reading the
+        latest bar of a stream that hasn't started.
+        """
+        instrument_id = self.ids.get((symbol, exchange))
+        if instrument_id is None or self.bid[instrument_id] != self.bid[instrument_id]:
+            raise IndexError("no quote for {} on {}".format(symbol, exchange))
+        return self.bid[instrument_id], self.ask[instrument_id]
@@ -0,0 +1,341 @@
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from event import _to_ns
+from tradelog import TradeLog
+
+
+FORMAT = 'backtest-results'
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+INSTRUMENTS_FILE = 'instruments.json'
+PNL_COLUMNS = [('Datetime', np.int64), ('Realised_PnL', np.float64), ('Unrealised_PnL', np.float64)]
+
+
+# On-disk format (version 1): a directory with one subdirectory per table
+# ('pnl', 'fills', 'bars', ...) holding one .npy file per column, and a
+# manifest.json listing the tables with their columns, dtypes and lengths
+# plus the (symbol, exchange) instruments the fills' Instrument ids refer
+# to. Every table has an int64 'Datetime' column (nanoseconds) in time
+# order. The manifest is written last, so a directory without one is
+# either still being written or the chunks of a run that was killed.
+
+
+class ResultsWriter(object):
+    """
+    Writes the results of a run to disk while it is running.
+
+    PnL snapshots (one per bar) and fills are collected in fixed-size
+    columnar buffers; whenever a buffer is full it is written out as a
+    chunk, i.e. a directory <table>/<chunk number>/ with one .npy file
+    per column, and then reused. Chunks are written under a temporary
+    name and renamed into place, so a chunk on disk is always complete,
+    and memory use doesn't grow with the length of the run.
+
+    close() joins the chunks of every table into single column files and
+    writes the manifest (see ResultsReader). read_results also reads the
+    chunks of a run that never got to close().
+    """
+
+    def __init__(self, directory, chunk_size=65536):
+        """
+        Parameters:
+        directory - where to write the results (created if needed).
+        chunk_size - number of rows per chunk.
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        for table in ['pnl', 'fills']:
+            path = os.path.join(directory, table)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.pnl = dict((name, np.zeros(chunk_size, dtype=dtype)) for name, dtype in PNL_COLUMNS)
+        self.pnl_count = 0
+        self.fills = TradeLog(chunk_size)
+        self.chunks = {'pnl': 0, 'fills': 0}
+        self.tables = {}
+        self.closed = False
+
+    def append_pnl(self, timestamp, realised, unrealised):
+        idx = self.pnl_count
+        self.pnl['Datetime'][idx] = _to_ns(timestamp)
+        self.pnl['Realised_PnL'][idx] = realised
+        self.pnl['Unrealised_PnL'][idx] = unrealised
+        self.pnl_count += 1
+        if self.pnl_count == self.chunk_size:
+            self._flush_pnl()
+
+    def append_fill(self, fill):
+        self.fills.append(fill)
+        if len(self.fills) == self.chunk_size:
+            self._flush_fills()
+
+    def write_table(self, table, columns):
+        """
+        Writes a whole table at once, e.g. the bars of the run.
+
+        Parameters:
+        table - the table name.
+        columns - list of (name, array) pairs, including 'Datetime'.
+        """
+        self.tables[table] = _write_columns(os.path.join(self.directory, table), columns)
+
+    def flush(self):
+        """
+        Writes out whatever is buffered.
+        """
+        self._flush_pnl()
+        self._flush_fills()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        for table, columns in [('pnl', PNL_COLUMNS), ('fills', TradeLog.COLUMNS)]:
+            self.tables[table] = _join_chunks(os.path.join(self.directory, table), columns)
+        _write_json(os.path.join(self.directory, MANIFEST_FILE),
+                    {'format': FORMAT, 'version': FORMAT_VERSION, 'tables': self.tables,
+                     'instruments': [list(instrument) for instrument in self.fills.instruments]})
+        for table in ['pnl', 'fills']:
+            for chunk in _chunk_names(os.path.join(self.directory, table)):
+                shutil.rmtree(os.path.join(self.directory, table, chunk))
+        self.closed = True
+
+    def _flush_pnl(self):
+        if self.pnl_count:
+            self._write_chunk('pnl', [(name, self.pnl[name][:self.pnl_count]) for name, _ in PNL_COLUMNS])
+            self.pnl_count = 0
+
+    def _flush_fills(self):
+        if len(self.fills):
+            self._write_chunk('fills', [(name, self.fills.column(name)) for name, _ in TradeLog.COLUMNS])
+            _write_json(os.path.join(self.directory, INSTRUMENTS_FILE),
+                        [list(instrument) for instrument in self.fills.instruments])
+            self.fills.clear()
+
+    def _write_chunk(self, table, columns):
+        path = os.path.join(self.directory, table, '{:06d}'.format(self.chunks[table]))
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        _write_columns(tmp_path, columns)
+        os.rename(tmp_path, path)
+        self.chunks[table] += 1
+
+
+def write_results(directory, tables, instruments=()):
+    """
+    Writes complete tables in the results format. The tables are written
+    to a temporary directory next to `directory` and renamed into place,
+    so readers never see a half written directory.
+
+    Parameters:
+    directory - the results directory. An existing directory is only
+                replaced if it is empty or holds results (a results
+                manifest); anything else raises a ValueError.
+    tables - dict of table name -> list of (column name, array) pairs.
+    instruments - the (symbol, exchange) pairs of the fills' Instrument ids.
+    """
+    directory = os.path.abspath(directory)
+    replace = os.path.isdir(directory) and bool(os.listdir(directory))
+    if os.path.exists(directory) and not os.path.isdir(directory) or replace and not _is_results(directory):
+        raise ValueError("{} exists and does not hold backtest results, "
+                         "not replacing it".format(directory))
+    parent = os.path.dirname(directory)
+    tmp_path = tempfile.mkdtemp(prefix='.results-', suffix='.tmp', dir=parent)
+    try:
+        manifest = {'format': FORMAT, 'version': FORMAT_VERSION, 'tables': {},
+                    'instruments': [list(instrument) for instrument in instruments]}
+        for table, columns in tables.items():
+            manifest['tables'][table] = _write_columns(os.path.join(tmp_path, table), columns)
+        _write_json(os.path.join(tmp_path, MANIFEST_FILE), manifest)
+        if replace:
+            # a directory can only be renamed over an empty one, so the old
+            # results are moved aside first and removed once replaced
+            old_path = tempfile.mkdtemp(prefix='.results-', suffix='.old', dir=parent)
+            os.rename(directory, os.path.join(old_path, 'results'))
+            os.rename(tmp_path, directory)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, directory)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def _is_results(directory):
+    """
+    Whether directory holds a results manifest written by this module.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as fp:
+            return json.load(fp).get('format') == FORMAT
+    except (IOError, ValueError, AttributeError):
+        return False
+
+
+class ResultsReader(object):
+    """
+    Reads results written by ResultsWriter / write_results.
+
+    Columns are memory-mapped read-only, so reading a few columns of a
+    time range only touches those pages on disk:
+
+        reader = ResultsReader(path)
+        equity = reader.table('pnl', ['Realised_PnL'], start='2017-03-01', end='2017-04-01')
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(directory, MANIFEST_FILE)) as fp:
+            self.manifest = json.load(fp)
+        if self.manifest.get('format') != FORMAT:
+            raise ValueError("{} does not hold backtest results".format(directory))
+        if self.manifest['version'] > FORMAT_VERSION:
+            raise ValueError("results format version {} is newer than the supported version {}".format(
+                self.manifest['version'], FORMAT_VERSION))
+        self.instruments = [tuple(instrument) for instrument in self.manifest.get('instruments', [])]
+
+    @property
+    def tables(self):
+        return sorted(self.manifest['tables'])
+
+    def columns(self, table):
+        return [str(name) for name, _ in self.manifest['tables'][table]['columns']]
+
+    def _load(self, table, name):
+        # empty files can't be memory-mapped
+        mmap_mode = self.mmap_mode if self.manifest['tables'][table]['length'] else None
+        return np.load(os.path.join(self.directory, table, name + '.npy'), mmap_mode=mmap_mode)
+
+    def rows(self, table, start=None, end=None):
+        """
+        The row range [first, last) of a table with start <= Datetime <= end.
+        """
+        length = self.manifest['tables'][table]['length']
+        if start is None and end is None:
+            return 0, length
+        datetimes = self._load(table, 'Datetime')
+        first = 0 if start is None else int(np.searchsorted(datetimes, _to_ns(start), side='left'))
+        last = length if end is None else int(np.searchsorted(datetimes, _to_ns(end), side='right'))
+        return first, max(first, last)
+
+    def column(self, table, name, start=None, end=None):
+        """
+        A memory-mapped column, restricted to the time range [start, end].
+        """
+        first, last = self.rows(table, start, end)
+        return self._load(table, name)[first:last]
+
+    def table(self, table, columns=None, start=None, end=None):
+        """
+        A DataFrame of the selected columns (all by default) of a time
+        range. Datetime is converted to datetime64 and, for the fills, the
+        Side and Instrument codes are spelled out as in TradeLog.to_frame.
+        """
+        if columns is None:
+            columns = self.columns(table)
+        first, last = self.rows(table, start, end)
+        data = dict((name, self._load(table, name)[first:last]) for name in columns)
+        if 'Datetime' in data:
+            data['Datetime'] = data['Datetime'].view('M8[ns]')
+        if table == 'fills':
+            if 'Side' in data:
+                data['Side'] = np.where(data['Side'] > 0, 'B', 'S')
+            if 'Instrument' in data:
+                codes = data.pop('Instrument')
+                data['Symbol'] = np.array([symbol for symbol, _ in self.instruments] or [''],
+                                          dtype=object)[codes]
+                data['Exchange'] = np.array([exchange for _, exchange in self.instruments] or [''],
+                                            dtype=object)[codes]
+                columns = [c for c in columns if c != 'Instrument']
+                columns = columns[:1] + ['Symbol', 'Exchange'] + columns[1:]
+        return pd.DataFrame(data, columns=columns)
+
+
+def read_results(directory):
+    """
+    Reads a results directory into DataFrames, one per table (pnl, fills,
+    and bars if they were saved). Also works on the chunks left behind by
+    a run that was killed before the writer was closed; incomplete chunks
+    are skipped.
+    """
+    if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        reader = ResultsReader(directory)
+        return dict((table, reader.table(table)) for table in reader.tables)
+    pnl = _read_chunks(os.path.join(directory, 'pnl'), PNL_COLUMNS)
+    pnl['Datetime'] = pnl['Datetime'].view('M8[ns]')
+    instruments = []
+    instruments_path = os.path.join(directory, INSTRUMENTS_FILE)
+    if os.path.exists(instruments_path):
+        with open(instruments_path) as fp:
+            instruments = json.load(fp)
+    fills = TradeLog.from_columns(_read_chunks(os.path.join(directory, 'fills'), TradeLog.COLUMNS),
+                                  instruments)
+    return {'pnl': pd.DataFrame(pnl, columns=[name for name, _ in PNL_COLUMNS]),
+            'fills': fills.to_frame()}
+
+
+def _write_columns(path, columns):
+    """
+    Writes (name, array) columns as <path>/<name>.npy and returns their
+    manifest entry.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, values in columns:
+        np.save(os.path.join(path, name + '.npy'), values)
+    lengths = set(len(values) for _, values in columns)
+    assert(len(lengths) <= 1), "all columns must have the same length"
+    return {'columns': [[name, np.asarray(values).dtype.str] for name, values in columns],
+            'length': lengths.pop() if lengths else 0}
+
+
+def _chunk_names(path):
+    return sorted(name for name in os.listdir(path) if name.isdigit())
+
+
+def _join_chunks(path, columns):
+    """
+    Joins the chunk directories under path into one .npy per column,
+    copying chunk by chunk into memory-mapped output files.
+    """
+    chunks = _chunk_names(path)
+    lengths = [len(np.load(os.path.join(path, chunk, columns[0][0] + '.npy'), mmap_mode='r'))
+               for chunk in chunks]
+    total = sum(lengths)
+    for name, dtype in columns:
+        filename = os.path.join(path, name + '.npy')
+        if total == 0:
+            np.save(filename, np.zeros(0, dtype=dtype))
+            continue
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(total,))
+        offset = 0
+        for chunk, length in zip(chunks, lengths):
+            out[offset:offset + length] = np.load(os.path.join(path, chunk, name + '.npy'), mmap_mode='r')
+            offset += length
+        out.flush()
+        del out
+    return {'columns': [[name, np.dtype(dtype).str] for name, dtype in columns], 'length': total}
+
+
+def _read_chunks(path, columns):
+    chunks = _chunk_names(path)
+    return dict((name, np.concatenate([np.zeros(0, dtype=dtype)] +
+                                      [np.load(os.path.join(path, chunk, name + '.npy'))
+                                       for chunk in chunks]))
+                for name, dtype in columns)
+
+
+def _write_json(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp)
+    os.rename(tmp_path, path)
@@ -0,0 +1,142 @@
+import collections
+import logging
+import time
+
+
+# the components log to children of this logger ('backtester.portfolio',
+# ...); nothing is printed unless the application configures logging
+LOGGER_NAME = 'backtester'
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+def get_logger(component):
+    return logging.getLogger('{}.{}'.format(LOGGER_NAME, component))
+
+
+class Sampler(object):
+    """
+    Decides when a periodic message is due: on every `every`-th call
+    and/or once `interval` seconds (wall time) have passed since the last
+    one. Without either it is never due.
+    """
+
+    def __init__(self, every=None, interval=None):
+        self.every = every
+        self.interval = interval
+        self.count = 0
+        self.last = time.time()
+
+    def due(self):
+        self.count += 1
+        if self.every is not None and self.count % self.every == 0:
+            self.last = time.time()
+            return True
+        if self.interval is not None:
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                return True
+        return False
+
+
+class RunLog(object):
+    """
+    The log of a simulation run.
+
+    Every event is kept, unformatted, in a ring buffer of the most recent
+    `capacity` events, which costs a deque append. Only events at or above
+    `level` are passed on to the 'backtester.<name>' logger. The recent
+    events are dumped to the logger when the run fails (dump()), so the
+    context of an error is available without logging every bar.
+    Warnings that the other components log through the 'backtester'
+    loggers are added to the ring buffer as well while attach()ed.
+
+    Progress (bars per second) is logged at INFO when the progress
+    sampler is due: every `progress_every` bars and/or every
+    `progress_interval` seconds. By default nothing is logged per bar.
+    """
+
+    def __init__(self, name='simulator', level=logging.WARNING, capacity=1000,
+                 progress_every=None, progress_interval=None):
+        """
+        Parameters:
+        name - the component name; events go to 'backtester.<name>'.
+        level - the lowest level passed on to the logger.
+        capacity - the number of recent events kept.
+        progress_every, progress_interval - when to log progress.
+        """
+        self.logger = get_logger(name)
+        self.level = level
+        self.recent = collections.deque(maxlen=capacity)
+        self.progress = Sampler(progress_every, progress_interval)
+        self.bars = 0
+        self.started = time.time()
+        self._handler = None
+
+    def log(self, level, msg, *args):
+        self.recent.append((level, msg, args))
+        if level >= self.level:
+            self.logger.log(level, msg, *args, extra={'recorded': True})
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def bar(self, timestamp):
+        """
+        Counts a bar and logs the progress if it is due.
+        """
+        self.bars += 1
+        if self.progress.due():
+            elapsed = time.time() - self.started
+            self.logger.info("%d bars (at %s), %.0f bars/s", self.bars, timestamp,
+                             self.bars / elapsed if elapsed > 0 else float('inf'))
+
+    def attach(self):
+        """
+        Starts recording the events of the other 'backtester' loggers.
+        """
+        if self._handler is None:
+            self._handler = _RecentHandler(self.recent)
+            logging.getLogger(LOGGER_NAME).addHandler(self._handler)
+        self.bars = 0
+        self.started = time.time()
+
+    def detach(self):
+        if self._handler is not None:
+            logging.getLogger(LOGGER_NAME).removeHandler(self._handler)
+            self._handler = None
+
+    def format_recent(self):
+        return ["{} {}".format(logging.getLevelName(level), msg % args if args else msg)
+                for level, msg, args in self.recent]
+
+    def dump(self, level=logging.ERROR):
+        """
+        Logs the recent events (oldest first) at `level`.
+        """
+        lines = self.format_recent()
+        self.logger.log(level, "last %d events:\n%s", len(lines), "\n".join(lines),
+                        extra={'recorded': True})
+
+
+class _RecentHandler(logging.Handler):
+    """
+    Adds records from other loggers to a RunLog's ring buffer.
+    """
+
+    def __init__(self, recent):
+        logging.Handler.__init__(self)
+        self.recent = recent
+
+    def emit(self, record):
+        if not getattr(record, 'recorded', False):
+            self.recent.append((record.levelno, "%s: %s", (record.name, record.getMessage())))
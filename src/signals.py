@@ -1,9 +1,11 @@
 import datetime
+import math
 import os
 import os.path
 import pandas as pd
 
 from abc import ABCMeta, abstractmethod
+from collections import deque
 
 from event import MarketEvent
 
@@ -12,28 +14,230 @@ import warnings
 import numpy as np
 
 from event import SignalEvent
+from bars import Bar
 from datetime import datetime
 
 
 class SignalCollector(object):
     """
     this is a collection of signals
+
+    The collector owns one PriceBuffer. Every bar is appended to it once
+    and all buffered signals read their history from it, so adding more
+    indicators doesn't add more copies of the price history.
+
+    In precompute mode (for historical runs) every signal that implements
+    compute_all() is evaluated over the whole BarStore in one vectorized
+    pass before the run; update() then only moves a cursor and
+    get_signals() reads the precomputed values at that cursor.
     """
-    def __init__(self, signals):
-        self.signals = signals        
+    def __init__(self, signals, buffer_capacity=1024, precompute=False, cache=None):
+        """
+        signals - dict of name -> SignalGenerator.
+        buffer_capacity - initial number of bars the shared buffer holds.
+        precompute - evaluate compute_all() over the whole history when
+                     the Simulator starts.
+        cache - optional dict to keep precomputed values in, keyed by
+                SignalGenerator.cache_key(). Collectors that run over the
+                same bars can share one cache to compute each signal once.
+        """
+        self.signals = signals
+        self.precompute = precompute
+        self.cache = cache
+        self.buffer = PriceBuffer(buffer_capacity)
+        for signal in self.signals.values():
+            if isinstance(signal, BufferedSignal):
+                signal.attach(self.buffer)
+        self.incremental = list(self.signals.values())
+        self.precomputed = {}
+        self.precomputed_bars = None
+        self.precomputed_datetime = None
+        self.cursor = -1
 
-    def update(self,bars):
+    def precompute_all(self, bars, lookahead_check=True):
+        """
+        Evaluates compute_all() of every signal that supports it over
+        a whole BarStore. Signals without compute_all keep being updated
+        bar by bar.
+
+        With lookahead_check the signals are also evaluated on the first
+        half of the bars, which has to give the same values as the full
+        pass; a signal that peeks at future bars raises a ValueError.
+        """
+        self.precomputed = {}
+        self.incremental = []
+        for signal in self.signals.values():
+            key = signal.cache_key() if self.cache is not None else None
+            if key is not None and key in self.cache:
+                self.precomputed.update(self.cache[key])
+                continue
+            values = signal.compute_all(bars)
+            if values is None:
+                self.incremental.append(signal)
+                continue
+            if lookahead_check and len(bars) > 1:
+                _check_lookahead(signal, bars, values)
+            if key is not None:
+                self.cache[key] = values
+            self.precomputed.update(values)
+        # precomputed signals don't read the buffer any more, so they must
+        # not keep it from overwriting old rows
         for signal in self.signals.values():
-            signal.update(bars)
+            if isinstance(signal, BufferedSignal) and signal not in self.incremental:
+                self.buffer.unregister(signal)
+        self.precomputed_bars = bars
+        self.precomputed_datetime = bars.datetime
+        self.cursor = -1
+
+    def set_timer(self, timer):
+        """
+        Times the per-bar update of every signal as stage 'signal <name>'
+        of a timing.Timer; set_timer(None) removes the timing again.
+        """
+        for name, signal in self.signals.items():
+            method = 'on_bar' if isinstance(signal, BufferedSignal) else 'update'
+            # the timed method shadows the class's on the instance
+            if method in vars(signal):
+                delattr(signal, method)
+            if timer is not None:
+                setattr(signal, method, timer.wrap('signal ' + name, getattr(signal, method)))
+
+    def _precomputed_row(self, bar):
+        """
+        The row of the precomputed bars a stream starts at. Bars of the
+        precomputed store carry their row; other bars are looked up by
+        datetime, and among rows with the same datetime by their quotes.
+        """
+        if isinstance(bar, Bar) and bar.store is self.precomputed_bars:
+            return bar.index
+        dt = _datetime_ns(bar)
+        first = np.searchsorted(self.precomputed_datetime, dt, side='left')
+        last = np.searchsorted(self.precomputed_datetime, dt, side='right')
+        if last - first > 1:
+            data = self.precomputed_bars.data
+            for row in xrange(first, last):
+                if data['Bid'][row] == bar['Bid'] and data['Ask'][row] == bar['Ask']:
+                    return row
+        return first
+
+    def update(self,bars):
+        if self.precomputed_datetime is not None:
+            if self.cursor < 0:
+                # the stream may start anywhere in the precomputed history
+                self.cursor = self._precomputed_row(bars)
+            else:
+                self.cursor += 1
+            if isinstance(bars, Bar) and bars.store is self.precomputed_bars:
+                in_order = bars.index == self.cursor
+            else:
+                in_order = (self.cursor < len(self.precomputed_datetime) and
+                            self.precomputed_datetime[self.cursor] == _datetime_ns(bars))
+            if not in_order:
+                raise ValueError("bar at {} is not the next precomputed bar".format(
+                    bars['Datetime']))
+        if not self.incremental:
+            return
+        self.buffer.append(bars)
+        for signal in self.incremental:
+            if isinstance(signal, BufferedSignal):
+                signal.on_bar(self.buffer)
+            else:
+                signal.update(bars)
 
     def get_signals(self):
         signal_values = dict([signal_name,None] for signal_name in self.signals.keys())
-        for signal in self.signals.values():  
-            tmp_dict = signal.get_values()
-            signal_values[tmp_dict.keys()[0]] = tmp_dict.values()[0]
+        for signal in self.incremental:
+            signal_values.update(signal.get_values())
+        if self.precomputed:
+            assert(self.cursor >= 0), "get_signals() called before the first bar"
+            for name, values in self.precomputed.items():
+                value = values[self.cursor]
+                signal_values[name] = None if value != value else value
         return signal_values
 
 
+def _check_lookahead(signal, bars, values):
+    """
+    Values computed on a prefix of the bars must match the full pass.
+    """
+    cut = len(bars) // 2
+    prefix = bars.slice(0, cut)
+    prefix_values = signal.compute_all(prefix)
+    for name, full in values.items():
+        if not np.allclose(prefix_values[name], full[:cut], rtol=1e-9, atol=1e-9, equal_nan=True):
+            raise ValueError("signal '{}' uses data from future bars".format(name))
+
+
+class PriceBuffer(object):
+    """
+    A preallocated ring buffer holding the bar history (datetime, bid, ask,
+    mid price and volume) that buffered signals read from.
+
+    Rows are addressed by their sequence number, i.e. the number of bars
+    appended before them. Before a row gets overwritten the buffer asks its
+    consumers for the oldest row they still need and doubles its capacity
+    if that row would be lost.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.datetime = np.zeros(capacity, dtype=np.int64)
+        self.bid = np.zeros(capacity)
+        self.ask = np.zeros(capacity)
+        self.mid = np.zeros(capacity)
+        self.volume = np.zeros(capacity)
+        self.count = 0
+        self.consumers = []
+
+    def register(self, consumer):
+        self.consumers.append(consumer)
+
+    def unregister(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+
+    def append(self, bar):
+        """
+        Bars without a 'Volume' entry are recorded with unit volume.
+        """
+        count = self.count
+        if count >= self.capacity:
+            oldest = min([c.oldest_needed() for c in self.consumers] or [count])
+            if oldest <= count - self.capacity:
+                self._grow()
+        idx = count % self.capacity
+        self.datetime[idx] = _datetime_ns(bar)
+        self.bid[idx] = bar['Bid']
+        self.ask[idx] = bar['Ask']
+        self.mid[idx] = (bar['Bid'] + bar['Ask']) / 2.
+        volume = bar.get('Volume')
+        self.volume[idx] = 1. if volume is None else volume
+        self.count = count + 1
+
+    def _grow(self):
+        old_capacity = self.capacity
+        self.capacity = 2 * old_capacity
+        seqs = np.arange(max(self.count - old_capacity, 0), self.count)
+        for name in ['datetime', 'bid', 'ask', 'mid', 'volume']:
+            old = getattr(self, name)
+            new = np.zeros(self.capacity, dtype=old.dtype)
+            new[seqs % self.capacity] = old[seqs % old_capacity]
+            setattr(self, name, new)
+
+    def column(self, name, start, stop):
+        """
+        Returns the rows [start, stop) of a column (a copy if the range
+        wraps around the end of the ring).
+        """
+        assert(stop - start <= self.capacity and stop <= self.count), \
+            "rows {}-{} are not in the buffer".format(start, stop)
+        values = getattr(self, name)
+        first, last = start % self.capacity, stop % self.capacity
+        if first < last or start == stop:
+            return values[first:first + stop - start]
+        return np.concatenate([values[first:], values[:last]])
+
+
 class SignalGenerator(object):
     """
     the base class for all signals
@@ -46,32 +250,413 @@ class SignalGenerator(object):
     def get_values(self):
         raise NotImplementedError("get_values() not implemented")        
 
+    def compute_all(self, bars):
+        """
+        Optionally computes the signal for every bar of a BarStore in one
+        vectorized pass. Returns a dict mapping the names returned by
+        get_values() to arrays aligned with the bars (NaN where
+        get_values() would give None), or None if not supported.
+        """
+        return None
+
+    def cache_key(self):
+        """
+        A hashable key identifying the signal's parameters, under which
+        its precomputed values can be cached (None disables caching).
+        """
+        return None
+
+
+class BufferedSignal(SignalGenerator):
+    """
+    Base class for incremental signals that read their history from a
+    PriceBuffer. Inside a SignalCollector the buffer is shared; a signal
+    that is updated on its own creates a private buffer.
+    """
+
+    buffer = None
+    owns_buffer = False
+
+    def attach(self, buffer):
+        self.buffer = buffer
+        buffer.register(self)
+
+    def update(self, bar):
+        if self.buffer is None:
+            self.attach(PriceBuffer())
+            self.owns_buffer = True
+        if self.owns_buffer:
+            self.buffer.append(bar)
+        self.on_bar(self.buffer)
+
+    def on_bar(self, buffer):
+        """
+        Called after the latest bar (row buffer.count - 1) was appended.
+        """
+        raise NotImplementedError("on_bar() not implemented")
+
+    def oldest_needed(self):
+        """
+        The oldest row that must survive the next append.
+        """
+        return self.buffer.count - 1
+
+
+class RollingWindow(BufferedSignal):
+    """
+    Base class for signals over the last `window` bars. Keeps a running
+    count, mean and sum of squared deviations (Welford's method) of the
+    mid price.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.updates = 0
+
+    def on_bar(self, buffer):
+        newest = buffer.count - 1
+        x = buffer.mid[newest % buffer.capacity]
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.n > self.window:
+            y = buffer.mid[(newest - self.window) % buffer.capacity]
+            self.n -= 1
+            delta = y - self.mean
+            self.mean -= delta / self.n
+            self.m2 -= delta * (y - self.mean)
+        self.updates += 1
+        if self.updates >= self.window:
+            # recompute now and then so rounding errors can't pile up
+            values = buffer.column('mid', buffer.count - self.n, buffer.count)
+            self.mean = values.mean()
+            self.m2 = ((values - self.mean) ** 2).sum()
+            self.updates = 0
+
+    def oldest_needed(self):
+        return self.buffer.count - self.window
+
+    def std(self):
+        if self.n < 2:
+            return None
+        return math.sqrt(max(self.m2, 0.) / (self.n - 1))
 
-class MovingAverage(SignalGenerator):
+
+class MovingAverage(BufferedSignal):
     """
     calculates the moving average for a given lookback period
+
+    The window runs from the start of the current hour minus the lookback
+    period up to the latest bar. It is tracked as a range of rows in the
+    price buffer together with the running sum of its prices; each update
+    adds the new price and evicts the expired ones from the front, so the
+    mean is updated in constant (amortised) time per bar.
     """
 
-    def __init__(self, lookback_period):
+    def __init__(self, lookback_period, name="Moving Average"):
         """
         the lookback period is a datetime.timedelta object
         """
         self.lookback_period = lookback_period
-        self.data = pd.DataFrame({"Datetime":[],"Price":[]})
+        self.name = name
+        self.lookback_ns = int(lookback_period.total_seconds() * 1e9)
+        self.min_data_points = lookback_period.total_seconds() / 3600.
+        self.start = 0
+        self.count = 0
+        self.price_sum = 0.
+        self.evictions = 0
         self.ma = None
 
-    def update(self, bar):
-        market_price = (bar['Bid'] + bar['Ask']) / 2.
-        self.data = self.data.append(pd.DataFrame({"Datetime":[bar['Datetime']],"Price":[market_price]}))        
-        lookback_datetime = bar['Datetime'].replace(minute=0,second=0) - self.lookback_period
-        self.data = self.data[self.data['Datetime']>=lookback_datetime]
-        #from nose.tools import set_trace; set_trace()        
-        if len(self.data) < self.lookback_period.seconds/3600.:
+    def on_bar(self, buffer):
+        capacity = buffer.capacity
+        newest = buffer.count - 1
+        self.price_sum += buffer.mid[newest % capacity]
+        now = buffer.datetime[newest % capacity]
+        # start of the current hour, as datetime.replace(minute=0, second=0)
+        lookback_datetime = now - (now // 10**9 % 3600) * 10**9 - self.lookback_ns
+        while buffer.datetime[self.start % capacity] < lookback_datetime:
+            self.price_sum -= buffer.mid[self.start % capacity]
+            self.start += 1
+            self.evictions += 1
+        self.count = buffer.count - self.start
+        if self.evictions >= self.count:
+            # resum now and then so rounding errors can't pile up
+            self.price_sum = math.fsum(buffer.column('mid', self.start, buffer.count))
+            self.evictions = 0
+        if self.count < self.min_data_points:
             warnings.warn("not enough data points available")
-            self.ma = self.data.groupby('Datetime').mean()['Price'][0]
-            #return SignalEvent(symbol='BTC', datetime=datetime.now(), signal_type='Moving Average')
+        self.ma = self.price_sum / self.count
+
+    def oldest_needed(self):
+        return self.start
+
+    def cache_key(self):
+        return ('MovingAverage', self.lookback_ns, self.name)
+
+    def get_values(self):
+        return {self.name: self.ma}
+
+    def compute_all(self, bars):
+        now, mid = bars.datetime, _mid(bars)
+        if not len(mid):
+            return {self.name: np.zeros(0)}
+        lookback_datetime = now - (now // 10**9 % 3600) * 10**9 - self.lookback_ns
+        start = np.searchsorted(now, lookback_datetime, side='left')
+        stop = np.arange(1, len(mid) + 1)
+        # summing deviations from the first price keeps the rounding error small
+        price_sums = np.concatenate([[0.], np.cumsum(mid - mid[0])])
+        return {self.name: mid[0] + (price_sums[stop] - price_sums[start]) / (stop - start)}
+
+
+class ExponentialMovingAverage(BufferedSignal):
+    """
+    exponential moving average of the mid price, seeded with the first price
+    """
+
+    def __init__(self, span, name="EMA"):
+        """
+        span - the decay in bars, alpha = 2 / (span + 1)
+        """
+        self.alpha = 2. / (span + 1.)
+        self.name = name
+        self.ema = None
+
+    def on_bar(self, buffer):
+        price = buffer.mid[(buffer.count - 1) % buffer.capacity]
+        if self.ema is None:
+            self.ema = price
+        else:
+            self.ema += self.alpha * (price - self.ema)
+
+    def get_values(self):
+        return {self.name: self.ema}
+
+    def cache_key(self):
+        return ('ExponentialMovingAverage', self.alpha, self.name)
+
+    def compute_all(self, bars):
+        return {self.name: pd.Series(_mid(bars)).ewm(alpha=self.alpha, adjust=False).mean().values}
+
+
+class RelativeStrengthIndex(BufferedSignal):
+    """
+    Wilder's relative strength index of the mid price. The first average
+    gain/loss is the plain mean over `period` changes, after that they are
+    smoothed with alpha = 1 / period.
+    """
+
+    def __init__(self, period=14, name="RSI"):
+        self.period = period
+        self.name = name
+        self.changes = 0
+        self.avg_gain = 0.
+        self.avg_loss = 0.
+        self.rsi = None
+
+    def on_bar(self, buffer):
+        if buffer.count < 2:
+            return
+        newest = buffer.count - 1
+        change = buffer.mid[newest % buffer.capacity] - buffer.mid[(newest - 1) % buffer.capacity]
+        gain, loss = max(change, 0.), max(-change, 0.)
+        self.changes += 1
+        if self.changes <= self.period:
+            self.avg_gain += gain / self.period
+            self.avg_loss += loss / self.period
+            if self.changes < self.period:
+                return
+        else:
+            self.avg_gain += (gain - self.avg_gain) / self.period
+            self.avg_loss += (loss - self.avg_loss) / self.period
+        if self.avg_loss == 0:
+            self.rsi = 100.
+        else:
+            self.rsi = 100. - 100. / (1. + self.avg_gain / self.avg_loss)
+
+    def get_values(self):
+        return {self.name: self.rsi}
+
+    def cache_key(self):
+        return ('RelativeStrengthIndex', self.period, self.name)
+
+    def compute_all(self, bars):
+        change = np.diff(_mid(bars))
+        avg_gain = _wilder_average(np.maximum(change, 0.), self.period)
+        avg_loss = _wilder_average(np.maximum(-change, 0.), self.period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsi = np.where(avg_loss == 0, 100., 100. - 100. / (1. + avg_gain / avg_loss))
+        rsi[np.isnan(avg_gain)] = np.nan
+        return {self.name: np.concatenate([[np.nan], rsi])}
+
+
+class RollingStd(RollingWindow):
+    """
+    sample standard deviation of the mid price over the last `window` bars
+    """
+
+    def __init__(self, window, name="Rolling Std"):
+        super(RollingStd, self).__init__(window)
+        self.name = name
+
+    def get_values(self):
+        return {self.name: self.std()}
+
+    def cache_key(self):
+        return ('RollingStd', self.window, self.name)
+
+    def compute_all(self, bars):
+        return {self.name: pd.Series(_mid(bars)).rolling(self.window, min_periods=2).std().values}
+
+
+class BollingerBands(RollingWindow):
+    """
+    rolling mean of the mid price over the last `window` bars plus/minus
+    `num_std` rolling standard deviations
+    """
+
+    def __init__(self, window=20, num_std=2., name="Bollinger"):
+        super(BollingerBands, self).__init__(window)
+        self.num_std = num_std
+        self.name = name
+
+    def get_values(self):
+        std = self.std()
+        if std is None:
+            return {self.name + " Middle": None, self.name + " Upper": None,
+                    self.name + " Lower": None}
+        return {self.name + " Middle": self.mean,
+                self.name + " Upper": self.mean + self.num_std * std,
+                self.name + " Lower": self.mean - self.num_std * std}
+
+    def cache_key(self):
+        return ('BollingerBands', self.window, self.num_std, self.name)
+
+    def compute_all(self, bars):
+        rolling = pd.Series(_mid(bars)).rolling(self.window, min_periods=2)
+        mean, std = rolling.mean().values, rolling.std().values
+        return {self.name + " Middle": mean,
+                self.name + " Upper": mean + self.num_std * std,
+                self.name + " Lower": mean - self.num_std * std}
+
+
+class VolumeWeightedAveragePrice(BufferedSignal):
+    """
+    volume weighted average of the mid price over the last `window` bars
+    """
+
+    def __init__(self, window, name="VWAP"):
+        self.window = window
+        self.name = name
+        self.pv_sum = 0.
+        self.volume_sum = 0.
+        self.updates = 0
+        self.vwap = None
+
+    def on_bar(self, buffer):
+        capacity = buffer.capacity
+        newest = buffer.count - 1
+        self.pv_sum += buffer.mid[newest % capacity] * buffer.volume[newest % capacity]
+        self.volume_sum += buffer.volume[newest % capacity]
+        if buffer.count > self.window:
+            oldest = (newest - self.window) % capacity
+            self.pv_sum -= buffer.mid[oldest] * buffer.volume[oldest]
+            self.volume_sum -= buffer.volume[oldest]
+        self.updates += 1
+        if self.updates >= self.window:
+            start = max(buffer.count - self.window, 0)
+            volume = buffer.column('volume', start, buffer.count)
+            self.pv_sum = (buffer.column('mid', start, buffer.count) * volume).sum()
+            self.volume_sum = volume.sum()
+            self.updates = 0
+        self.vwap = self.pv_sum / self.volume_sum if self.volume_sum > 0 else None
+
+    def oldest_needed(self):
+        return self.buffer.count - self.window
+
+    def get_values(self):
+        return {self.name: self.vwap}
+
+    def cache_key(self):
+        return ('VolumeWeightedAveragePrice', self.window, self.name)
+
+    def compute_all(self, bars):
+        volume = bars.data['Volume'] if 'Volume' in bars.data else np.ones(len(bars))
+        pv_sum = pd.Series(_mid(bars) * volume).rolling(self.window, min_periods=1).sum().values
+        volume_sum = pd.Series(volume).rolling(self.window, min_periods=1).sum().values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {self.name: np.where(volume_sum > 0, pv_sum / volume_sum, np.nan)}
+
+
+class AverageTrueRange(BufferedSignal):
+    """
+    Wilder's average true range. The bars only carry bid and ask, so the
+    true range of a bar is the move of the mid price since the previous bar.
+    The first value is the plain mean over `period` ranges, after that it
+    is smoothed with alpha = 1 / period.
+    """
+
+    def __init__(self, period=14, name="ATR"):
+        self.period = period
+        self.name = name
+        self.ranges = 0
+        self.range_sum = 0.
+        self.atr = None
+
+    def on_bar(self, buffer):
+        if buffer.count < 2:
+            return
+        newest = buffer.count - 1
+        true_range = abs(buffer.mid[newest % buffer.capacity] -
+                         buffer.mid[(newest - 1) % buffer.capacity])
+        self.ranges += 1
+        if self.ranges < self.period:
+            self.range_sum += true_range
+        elif self.ranges == self.period:
+            self.atr = (self.range_sum + true_range) / self.period
         else:
-            self.ma = None
-    
+            self.atr += (true_range - self.atr) / self.period
+
     def get_values(self):
-        return {"Moving Average": self.ma}
+        return {self.name: self.atr}
+
+    def cache_key(self):
+        return ('AverageTrueRange', self.period, self.name)
+
+    def compute_all(self, bars):
+        atr = _wilder_average(np.abs(np.diff(_mid(bars))), self.period)
+        return {self.name: np.concatenate([[np.nan], atr])}
+
+
+def _mid(bars):
+    return (bars.data['Bid'] + bars.data['Ask']) / 2.
+
+
+def _wilder_average(values, period):
+    """
+    Wilder's smoothing: NaN for the first period - 1 values, then the
+    plain mean of the first `period` values, then an exponential average
+    with alpha = 1 / period.
+    """
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+    seeded = values[period - 1:].copy()
+    seeded[0] = values[:period].mean()
+    result[period - 1:] = pd.Series(seeded).ewm(alpha=1. / period, adjust=False).mean().values
+    return result
+
+
+def _datetime_ns(bar):
+    """
+    nanoseconds since the epoch of a bar's datetime
+    """
+    if isinstance(bar, Bar):
+        return bar.store.datetime[bar.index]
+    dt = bar['Datetime']
+    if isinstance(dt, pd.Timestamp):
+        return dt.value
+    return pd.Timestamp(dt).value
@@ -1,53 +1,214 @@
-import cPickle as pickle
+import numpy as np
+import pandas as pd
+
+from event import Event, EventHandler, MarketEvent, SignalEvent
+from results import PNL_COLUMNS, write_results
+from runlog import RunLog
+from tradelog import TradeLog
 
 class Simulator(object):
+    """
+    Runs a backtest on an EventHandler loop: every bar is put on the loop
+    as a MARKET event, which updates the signals and raises a SIGNAL event
+    for the strategy; its orders are dispatched as ORDER events to the
+    broker and the resulting FILL events to the portfolio. Fills are
+    recorded in a columnar TradeLog (simulator.trade_log) and the PnL
+    after every bar in simulator.pnls, or, if a results.ResultsWriter is
+    given, both are streamed to disk instead of being kept in memory.
+    Bars and fills are logged to a runlog.RunLog, which by default only
+    keeps them in its ring buffer and dumps that if the run fails.
+    With a timing.Timer every stage of the bar loop is timed (see
+    simulator.timer.table() after the run).
+    """
 
-    def __init__(self, dataStream, broker, strategy, portfolio, signals):
+    def __init__(self, dataStream, broker, strategy, portfolio, signals, events=None,
+                 order_latency=None, results=None, log=None, timer=None):
+        """
+        Parameters:
+        dataStream, broker, strategy, portfolio, signals - the components.
+        events - the EventHandler to run on; defaults to the broker's event
+                 queue if that is an EventHandler, otherwise a new one.
+        order_latency - optional timedelta between posting an order and
+                        its execution (it then fills at the first bar at
+                        or after that time).
+        results - optional ResultsWriter; it is closed at the end of run(),
+                  also when the run fails.
+        log - the RunLog to use (RunLog() by default).
+        timer - optional timing.Timer that times the signal updates,
+                strategy, broker and portfolio calls and every signal's
+                update. Without it nothing is timed.
+        """
         self.dataStream = dataStream
         self.broker = broker
         self.strategy = strategy
         self.portfolio = portfolio
         self.signals = signals
-        self.executed_orders = []
+        self.trade_log = TradeLog()
         self.pnls = {}
+        if events is None:
+            queue = getattr(broker, 'event_queue', None)
+            events = queue if isinstance(queue, EventHandler) else EventHandler()
+        self.events = events
+        self.order_latency = order_latency
+        self.results = results
+        self.log = RunLog() if log is None else log
+        self.timer = timer
+        self._bind_stages()
+        events.register('MARKET', self._on_market)
+        events.register('SIGNAL', self._on_signal)
+        events.register('ORDER', self._on_order)
+        events.register('FILL', self._on_fill)
+
+    def _bind_stages(self):
+        """
+        Looks up the functions the bar loop calls, wrapped by the timer if
+        there is one, so the handlers don't check for timing on every call.
+        """
+        stages = [('_update_signals', 'signals.update', self.signals, 'update'),
+                  ('_make_offers', 'strategy.make_offers', self.strategy, 'make_offers'),
+                  ('_execute_order', 'broker.execute_order', self.broker, 'execute_order'),
+                  ('_broker_on_bar', 'broker.on_bar', self.broker, 'on_bar'),
+                  ('_update_portfolio', 'portfolio.update', self.portfolio, 'update'),
+                  ('_mark_to_market', 'portfolio.mark_to_market', self.portfolio, 'mark_to_market')]
+        for attribute, stage, component, method in stages:
+            func = getattr(component, method, None)
+            if func is not None and self.timer is not None:
+                func = self.timer.wrap(stage, func)
+            setattr(self, attribute, func)
+        if hasattr(self.signals, 'set_timer'):
+            self.signals.set_timer(self.timer)
 
     def run(self):
-        all_executed_orders = []
-        for bar in self.dataStream._data_streamer():           
-            print bar['Datetime'] 
-            #if bar['Datetime'].month<8 and bar['Datetime'].month>1:
-            #    break
-            self.signals.update(bar)
-            orders = self.strategy.make_offers(bar, self.signals)
-            executed_orders = []
-            if orders:
-                for order in orders:
-                    executed = self.broker.execute_order(order)                    
-                    print executed
-                    executed_orders.append(executed)
-                    all_executed_orders.append(executed)
-            self.portfolio.update(executed_orders)
-            #from nose.tools import set_trace; set_trace()
-            self.pnls[bar['Datetime']] = {'realised': self.portfolio.realised_pnl,
-                                          'unrealised': self.portfolio.unrealised_pnl}
-        self.executed_orders = all_executed_orders
-        return executed_orders
-
-    def save_results(self, filename):
-        results = {
-                     "Trades": self.executed_orders,
-                     "Bid": self.dataStream.symbol_data['Bid'].values,
-                     "Ask": self.dataStream.symbol_data['Ask'].values,
-                     "Datetime": self.dataStream.symbol_data['Datetime'].values,
-                     "Realised_PnL": [pnl['realised'] for pnl in self.pnls.values()],
-                     "Unrealised_PnL": [pnl['unrealised'] for pnl in self.pnls.values()]
-                     }
-        with open(filename,'w') as fp:
-            pickle.dump(results,fp)
-
-class Order(object):
-
-    def __init__(self, symbol, order_type, exchange, volume, side, posted_at, price=None):
+        self.trade_log = TradeLog()
+        self._bind_stages()
+        if getattr(self.signals, 'precompute', False):
+            bars = getattr(self.dataStream, 'bars', None)
+            if bars is None:
+                # e.g. partitioned or live streams, which never hold the
+                # whole history at once
+                self.log.warning("%s has no bars to precompute the signals on, "
+                                 "updating them bar by bar", type(self.dataStream).__name__)
+            else:
+                precompute_all = self.signals.precompute_all
+                if self.timer is not None:
+                    precompute_all = self.timer.wrap('signals.precompute', precompute_all)
+                precompute_all(bars)
+        events = self.events
+        # portfolios that can revalue all their positions cheaply are
+        # marked to market on every bar, not only when they trade
+        mark_to_market = self._mark_to_market
+        results = self.results
+        log = self.log
+        log.attach()
+        try:
+            for bar in self.dataStream._data_streamer():
+                now = bar['Datetime']
+                log.bar(now)
+                events.put(MarketEvent(now, bar))
+                events.run(until=now)
+                if mark_to_market is not None:
+                    mark_to_market()
+                if results is not None:
+                    results.append_pnl(now, self.portfolio.realised_pnl, self.portfolio.unrealised_pnl)
+                else:
+                    self.pnls[now] = {'realised': self.portfolio.realised_pnl,
+                                      'unrealised': self.portfolio.unrealised_pnl}
+        except Exception:
+            log.error("run failed at %s", None if events.now is None else pd.Timestamp(events.now))
+            log.dump()
+            raise
+        finally:
+            log.detach()
+            if results is not None:
+                bars = self._bar_columns()
+                if bars is not None:
+                    results.write_table('bars', bars)
+                results.close()
+        return self.trade_log
+
+    def _on_market(self, event):
+        self.log.debug("bar %s", event.timestamp)
+        # resting orders are checked against the new bar first
+        if self._broker_on_bar is not None:
+            self._forward_fills(self._broker_on_bar(event.timestamp))
+        self._update_signals(event.bar)
+        self.events.put(SignalEvent(symbol='BTC', datetime=event.timestamp,
+                                    signal_type='UPDATE', data=event.bar))
+
+    def _on_signal(self, event):
+        orders = self._make_offers(event.data, self.signals)
+        if orders:
+            for order in orders:
+                self.events.put(order, timestamp=event.timestamp, delay=self.order_latency)
+
+    def _on_order(self, order):
+        executed = self._execute_order(order)
+        if executed is not None:
+            self._forward_fills([executed])
+
+    def _forward_fills(self, fills):
+        # brokers put their fills on their own event queue; pass them on
+        # if that isn't this loop
+        if getattr(self.broker, 'event_queue', None) is not self.events:
+            for fill in fills:
+                self.events.put(fill, timestamp=self.events.now)
+
+    def _on_fill(self, fill):
+        self.log.info("%s", fill)
+        if self.results is not None:
+            self.results.append_fill(fill)
+        else:
+            self.trade_log.append(fill)
+        self._update_portfolio([fill])
+
+    def _bar_columns(self):
+        """
+        Datetime/Bid/Ask of the bars streamed so far, for streams that
+        keep their bars in a BarStore.
+        """
+        bars = getattr(self.dataStream, 'bars', None)
+        if bars is None or not hasattr(bars, 'data'):
+            return None
+        start = getattr(self.dataStream, 'start', 0)
+        stop = self.dataStream.current_idx
+        return [(name, bars.data[name][start:stop]) for name in ['Datetime', 'Bid', 'Ask']
+                if name in bars.data]
+
+    def save_results(self, directory):
+        """
+        Saves the bars, the PnL after every bar and the fills of a finished
+        run in the columnar results format (see results.py); load them with
+        results.ResultsReader or results.read_results.
+        """
+        datetimes = sorted(self.pnls)
+        pnl = [('Datetime', np.array([dt.value for dt in datetimes], dtype=np.int64)),
+               ('Realised_PnL', np.array([self.pnls[dt]['realised'] for dt in datetimes], dtype=np.float64)),
+               ('Unrealised_PnL', np.array([self.pnls[dt]['unrealised'] for dt in datetimes],
+                                           dtype=np.float64))]
+        assert([name for name, _ in pnl] == [name for name, _ in PNL_COLUMNS])
+        tables = {'pnl': pnl,
+                  'fills': [(name, self.trade_log.column(name)) for name, _ in TradeLog.COLUMNS]}
+        bars = self._bar_columns()
+        if bars is not None:
+            tables['bars'] = bars
+        write_results(directory, tables, self.trade_log.instruments)
+
+class Order(Event):
+    """
+    An order from a strategy. Limit orders that can't be filled right
+    away rest at the broker until they fill, are cancelled (by their
+    order_id, which the broker sets) or reach expires_at; without an
+    expiry they are good till cancelled.
+    """
+
+    type = 'ORDER'
+    __slots__ = ('symbol', 'exchange', 'volume', 'side', 'posted_at', 'order_type', 'price',
+                 'expires_at', 'order_id')
+
+    def __init__(self, symbol, order_type, exchange, volume, side, posted_at, price=None,
+                 expires_at=None):
+        self.expires_at = expires_at
+        self.order_id = None
         if order_type != 'MKT':
             self.price = price
         self.symbol = symbol
@@ -57,6 +218,10 @@ class Order(object):
         self.posted_at = posted_at
         self.order_type = order_type
 
+    @property
+    def timestamp(self):
+        return self.posted_at
+
     def __str__(self):
         if self.order_type == 'MKT':
             return "Symbol {}; {} {} at market price".format(self.symbol, self.side, self.volume)
@@ -34,11 +34,13 @@ class TestStrategy(Strategy):
     posting buy market orders
     """
 
-    def __init__(self, events):
+    def __init__(self, events, volume=10):
         """
         events - The Event Queue object.
+        volume - The volume of every order.
         """
         self.events = events
+        self.volume = volume
         self.order_id = 0
 
     def make_offers(self, bars, signals):
@@ -46,12 +48,12 @@ class TestStrategy(Strategy):
         self.order_id += 1
         #from nose.tools import set_trace; set_trace()
         if bars['Ask']<sign['Moving Average']:
-            return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=10,
+            return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=self.volume,
                           side='B', posted_at=bars['Datetime'])]
             #return [Order(symbol='BTC', order_type='LMT', exchange='TestExchange', volume=10,
             #              side='B', posted_at=bars['Datetime'] , price=30)]
         elif bars['Bid']>sign['Moving Average']:
-            return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=10,
+            return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=self.volume,
                           side='S', posted_at=bars['Datetime']) ]
             #return [Order(symbol='BTC', order_type='LMT', exchange='TestExchange', volume=10,
             #              side='S', posted_at=bars['Datetime'], price=30)]
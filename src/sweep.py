@@ -0,0 +1,170 @@
+import datetime
+import itertools
+import multiprocessing
+import Queue
+
+import numpy as np
+import pandas as pd
+
+from broker import BacktestingBroker
+from data import BitcoinFromCSV, HistoricBarStream
+from event import EventHandler
+from portfolio import ArrayPortfolio
+from signals import SignalCollector, MovingAverage
+from simulator import Simulator
+from strategy import TestStrategy
+
+# the bars of the current worker process, loaded once by _init_worker,
+# and the signals precomputed on them
+_worker_bars = None
+_worker_signal_cache = {}
+
+
+def load_csv_bars(csv_path, spread=0.):
+    """
+    Data loader for run_sweep: the bars of a csv as used by BitcoinFromCSV.
+    """
+    return BitcoinFromCSV(Queue.Queue(), csv_path, spread).bars
+
+
+def build_simulator(bars, lookback=datetime.timedelta(days=3), volume=10, spread=None,
+                    commission=0.01, init_cash=100, start=0, stop=None, signal_cache=None):
+    """
+    The default run factory: wires up the same components as backtester.py
+    (a moving average signal, TestStrategy and BacktestingBroker) on top of
+    already loaded bars. The portfolio is an ArrayPortfolio, which the
+    Simulator marks to market on every bar, so the equity curve of the run
+    is cash plus positions at the mid price after every bar.
+
+    Parameters:
+    bars - a BarStore.
+    lookback - the lookback period of the moving average.
+    volume - the volume of every order.
+    spread - if given, Bid/Ask are set this far below/above the mid price.
+    commission - the broker's commission per unit.
+    init_cash - the portfolio's starting cash.
+    start, stop - only trade on the rows [start, stop) of the bars; the
+                  signals still see the history before start.
+    signal_cache - optional dict shared by runs over the same bars, in
+                   which the precomputed signals are kept.
+    """
+    if spread is not None:
+        bars = bars.with_spread(spread)
+    events = EventHandler()
+    dataStream = HistoricBarStream(events, bars, start, stop)
+    broker = BacktestingBroker(dataStream=dataStream, event_queue=events, commission=commission)
+    strategy = TestStrategy(events, volume=volume)
+    portfolio = ArrayPortfolio(broker, init_cash)
+    signals = SignalCollector({"Moving Average": MovingAverage(lookback_period=lookback)},
+                              precompute=True, cache=signal_cache)
+    return Simulator(dataStream, broker, strategy, portfolio, signals)
+
+
+def equity_curve(simulator):
+    """
+    The equity after every bar of a finished run: the initial cash plus
+    realised and unrealised PnL. Returns (int64 datetimes, equity).
+
+    This is the mark-to-market equity only for portfolios that are
+    revalued on every bar (those with a mark_to_market method, such as
+    ArrayPortfolio); the PnL of Portfolio is only updated on fills.
+    """
+    init_cash = simulator.portfolio.init_cash
+    datetimes = sorted(simulator.pnls)
+    equity = np.array([init_cash + simulator.pnls[dt]['realised'] + simulator.pnls[dt]['unrealised']
+                       for dt in datetimes], dtype=np.float64)
+    return pd.to_datetime(datetimes).values.view(np.int64), equity
+
+
+def summarise(simulator):
+    """
+    Reduces a finished run to final equity, realised PnL, trade count and
+    maximum drawdown of the equity curve.
+    """
+    init_cash = simulator.portfolio.init_cash
+    _, equity = equity_curve(simulator)
+    if len(equity):
+        max_drawdown = float(np.max(np.maximum.accumulate(equity) - equity))
+        final_equity = float(equity[-1])
+    else:
+        max_drawdown = 0.
+        final_equity = float(init_cash)
+    return {'final_equity': final_equity,
+            'realised_pnl': float(simulator.portfolio.realised_pnl),
+            'trade_count': len(simulator.trade_log),
+            'max_drawdown': max_drawdown}
+
+
+def parameter_grid(param_grid):
+    """
+    Expands a dict of parameter name -> list of values into the list
+    of all combinations (as dicts), in a stable order.
+    """
+    names = sorted(param_grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[param_grid[name] for name in names])]
+
+
+def _init_worker(data_loader):
+    global _worker_bars, _worker_signal_cache
+    _worker_bars = data_loader()
+    _worker_signal_cache = {}
+
+
+def _run_one(task):
+    """
+    Runs factory(bars, **params). With the 'signal_cache' option the
+    factory also gets the worker's signal cache; with 'equity_curve'
+    the equity curve is returned along with the summary.
+    """
+    factory, params, options = task
+    if options.get('signal_cache'):
+        simulator = factory(_worker_bars, signal_cache=_worker_signal_cache, **params)
+    else:
+        simulator = factory(_worker_bars, **params)
+    simulator.run()
+    if options.get('equity_curve'):
+        return summarise(simulator), equity_curve(simulator)
+    return summarise(simulator)
+
+
+def run_tasks(tasks, data_loader, processes=None):
+    """
+    Runs (factory, params, options) tasks with _run_one, on a process pool
+    whose workers load the bars once, or inline if processes is 1.
+    """
+    if processes == 1:
+        _init_worker(data_loader)
+        return [_run_one(task) for task in tasks]
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(data_loader,))
+    try:
+        return pool.map(_run_one, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_sweep(param_grid, data_loader, factory=build_simulator, processes=None):
+    """
+    Runs one backtest per parameter combination over a process pool and
+    returns one summary row per run as a DataFrame.
+
+    Every worker calls data_loader once when it starts and reuses the bars
+    for all the runs it gets, so the data is parsed once per core rather
+    than once per run.
+
+    Parameters:
+    param_grid - dict of parameter name -> list of values, passed to the
+                 factory as keyword arguments.
+    data_loader - picklable callable returning a BarStore, e.g.
+                  functools.partial(load_csv_bars, csv_path).
+    factory - picklable callable (bars, **params) -> Simulator.
+    processes - number of worker processes (defaults to the number of
+                cores); 1 runs everything in this process.
+    """
+    grid = parameter_grid(param_grid)
+    summaries = run_tasks([(factory, params, {}) for params in grid], data_loader, processes)
+    rows = [dict(params, **summary) for params, summary in zip(grid, summaries)]
+    columns = sorted(param_grid) + ['final_equity', 'realised_pnl', 'trade_count', 'max_drawdown']
+    return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,114 @@
+import json
+import random
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class StageTimings(object):
+    """
+    Call count, total, maximum and a sample of the durations of one stage.
+    The sample is a reservoir of at most `capacity` durations, so the
+    percentiles of long runs are estimated in bounded memory.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.sample = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if len(self.sample) < self.capacity:
+            self.sample.append(seconds)
+        else:
+            idx = random.randrange(self.count)
+            if idx < self.capacity:
+                self.sample[idx] = seconds
+
+    def percentile(self, q):
+        return float(np.percentile(self.sample, q)) if self.sample else 0.
+
+
+class Timer(object):
+    """
+    Collects the timings of named stages.
+
+    Timing is switched on by giving a Timer to the Simulator: it then wraps
+    the stage functions of the bar loop (and the update of every signal)
+    with timer.wrap() before the run. Without a Timer nothing is wrapped,
+    so switching timing off costs nothing.
+    """
+
+    def __init__(self, capacity=10000, clock=time.time):
+        """
+        Parameters:
+        capacity - the number of durations kept per stage for percentiles.
+        clock - the clock function.
+        """
+        self.capacity = capacity
+        self.clock = clock
+        self.stages = OrderedDict()
+
+    def stage(self, name):
+        timings = self.stages.get(name)
+        if timings is None:
+            timings = self.stages[name] = StageTimings(self.capacity)
+        return timings
+
+    def wrap(self, name, func):
+        """
+        Returns func wrapped so that every call is timed as stage `name`.
+        """
+        add = self.stage(name).add
+        clock = self.clock
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(clock() - start)
+        return timed
+
+    def summary(self):
+        """
+        One row per stage: calls, total seconds and the mean, median,
+        90th/99th percentile and maximum duration in microseconds.
+        """
+        rows = []
+        for name, timings in self.stages.items():
+            rows.append(OrderedDict([
+                ('stage', name),
+                ('calls', timings.count),
+                ('total_s', timings.total),
+                ('mean_us', 1e6 * timings.total / timings.count if timings.count else 0.),
+                ('p50_us', 1e6 * timings.percentile(50)),
+                ('p90_us', 1e6 * timings.percentile(90)),
+                ('p99_us', 1e6 * timings.percentile(99)),
+                ('max_us', 1e6 * timings.max)]))
+        return rows
+
+    def to_frame(self):
+        rows = self.summary()
+        return pd.DataFrame(rows, columns=list(rows[0].keys()) if rows else None)
+
+    def table(self):
+        return self.to_frame().to_string(index=False, float_format=lambda x: '{:.4g}'.format(x))
+
+    def to_json(self, path=None):
+        """
+        The summary as JSON; written to `path` if one is given.
+        """
+        text = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+from event import _to_ns
+
+
+SIDES = {'B': 1, 'S': -1}
+
+
+class TradeLog(object):
+    """
+    Columnar log of fills.
+
+    Every field of a fill is kept in its own preallocated NumPy array that
+    doubles in size when it is full, so logging a fill writes a handful of
+    scalars instead of keeping the FillEvent alive. Sides are stored as
+    +1 (buy) / -1 (sell) and the (symbol, exchange) of a fill as an index
+    into `instruments`.
+    """
+
+    COLUMNS = [('Datetime', np.int64), ('Side', np.int8), ('Volume', np.float64),
+               ('Price', np.float64), ('Commission', np.float64), ('Fill Cost', np.float64),
+               ('Instrument', np.int32)]
+
+    def __init__(self, capacity=1024):
+        """
+        Parameters:
+        capacity - the number of fills to allocate room for up front.
+        """
+        self.count = 0
+        self.data = dict((name, np.zeros(max(capacity, 1), dtype=dtype))
+                         for name, dtype in self.COLUMNS)
+        self.instruments = []
+        self.instrument_ids = {}
+
+    @classmethod
+    def from_columns(cls, columns, instruments=()):
+        """
+        Builds a log from column arrays (e.g. read back from disk) and the
+        list of (symbol, exchange) instruments their ids refer to.
+        """
+        log = cls(1)
+        log.data = dict((name, np.asarray(columns[name], dtype=dtype)) for name, dtype in cls.COLUMNS)
+        log.count = len(log.data['Datetime'])
+        for symbol, exchange in instruments:
+            log.instrument_id(symbol, exchange)
+        return log
+
+    def __len__(self):
+        return self.count
+
+    def append(self, fill):
+        """
+        Logs a FillEvent.
+        """
+        if self.count == len(self.data['Datetime']):
+            self._grow()
+        idx = self.count
+        data = self.data
+        data['Datetime'][idx] = _to_ns(fill.timeindex)
+        data['Side'][idx] = SIDES[fill.side]
+        data['Volume'][idx] = fill.volume
+        data['Price'][idx] = fill.price
+        data['Commission'][idx] = 0. if fill.commission is None else fill.commission
+        data['Fill Cost'][idx] = 0. if fill.fill_cost is None else fill.fill_cost
+        data['Instrument'][idx] = self.instrument_id(fill.symbol, fill.exchange)
+        self.count += 1
+
+    def instrument_id(self, symbol, exchange):
+        key = (symbol, exchange)
+        if key not in self.instrument_ids:
+            self.instrument_ids[key] = len(self.instruments)
+            self.instruments.append(key)
+        return self.instrument_ids[key]
+
+    def clear(self):
+        """
+        Empties the log, keeping its arrays (and instrument ids).
+        """
+        self.count = 0
+
+    def _grow(self):
+        for name, values in self.data.items():
+            grown = np.zeros(max(2 * len(values), 1), dtype=values.dtype)
+            grown[:len(values)] = values
+            self.data[name] = grown
+
+    def column(self, name):
+        """
+        View on the logged values of a column.
+        """
+        return self.data[name][:self.count]
+
+    def signed_volume(self):
+        return self.column('Side') * self.column('Volume')
+
+    def to_frame(self):
+        """
+        The fills as a DataFrame, one row per fill, with the sides as
+        'B'/'S' and the symbol and exchange spelled out.
+        """
+        instruments = self.column('Instrument')
+        symbols = np.array([symbol for symbol, _ in self.instruments] or [''], dtype=object)
+        exchanges = np.array([exchange for _, exchange in self.instruments] or [''], dtype=object)
+        return pd.DataFrame({'Datetime': self.column('Datetime').view('M8[ns]'),
+                             'Symbol': symbols[instruments],
+                             'Exchange': exchanges[instruments],
+                             'Side': np.where(self.column('Side') > 0, 'B', 'S'),
+                             'Volume': self.column('Volume'),
+                             'Price': self.column('Price'),
+                             'Commission': self.column('Commission'),
+                             'Fill Cost': self.column('Fill Cost')},
+                            columns=['Datetime', 'Symbol', 'Exchange', 'Side', 'Volume',
+                                     'Price', 'Commission', 'Fill Cost'])
@@ -1,15 +1,49 @@
 import unittest
-from data import DataHandler
+from data import (DataHandler, HistoricBarStream, BitcoinFromCSV, PartitionedBarStream, SharedBarStream,
+                  partition_csv)
+from bars import BarStore, PartitionWriter, write_partitions, publish_bars, attach_bars, unpublish_bars
+import functools
 from simulator import Order, Simulator
 from broker import BacktestingBroker
 import Queue
 from nose.tools import set_trace
 import datetime 
+import os
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
-from event import FillEvent
-from portfolio import Portfolio
-from signals import SignalCollector
+from event import FillEvent, EventHandler, MarketEvent
+from portfolio import Portfolio, ArrayPortfolio
+from vectorized import run_vectorized, threshold_orders
+from sweep import run_sweep, parameter_grid, summarise, equity_curve
+from sweep import build_simulator as build_sweep_simulator
+from tradelog import TradeLog
+import logging
+import json
+from runlog import RunLog, Sampler
+from timing import Timer
+import backtester
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+from live import Cadence, HTTPQuoteClient, CoinbaseQuoteSource, HTTPStreamFeed, LiveQuoteStream
+import sys
+import StringIO
+from benchmarks import write_csv, synthetic_bars, run_benchmarks, save_baseline, load_baseline, compare
+from results import ResultsWriter, ResultsReader, read_results
+from quotes import QuoteSnapshot
+from pending import PendingOrders
+from costs import (FixedBpsSlippage, ParticipationSlippage, SquareRootImpact, PerUnitFee, BpsFee,
+                   TieredFee)
+from orderbook import OrderBook, BookReplay, BID, ASK
+from walkforward import walk_forward_windows, run_walk_forward, stitch_equity_curves
+import signals
+from signals import (SignalCollector, MovingAverage, ExponentialMovingAverage, RelativeStrengthIndex,
+                     RollingStd, BollingerBands, VolumeWeightedAveragePrice, AverageTrueRange,
+                     SignalGenerator)
+import warnings
 
 # get coverage of this folder
 # nosetests --with-coverage --cover-erase --cover-package=.
@@ -43,6 +77,321 @@ class testSignals(unittest.TestCase):
     def test_normal(self):
         self.assertEqual(1, 1)
 
+    def recorded_bars(self):
+        # an hourly random walk with gaps and repeated timestamps
+        rng = np.random.RandomState(42)
+        steps = rng.choice([0, 30, 60, 60, 60, 180], size=500)
+        dates = [pd.Timestamp('2017-01-01 00:17:00') + pd.Timedelta(minutes=m) for m in np.cumsum(steps)]
+        mid = 1000 + np.cumsum(rng.randn(len(dates)))
+        return pd.DataFrame({'Datetime': dates, 'Bid': mid - 0.3, 'Ask': mid + 0.3})
+
+    def test_moving_average_matches_pandas(self):
+        """
+        the ring buffer has to agree with a plain pandas implementation
+        of the same window (everything from the start of the current hour
+        minus the lookback period)
+        """
+        bars = self.recorded_bars()
+        for lookback in [datetime.timedelta(hours=5), datetime.timedelta(days=1)]:
+            ma = MovingAverage(lookback_period=lookback)
+            history = pd.DataFrame({"Datetime": [], "Price": []})
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for _, bar in bars.iterrows():
+                    ma.update(bar)
+                    history = history.append(pd.DataFrame(
+                        {"Datetime": [bar['Datetime']], "Price": [(bar['Bid'] + bar['Ask']) / 2.]}))
+                    lookback_datetime = bar['Datetime'].replace(minute=0, second=0) - lookback
+                    history = history[history['Datetime'] >= lookback_datetime]
+                    self.assertAlmostEqual(ma.get_values()['Moving Average'],
+                                           history['Price'].mean(), places=9)
+                    self.assertEqual(ma.count, len(history))
+
+    def test_moving_average_hand_checked(self):
+        # the window starts at the start of the current hour minus the lookback
+        mid = np.array([10., 20., 30., 40., 70.])
+        bars = BarStore.from_frame(pd.DataFrame({
+            'Datetime': pd.to_datetime(['2017-01-01 00:00', '2017-01-01 01:30', '2017-01-01 02:00',
+                                        '2017-01-01 03:45', '2017-01-03 03:10']),
+            'Bid': mid - 0.5, 'Ask': mid + 0.5}))
+        # 2 hours at 03:45: 01:30, 02:00 and 03:45 are from 01:00 on
+        # 2 days at 01-03 03:10: 03:45 and 03:10 are from 01-01 03:00 on
+        expected = {datetime.timedelta(hours=2): [10., 15., 20., 30., 70.],
+                    datetime.timedelta(days=2): [10., 15., 20., 25., 55.]}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for lookback, values in expected.items():
+                ma = MovingAverage(lookback_period=lookback)
+                incremental = []
+                for idx in range(len(bars)):
+                    ma.update(bars.bar(idx))
+                    incremental.append(ma.get_values()['Moving Average'])
+                self.assertEqual(incremental, values)
+                self.assertEqual(list(MovingAverage(lookback).compute_all(bars)['Moving Average']), values)
+
+    def test_collector_shares_one_buffer(self):
+        bars = self.recorded_bars()
+        bars['Volume'] = np.random.RandomState(0).uniform(1, 10, len(bars))
+        collector = SignalCollector({"MA": MovingAverage(datetime.timedelta(days=2)),
+                                     "EMA": ExponentialMovingAverage(span=10),
+                                     "RSI": RelativeStrengthIndex(period=14),
+                                     "Std": RollingStd(window=20),
+                                     "Bollinger": BollingerBands(window=20),
+                                     "VWAP": VolumeWeightedAveragePrice(window=20),
+                                     "ATR": AverageTrueRange(period=14)},
+                                    buffer_capacity=8)
+        for signal in collector.signals.values():
+            self.assertTrue(signal.buffer is collector.buffer)
+        mid = (bars['Bid'] + bars['Ask']) / 2.
+        expected = pd.DataFrame({
+            'EMA': mid.ewm(span=10, adjust=False).mean(),
+            'Rolling Std': mid.rolling(20, min_periods=2).std(),
+            'Bollinger Upper': mid.rolling(20).mean() + 2 * mid.rolling(20).std(),
+            'VWAP': (mid * bars['Volume']).rolling(20, min_periods=1).sum() /
+                    bars['Volume'].rolling(20, min_periods=1).sum()})
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for idx, bar in bars.iterrows():
+                collector.update(bar)
+                values = collector.get_signals()
+                for name in expected.columns:
+                    if np.isnan(expected[name][idx]):
+                        continue
+                    self.assertAlmostEqual(values[name], expected[name][idx], places=6)
+                self.assertTrue(values['RSI'] is None or 0 <= values['RSI'] <= 100)
+        # the buffer had to grow to hold two days of bars
+        self.assertGreater(collector.buffer.capacity, 8)
+        self.assertEqual(collector.buffer.count, len(bars))
+
+    def test_rsi_and_atr(self):
+        dates = pd.date_range('2017-01-01', periods=30, freq='H')
+        bars = pd.DataFrame({'Datetime': dates, 'Bid': np.arange(30.) * 2, 'Ask': np.arange(30.) * 2})
+        rsi = RelativeStrengthIndex(period=14)
+        atr = AverageTrueRange(period=14)
+        for idx, bar in bars.iterrows():
+            rsi.update(bar)
+            atr.update(bar)
+            if idx < 14:
+                self.assertIsNone(rsi.get_values()['RSI'])
+                self.assertIsNone(atr.get_values()['ATR'])
+        self.assertEqual(rsi.get_values()['RSI'], 100.)
+        self.assertEqual(atr.get_values()['ATR'], 2.)
+
+    def all_indicators(self):
+        return {"MA": MovingAverage(datetime.timedelta(hours=10)),
+                "EMA": ExponentialMovingAverage(span=10),
+                "RSI": RelativeStrengthIndex(period=14),
+                "Std": RollingStd(window=20),
+                "Bollinger": BollingerBands(window=20),
+                "VWAP": VolumeWeightedAveragePrice(window=20),
+                "ATR": AverageTrueRange(period=14)}
+
+    def test_precompute_matches_incremental(self):
+        frame = self.recorded_bars()
+        frame['Volume'] = np.random.RandomState(0).uniform(1, 10, len(frame))
+        store = BarStore.from_frame(frame)
+        incremental = SignalCollector(self.all_indicators())
+        precomputed = SignalCollector(self.all_indicators(), precompute=True)
+        precomputed.precompute_all(store)
+        self.assertEqual(precomputed.incremental, [])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for idx in range(len(store)):
+                incremental.update(store.bar(idx))
+                precomputed.update(store.bar(idx))
+                expected = incremental.get_signals()
+                values = precomputed.get_signals()
+                self.assertEqual(sorted(values.keys()), sorted(expected.keys()))
+                for name in expected:
+                    if expected[name] is None:
+                        self.assertIsNone(values[name], name)
+                    else:
+                        self.assertAlmostEqual(values[name], expected[name], places=6, msg=name)
+
+    def test_precompute_keeps_buffer_bounded(self):
+        class StreamingStd(RollingStd):
+            def compute_all(self, bars):
+                return None
+
+        dates = pd.date_range('2017-01-01', periods=5000, freq='H')
+        mid = 100 + np.sin(np.arange(5000.))
+        store = BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': mid, 'Ask': mid}))
+        collector = SignalCollector({"MA": MovingAverage(datetime.timedelta(days=1)),
+                                     "Std": StreamingStd(window=20)}, precompute=True)
+        collector.precompute_all(store)
+        self.assertEqual(len(collector.incremental), 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for idx in range(len(store)):
+                collector.update(store.bar(idx))
+        self.assertEqual(collector.buffer.capacity, 1024)
+
+    def test_precompute_lookahead_guard(self):
+        class PeekingSignal(SignalGenerator):
+            def compute_all(self, bars):
+                return {"Next Bid": np.append(bars.column('Bid')[1:], np.nan)}
+
+        store = BarStore.from_frame(self.recorded_bars())
+        collector = SignalCollector({"Next Bid": PeekingSignal()}, precompute=True)
+        self.assertRaises(ValueError, collector.precompute_all, store)
+        # bars have to arrive in the order they were precomputed in
+        collector = SignalCollector({"EMA": ExponentialMovingAverage(span=10)}, precompute=True)
+        collector.precompute_all(store)
+        collector.update(store.bar(0))
+        self.assertRaises(ValueError, collector.update, store.bar(2))
+
+    def test_precompute_starts_inside_duplicate_timestamps(self):
+        frame = self.recorded_bars().iloc[:10].copy()
+        frame['Datetime'] = frame['Datetime'].iloc[[0, 1, 2, 2, 2, 3, 4, 5, 6, 7]].values
+        store = BarStore.from_frame(frame)
+        full = SignalCollector({"EMA": ExponentialMovingAverage(span=3)}, precompute=True)
+        full.precompute_all(store)
+        expected = full.precomputed['EMA']
+        # the stream starts at the second of three bars with the same datetime
+        for make_bar in [store.bar, lambda idx: frame.iloc[idx]]:
+            collector = SignalCollector({"EMA": ExponentialMovingAverage(span=3)}, precompute=True)
+            collector.precompute_all(store)
+            for idx in range(3, len(store)):
+                collector.update(make_bar(idx))
+                self.assertEqual(collector.cursor, idx)
+                self.assertEqual(collector.get_signals()['EMA'], expected[idx])
+
+    def test_moving_average_warns_on_short_history(self):
+        ma = MovingAverage(lookback_period=datetime.timedelta(hours=3))
+        bars = self.recorded_bars()
+        # python 2 consults the registry before the filters
+        getattr(signals, '__warningregistry__', {}).clear()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ma.update(bars.iloc[0])
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(ma.get_values()['Moving Average'], (bars['Bid'][0] + bars['Ask'][0]) / 2.)
+
+
+class testData(unittest.TestCase):
+
+    def setUp(self):
+        prices = np.array([10., 20., 30., 40.])
+        dates = [datetime.datetime(2017, 1, 1) + datetime.timedelta(hours=i) for i in range(len(prices))]
+        self.frame = pd.DataFrame({'Bid': prices, 'Ask': prices + 5, 'Datetime': dates})
+        self.stream = HistoricBarStream(Queue.Queue(), BarStore.from_frame(self.frame))
+
+    def test_bar_store_columns(self):
+        store = self.stream.bars
+        self.assertEqual(store.datetime.dtype, np.int64)
+        self.assertEqual(store.column('Bid').dtype, np.float64)
+        self.assertTrue(store.to_frame().equals(self.frame[['Datetime', 'Ask', 'Bid']]))
+
+    def test_streamed_bars(self):
+        for idx, bar in enumerate(self.stream._data_streamer()):
+            self.assertEqual(bar['Bid'], self.frame['Bid'][idx])
+            self.assertEqual(bar['Ask'], self.frame['Ask'][idx])
+            self.assertEqual(bar['Datetime'], self.frame['Datetime'][idx])
+            # the latest bar is the one that was just streamed, never a future one
+            latest = self.stream.get_latest_bars(N=2)
+            self.assertEqual(latest['Bid'][-1], bar['Bid'])
+            self.assertEqual(len(latest), min(idx + 1, 2))
+
+    def test_windows_are_views(self):
+        self.stream.update_bars()
+        self.stream.update_bars()
+        window = self.stream.get_latest_bars(N=10)
+        self.assertEqual(len(window), 2)
+        self.assertTrue(np.shares_memory(window['Bid'], self.stream.bars.column('Bid')))
+        self.assertEqual(list(window[['Bid', 'Ask']].to_frame().columns), ['Bid', 'Ask'])
+
+
+    def test_csv_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(tmp_dir, 'prices.csv')
+            pd.DataFrame({'Timestamp': ['2017-01-01 02:00:00', '2017-01-01 00:00:00', '2017-01-01 01:00:00'],
+                          'Weighted Price': ['12', '10', 'n/a']}).to_csv(csv_path, index=False)
+            parsed = BitcoinFromCSV(Queue.Queue(), csv_path, spread=0.5)
+            self.assertTrue(os.path.exists(parsed.cache_path))
+            cached = BitcoinFromCSV(Queue.Queue(), csv_path, spread=0.5)
+            self.assertIsNotNone(cached._load_cache())
+            for stream in [parsed, cached]:
+                np.testing.assert_array_equal(stream.bars.column('Bid'), [9.5, np.nan, 11.5])
+                np.testing.assert_array_equal(stream.bars.column('Ask'), [10.5, np.nan, 12.5])
+                self.assertEqual(stream.bars.bar(0)['Datetime'], pd.Timestamp('2017-01-01 00:00:00'))
+            # changing the csv invalidates the cache
+            pd.DataFrame({'Timestamp': ['2017-01-01 00:00:00'],
+                          'Weighted Price': ['20']}).to_csv(csv_path, index=False)
+            os.utime(csv_path, (0, 0))
+            self.assertIsNone(cached._load_cache())
+            reparsed = BitcoinFromCSV(Queue.Queue(), csv_path, spread=0.5)
+            np.testing.assert_array_equal(reparsed.bars.column('Bid'), [19.5])
+            # a truncated cache is parsed again and rewritten
+            for size in [os.path.getsize(reparsed.cache_path) // 2, 10, 0]:
+                with open(reparsed.cache_path, 'r+b') as fp:
+                    fp.truncate(size)
+                self.assertIsNone(reparsed._load_cache())
+                recovered = BitcoinFromCSV(Queue.Queue(), csv_path, spread=0.5)
+                np.testing.assert_array_equal(recovered.bars.column('Bid'), [19.5])
+                self.assertIsNotNone(recovered._load_cache())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_partitioned_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dates = pd.date_range('2017-01-30', '2017-03-02', freq='D')
+            prices = np.arange(len(dates), dtype=float)
+            store = BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': prices, 'Ask': prices + 1}))
+            partitions = write_partitions(store, tmp_dir)
+            self.assertEqual([p['name'] for p in partitions], ['2017-01', '2017-02', '2017-03'])
+            stream = PartitionedBarStream(Queue.Queue(), tmp_dir)
+            for idx, bar in enumerate(stream._data_streamer()):
+                self.assertEqual(bar['Bid'], prices[idx])
+                self.assertEqual(bar['Datetime'], dates[idx])
+                latest = stream.get_latest_bars(N=5)
+                np.testing.assert_array_equal(latest['Bid'], prices[max(idx - 4, 0):idx + 1])
+                self.assertLessEqual(len(stream._chunks), 2)
+            self.assertEqual(idx + 1, len(dates))
+            # windows reaching back over more than one partition
+            np.testing.assert_array_equal(stream.get_latest_bars(N=40)['Ask'], prices[-40:] + 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_partition_csv_in_chunks(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(tmp_dir, 'bars.csv')
+            write_csv(synthetic_bars(2000), csv_path)
+            partitions = partition_csv(csv_path, os.path.join(tmp_dir, 'chunked'), spread=0.3,
+                                       chunksize=300)
+            expected = write_partitions(BitcoinFromCSV(Queue.Queue(), csv_path, 0.3, use_cache=False).bars,
+                                        os.path.join(tmp_dir, 'whole'))
+            self.assertEqual(partitions, expected)
+            self.assertEqual([p['name'] for p in partitions], ['2017-01', '2017-02', '2017-03'])
+            stream = PartitionedBarStream(Queue.Queue(), os.path.join(tmp_dir, 'chunked'))
+            np.testing.assert_allclose([bar['Bid'] for bar in stream._data_streamer()],
+                                       synthetic_bars(2000).column('Bid'))
+            writer = PartitionWriter(os.path.join(tmp_dir, 'unordered'))
+            writer.append(sweep_bars().slice(10, 20))
+            self.assertRaises(ValueError, writer.append, sweep_bars().slice(0, 10))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_precompute_on_partitioned_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            write_partitions(sweep_bars(), tmp_dir, freq='h')
+            stream = PartitionedBarStream(Queue.Queue(), tmp_dir)
+            broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+            signals = SignalCollector({"EMA": ExponentialMovingAverage(span=3)}, precompute=True)
+            log = RunLog()
+            simulator = Simulator(stream, broker, VolumeStrategy(1), Portfolio(broker, 1000), signals, log=log)
+            simulator.run()
+            # the stream has no BarStore, so the signals are updated bar by bar
+            self.assertEqual(len(simulator.trade_log), 20)
+            self.assertIsNotNone(signals.get_signals()['EMA'])
+            self.assertTrue("PartitionedBarStream has no bars to precompute" in log.format_recent()[0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 class testBroker(unittest.TestCase):
 
@@ -122,7 +471,30 @@ class testBroker(unittest.TestCase):
         for idx, order in enumerate(orders):
             event = broker.execute_order(order)            
             self.compare_events(expectedEvents[idx], event)         
-        
+
+    def test_quotes_from_snapshot(self):
+        bars = sweep_bars()
+        stream = HistoricBarStream(Queue.Queue(), bars)
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.0)
+        self.assertRaises(IndexError, broker.get_bid_ask, 'BTC', 'TestExchange')
+        for idx, bar in enumerate(stream._data_streamer()):
+            if idx == 4:
+                break
+        self.assertEqual(stream.quotes.bid_ask('BTC', 'TestExchange'), (104., 105.))
+        self.assertEqual(broker.get_market_price('TestExchange', 'B'), 105.)
+        self.assertEqual(broker.get_market_price('TestExchange', 'S'), 104.)
+        self.assertEqual(stream.quotes.timestamp, bars.datetime[4])
+
+    def test_quote_snapshot_instruments(self):
+        quotes = QuoteSnapshot(capacity=1)
+        quotes.update('BTC', 'A', 1., 2.)
+        quotes.update('ETH', 'A', 3., 4.)
+        quotes.update('BTC', 'B', 5., 6.)
+        self.assertEqual(quotes.instrument_id('ETH', 'A'), 1)
+        self.assertEqual(quotes.bid_ask('BTC', 'B'), (5., 6.))
+        self.assertEqual(quotes.bid_ask('BTC', 'A'), (1., 2.))
+        self.assertRaises(IndexError, quotes.bid_ask, 'ETH', 'B')
+
 
 
 class testPortfolio(unittest.TestCase):
@@ -230,6 +602,105 @@ class testPortfolio(unittest.TestCase):
         self.assertEqual(self.portfolio.closed_positions[0].side,'B')
         #self.assertEqual(self.portfolio.closed_positions[0].volume,3)
 
+    def test_repeated_flips(self):
+        fills = [FillEvent(timeindex=datetime.datetime.now(), symbol='BTC', exchange='TestExchange',
+                           volume=volume, side=side, fill_cost=price * volume, price=price,
+                           commission=commission)
+                 for volume, side, price, commission in [(3, 'B', 21, 0.3), (4, 'S', 20, 0.4),
+                                                         (2, 'B', 19, 0.2), (3, 'S', 22, 0.3)]]
+        self.portfolio.update(fills[:2])
+        self.assertEqual(self.portfolio.positions['BTC'].side, 'S')
+        # the flipped position is reopened in place
+        position = self.portfolio.positions['BTC']
+        self.assertEqual((position.buys, position.sells, position.volume), (0, 1, 1))
+        # the closed and the reopened part both carry the flipping fill's commission
+        self.assertAlmostEqual(self.portfolio.closed_positions[0].total_commission, 0.7)
+        self.assertAlmostEqual(position.total_commission, 0.4)
+        # flipping back from a short position
+        self.portfolio.update(fills[2:3])
+        self.assertIs(self.portfolio.positions['BTC'], position)
+        self.assertEqual(self.portfolio.positions['BTC'].side, 'B')
+        self.assertEqual(self.portfolio.positions['BTC'].volume, 1)
+        self.portfolio.update(fills[3:])
+        self.assertEqual(self.portfolio.positions['BTC'].side, 'S')
+        self.assertEqual(self.portfolio.positions['BTC'].volume, 2)
+        self.assertEqual([p.side for p in self.portfolio.closed_positions], ['B', 'S', 'B'])
+        self.assertAlmostEqual(self.portfolio.realised_pnl,
+                               sum(p.realised_pnl for p in self.portfolio.closed_positions))
+        self.assertAlmostEqual(self.portfolio.cur_cash, 100 - 63.3 + 79.6 - 38.2 + 65.7)
+
+
+class testVectorized(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        mid = 100 + np.cumsum(rng.randn(300))
+        dates = pd.date_range('2017-01-01', periods=len(mid), freq='H')
+        self.store = BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': mid - 0.5, 'Ask': mid + 0.5}))
+
+    def simulate(self, strategy, signals, portfolio=None):
+        stream = HistoricBarStream(Queue.Queue(), self.store)
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.01)
+        if portfolio is None:
+            portfolio = NullPortfolio()
+        else:
+            portfolio = portfolio(broker, 1000)
+        simulator = Simulator(stream, broker, strategy, portfolio, signals)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            simulator.run()
+        return simulator
+
+    def test_matches_simulator_fills(self):
+        from strategy import TestStrategy
+        signals = SignalCollector({"Moving Average": MovingAverage(datetime.timedelta(hours=12))},
+                                  precompute=True)
+        simulator = self.simulate(TestStrategy(Queue.Queue()), signals)
+        ma = signals.precomputed['Moving Average']
+        orders = threshold_orders(self.store.column('Bid'), self.store.column('Ask'), ma, 10)
+        result = run_vectorized(self.store, np.cumsum(orders), commission=0.01, init_cash=1000)
+        fills = simulator.trade_log
+        self.assertEqual(result.trade_count, len(fills))
+        traded = np.flatnonzero(result.trades)
+        np.testing.assert_allclose(result.fill_price[traded], fills.column('Price'))
+        np.testing.assert_allclose(result.commission[traded], fills.column('Commission'))
+        np.testing.assert_allclose(result.trades[traded], fills.signed_volume())
+
+    def test_matches_portfolio_cash(self):
+        simulator = self.simulate(test_strategy(), SignalCollector({}), Portfolio)
+        result = run_vectorized(self.store, 10 * np.arange(1, len(self.store) + 1),
+                                commission=0.01, init_cash=1000)
+        self.assertAlmostEqual(result.cash[-1], simulator.portfolio.cur_cash, places=6)
+        mid = (self.store.column('Bid') + self.store.column('Ask')) / 2.
+        self.assertAlmostEqual(result.equity[-1], result.cash[-1] + result.position[-1] * mid[-1])
+
+    def test_matches_array_portfolio(self):
+        simulator = self.simulate(test_strategy(), SignalCollector({}), ArrayPortfolio)
+        result = run_vectorized(self.store, 10 * np.arange(1, len(self.store) + 1),
+                                commission=0.01, init_cash=1000)
+        pnls = [simulator.pnls[dt] for dt in sorted(simulator.pnls)]
+        np.testing.assert_allclose([pnl['realised'] for pnl in pnls], result.realised_pnl, atol=1e-6)
+        np.testing.assert_allclose([pnl['unrealised'] for pnl in pnls], result.unrealised_pnl, atol=1e-6)
+        self.assertAlmostEqual(simulator.portfolio.cur_cash, result.cash[-1], places=6)
+
+    def test_realised_pnl(self):
+        frame = pd.DataFrame({'Datetime': pd.date_range('2017-01-01', periods=5, freq='H'),
+                              'Bid': [100., 110., 120., 90., 90.], 'Ask': [100., 110., 120., 90., 90.]})
+        store = BarStore.from_frame(frame)
+        # buy 10 @100, buy 10 @110, sell 5 @120, flip to -5 @90, close @90
+        result = run_vectorized(store, [10, 20, 15, -5, 0], commission=0., init_cash=0.)
+        np.testing.assert_allclose(result.realised_pnl, [0., 0., 75., -150., -150.])
+        np.testing.assert_allclose(result.unrealised_pnl, [0., 100., 225., 0., 0.])
+        np.testing.assert_allclose(result.equity, result.realised_pnl + result.unrealised_pnl)
+
+
+class NullPortfolio(object):
+    realised_pnl = 0
+    unrealised_pnl = 0
+
+    def update(self, executed_orders):
+        pass
+
 
 from strategy import Strategy
 class test_strategy(Strategy):
@@ -263,8 +734,818 @@ class testSimulator(unittest.TestCase):
     def test_run_live(self):
         pass
 
+class testEventHandler(unittest.TestCase):
+
+    class Ping(object):
+        type = 'PING'
+
+        def __init__(self, name, timestamp=None):
+            self.name = name
+            self.timestamp = timestamp
+
+    def test_dispatch_order(self):
+        events = EventHandler()
+        seen = []
+        events.register('PING', lambda event: seen.append(event.name))
+        start = datetime.datetime(2017, 1, 1)
+        events.put(self.Ping('late', start + datetime.timedelta(minutes=2)))
+        events.put(self.Ping('first', start))
+        events.put(self.Ping('second', start))
+        events.put(self.Ping('delayed', start), delay=datetime.timedelta(minutes=1))
+        events.run(until=start + datetime.timedelta(minutes=1))
+        self.assertEqual(seen, ['first', 'second', 'delayed'])
+        self.assertEqual(events.qsize(), 1)
+        events.run()
+        self.assertEqual(seen, ['first', 'second', 'delayed', 'late'])
+        self.assertTrue(events.empty())
+
+    def test_handlers_can_schedule_events(self):
+        events = EventHandler()
+        seen = []
+        def on_market(event):
+            seen.append('market')
+            events.put(self.Ping('ping'))
+        events.register('MARKET', on_market)
+        events.register('PING', lambda event: seen.append(event.name))
+        events.put(MarketEvent(datetime.datetime(2017, 1, 1)))
+        events.run(until=datetime.datetime(2017, 1, 1))
+        self.assertEqual(seen, ['market', 'ping'])
+
+    def test_historic_streams_drive_the_loop(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            write_partitions(sweep_bars(), tmp_dir, freq='h')
+            for make_stream in [lambda events: HistoricBarStream(events, sweep_bars()),
+                                lambda events: PartitionedBarStream(events, tmp_dir)]:
+                events = EventHandler()
+                stream = make_stream(events)
+                broker = BacktestingBroker(stream, events, 0.)
+                collector = SignalCollector({'EMA': ExponentialMovingAverage(span=3)})
+                simulator = Simulator(stream, broker, VolumeStrategy(1), Portfolio(broker, 1000), collector)
+                stream.update_bars()
+                while stream.continue_backtest:
+                    events.run()
+                    stream.update_bars()
+                # every bar reached the signals and was traded on at its own time
+                reference = SignalCollector({'EMA': ExponentialMovingAverage(span=3)})
+                for bar in HistoricBarStream(Queue.Queue(), sweep_bars())._data_streamer():
+                    reference.update(bar)
+                self.assertEqual(collector.get_signals()['EMA'], reference.get_signals()['EMA'])
+                self.assertEqual(len(simulator.trade_log), len(sweep_bars()))
+                np.testing.assert_array_equal(simulator.trade_log.column('Datetime'), sweep_bars().datetime)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_simulator_with_order_latency(self):
+        bars = sweep_bars()
+        events = EventHandler()
+        stream = HistoricBarStream(events, bars)
+        broker = BacktestingBroker(stream, events, 0.)
+        simulator = Simulator(stream, broker, VolumeStrategy(1), Portfolio(broker, 1000), SignalCollector({}),
+                              order_latency=datetime.timedelta(minutes=90))
+        simulator.run()
+        # every order fills two bars later, at that bar's ask
+        fills = simulator.trade_log
+        self.assertEqual(len(fills), len(bars) - 2)
+        np.testing.assert_array_equal(fills.column('Price'), bars.column('Ask')[2:])
+        # and is stamped with the time of that bar, not the posting time
+        np.testing.assert_array_equal(fills.column('Datetime'), bars.datetime[2:])
+        # the orders posted in the last two hours are still waiting
+        self.assertEqual(events.qsize(), 2)
+
+
+class VolumeStrategy(Strategy):
+
+    def __init__(self, volume):
+        self.volume = volume
+
+    def make_offers(self, bars, signals):
+        return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=self.volume,
+                      side='B', posted_at=bars['Datetime'])]
+
+
+def sweep_bars():
+    prices = 100 + np.arange(20.)
+    dates = pd.date_range('2017-01-01', periods=len(prices), freq='H')
+    return BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': prices, 'Ask': prices + 1}))
+
+
+def buying_simulator(bars, volume, commission):
+    stream = HistoricBarStream(Queue.Queue(), bars)
+    broker = BacktestingBroker(stream, Queue.Queue(), commission)
+    return Simulator(stream, broker, VolumeStrategy(volume), ArrayPortfolio(broker, 1000),
+                     SignalCollector({}))
+
+
+class testSweep(unittest.TestCase):
+
+    def test_parameter_grid(self):
+        grid = parameter_grid({'b': [1, 2], 'a': ['x']})
+        self.assertEqual(grid, [{'a': 'x', 'b': 1}, {'a': 'x', 'b': 2}])
+
+    def test_sweep_on_shared_bars(self):
+        path = publish_bars(sweep_bars())
+        try:
+            stream = SharedBarStream(Queue.Queue(), path)
+            self.assertFalse(stream.bars.column('Bid').flags.writeable)
+            np.testing.assert_array_equal(stream.bars.column('Ask'), sweep_bars().column('Ask'))
+            grid = {'volume': [1, 2], 'commission': [0.]}
+            shared = run_sweep(grid, functools.partial(attach_bars, path),
+                               factory=buying_simulator, processes=2)
+            self.assertTrue(shared.equals(run_sweep(grid, sweep_bars, factory=buying_simulator, processes=1)))
+        finally:
+            unpublish_bars(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_publish_bars_to_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'bars')
+            self.assertEqual(publish_bars(sweep_bars(), path), path)
+            np.testing.assert_array_equal(attach_bars(path).column('Bid'), sweep_bars().column('Bid'))
+            self.assertEqual(os.listdir(tmp_dir), ['bars'])
+            self.assertRaises(OSError, publish_bars, sweep_bars(), path)
+            self.assertEqual(os.listdir(tmp_dir), ['bars'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_sweep(self):
+        grid = {'volume': [1, 2, 3], 'commission': [0., 0.5]}
+        inline = run_sweep(grid, sweep_bars, factory=buying_simulator, processes=1)
+        pooled = run_sweep(grid, sweep_bars, factory=buying_simulator, processes=2)
+        self.assertEqual(len(inline), 6)
+        self.assertTrue(inline.equals(pooled))
+        self.assertEqual(list(inline['trade_count']), [20] * 6)
+        # buying more in a rising market ends with more equity
+        for _, runs in inline.groupby('commission'):
+            self.assertTrue(runs['final_equity'].is_monotonic_increasing)
+        self.assertTrue((inline['max_drawdown'] >= 0).all())
+
+    def test_summary_is_marked_to_market(self):
+        bars = synthetic_bars(500)
+        simulator = build_sweep_simulator(bars, lookback=datetime.timedelta(hours=20))
+        simulator.run()
+        portfolio = simulator.portfolio
+        volume = portfolio.volume[:len(portfolio.instruments)].sum()
+        self.assertNotEqual(volume, 0)
+        mid = (bars.column('Bid')[-1] + bars.column('Ask')[-1]) / 2.
+        summary = summarise(simulator)
+        self.assertAlmostEqual(summary['final_equity'], portfolio.cur_cash + volume * mid, places=6)
+        # the drawdown is taken from the equity after every bar
+        _, equity = equity_curve(simulator)
+        self.assertEqual(len(equity), len(bars))
+        self.assertAlmostEqual(summary['max_drawdown'],
+                               np.max(np.maximum.accumulate(equity) - equity))
+
+
+def windowed_buying_simulator(bars, volume, init_cash, start, stop, signal_cache):
+    stream = HistoricBarStream(Queue.Queue(), bars, start, stop)
+    broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+    signals = SignalCollector({"EMA": ExponentialMovingAverage(span=3)}, precompute=True, cache=signal_cache)
+    return Simulator(stream, broker, VolumeStrategy(volume), ArrayPortfolio(broker, init_cash), signals)
+
+
+class testWalkForward(unittest.TestCase):
+
+    def test_windows(self):
+        datetimes = pd.date_range('2017-01-01', periods=48, freq='H').values.view(np.int64)
+        windows = walk_forward_windows(datetimes, datetime.timedelta(hours=12), datetime.timedelta(hours=6))
+        self.assertEqual(windows[0], (0, 12, 12, 18))
+        self.assertEqual(windows[1], (6, 18, 18, 24))
+        self.assertEqual(windows[-1], (30, 42, 42, 48))
+        # the test windows tile the timeline after the first train window
+        self.assertEqual([w[2] for w in windows[1:]], [w[3] for w in windows[:-1]])
+
+    def test_walk_forward(self):
+        bars = sweep_bars()
+        folds, equity = run_walk_forward(bars, {'volume': [1, 3, 2]}, datetime.timedelta(hours=6),
+                                         datetime.timedelta(hours=4), factory=windowed_buying_simulator,
+                                         init_cash=1000, processes=2)
+        self.assertEqual(len(folds), 4)
+        # buying more always wins in a rising market
+        self.assertEqual(list(folds['volume']), [3, 3, 3, 3])
+        # the last test window is cut short by the end of the data
+        self.assertEqual(list(folds['trade_count']), [4, 4, 4, 2])
+        self.assertEqual(len(equity), 14)
+        self.assertTrue(equity.index.is_monotonic_increasing)
+        self.assertEqual(equity.index[0], pd.Timestamp('2017-01-01 06:00:00'))
+
+    def test_picks_best_marked_to_market_parameters(self):
+        bars = synthetic_bars(24 * 12, seed=2)
+        grid = {'lookback': [datetime.timedelta(hours=h) for h in [3, 12, 48]], 'volume': [1, 5]}
+        train, test = datetime.timedelta(days=4), datetime.timedelta(days=2)
+        folds, _ = run_walk_forward(bars, grid, train, test, init_cash=1000, processes=1)
+        windows = walk_forward_windows(bars.datetime, train, test)
+        self.assertEqual(len(folds), len(windows))
+        # the folds don't all pick the same parameters
+        self.assertTrue(len(set(zip(folds['lookback'], folds['volume']))) > 1)
+        mid = (bars.column('Bid') + bars.column('Ask')) / 2.
+        for (start, stop, _, _), (_, fold) in zip(windows, folds.iterrows()):
+            # cash plus the position at the last mid of the train window
+            equity = []
+            for params in parameter_grid(grid):
+                simulator = build_sweep_simulator(bars, start=start, stop=stop, init_cash=1000, **params)
+                simulator.run()
+                portfolio = simulator.portfolio
+                volume = portfolio.volume[:len(portfolio.instruments)].sum()
+                equity.append((portfolio.cur_cash + volume * mid[stop - 1], params))
+            best_equity, best = max(equity, key=lambda pair: pair[0])
+            self.assertEqual((fold['lookback'], fold['volume']), (best['lookback'], best['volume']))
+            self.assertAlmostEqual(fold['in_sample_final_equity'], best_equity, places=6)
+
+    def test_stitch(self):
+        curves = [(np.array([1, 2]), np.array([110., 120.])), (np.array([3, 4]), np.array([90., 100.]))]
+        stitched = stitch_equity_curves(curves, 100.)
+        np.testing.assert_array_equal(stitched.values, [110., 120., 110., 120.])
+
+
+class QuoteHandler(object):
+
+    def __init__(self):
+        self.quotes = QuoteSnapshot()
+
+    def get_bid_ask(self, ticker, exchange):
+        return self.quotes.bid_ask(ticker, exchange)
+
+
+class testArrayPortfolio(unittest.TestCase):
+
+    def fill(self, symbol, exchange, side, volume, price):
+        return FillEvent(timeindex=datetime.datetime.now(), symbol=symbol, exchange=exchange,
+                         volume=volume, side=side, fill_cost=volume * price, price=price, commission=0.)
+
+    def test_several_exchanges(self):
+        handler = QuoteHandler()
+        handler.quotes.update('BTC', 'A', 9., 11.)
+        handler.quotes.update('BTC', 'B', 11., 13.)
+        handler.quotes.update('ETH', 'A', 5., 7.)
+        portfolio = ArrayPortfolio(handler, 100, capacity=1)
+        portfolio.update([self.fill('BTC', 'A', 'B', 2, 10.), self.fill('BTC', 'B', 'S', 1, 12.),
+                          self.fill('ETH', 'A', 'B', 3, 5.)])
+        np.testing.assert_array_equal(portfolio.unrealised[:3], [0., 0., 3.])
+        handler.quotes.update('BTC', 'A', 11., 13.)
+        portfolio.mark_to_market()
+        self.assertEqual(portfolio.unrealised[portfolio.instrument_id('BTC', 'A')], 4.)
+        # flip BTC on A from long 2 to short 1
+        portfolio.update([self.fill('BTC', 'A', 'S', 3, 13.)])
+        frame = portfolio.positions_frame()
+        self.assertEqual(list(frame['Volume']), [-1., -1., 3.])
+        self.assertEqual(list(frame['Realised_PnL']), [6., 0., 0.])
+        self.assertEqual(portfolio.unrealised_pnl, 1. + 0. + 3.)
+        self.assertEqual(portfolio.cur_cash, 116.)
+        self.assertEqual(portfolio.equity, portfolio.cur_cash + np.dot(frame['Volume'], frame['Mid']))
+
+    def test_without_quote_snapshot(self):
+        prices = np.array([10, 20, 30, 40])
+        stream = testStream(pd.DataFrame({'Bid': prices, 'Ask': prices + 5}))
+        stream.update_bars()
+        stream.update_bars()
+        portfolio = ArrayPortfolio(BacktestingBroker(stream, Queue.Queue(), 0.0), 100)
+        portfolio.update([self.fill('BTC', 'TestExchange', 'B', 2, 21.)])
+        self.assertEqual(portfolio.unrealised_pnl, 2 * 22.5 - 42.)
+
+
+class testOrderBook(unittest.TestCase):
+
+    def depth_frame(self):
+        t0 = pd.Timestamp('2017-01-01')
+        rows = [(t0, BID, 99., 1., 1), (t0, BID, 98., 2., 0), (t0, ASK, 101., 1., 0), (t0, ASK, 102., 2., 0),
+                (t0, ASK, 104., 5., 0),
+                (t0 + pd.Timedelta('1min'), ASK, 101., 0., 0), (t0 + pd.Timedelta('1min'), ASK, 103., 1., 0),
+                (t0 + pd.Timedelta('2min'), BID, 50., 1., 1), (t0 + pd.Timedelta('2min'), ASK, 51., 1., 0)]
+        return pd.DataFrame(rows, columns=['Datetime', 'Side', 'Price', 'Size', 'Reset'])
+
+    def test_levels(self):
+        book = OrderBook()
+        book.apply_snapshot([(99., 1.), (98., 2.)], [(101., 1.), (102., 2.)])
+        book.apply_diff([(BID, 99.5, 3.), (ASK, 101., 0.), (BID, 98., 4.)])
+        self.assertEqual(book.best_bid, 99.5)
+        self.assertEqual(book.best_ask, 102.)
+        self.assertEqual(book.depth(BID), [(99.5, 3.), (99., 1.), (98., 4.)])
+        self.assertEqual(book.walk('S', 5.), (5., 3 * 99.5 + 99. + 98.))
+        self.assertEqual(book.walk('B', 5., limit=101.), (0., 0.))
+        self.assertEqual(book.walk('S', 3.5, consume=True), (3.5, 3 * 99.5 + 0.5 * 99.))
+        self.assertEqual(book.depth(BID), [(99., 0.5), (98., 4.)])
+
+    def test_replay(self):
+        replay = BookReplay.from_frame(self.depth_frame())
+        book = replay.advance_to(pd.Timestamp('2017-01-01 00:00:30'))
+        self.assertEqual((book.best_bid, book.best_ask), (99., 101.))
+        book = replay.advance_to(pd.Timestamp('2017-01-01 00:01:00'))
+        self.assertEqual(book.depth(ASK), [(102., 2.), (103., 1.), (104., 5.)])
+        # a new snapshot replaces the book
+        book = replay.advance_to(pd.Timestamp('2017-01-01 00:05:00'))
+        self.assertEqual((book.depth(BID), book.depth(ASK)), ([(50., 1.)], [(51., 1.)]))
+
+    def test_broker_walks_the_book(self):
+        replay = BookReplay.from_frame(self.depth_frame())
+        broker = BacktestingBroker(HistoricBarStream(Queue.Queue(), sweep_bars()), Queue.Queue(), 0.1,
+                                   books={('BTC', 'TestExchange'): replay})
+        posted_at = datetime.datetime(2017, 1, 1, 0, 0, 30)
+        fill = broker.execute_order(Order('BTC', 'MKT', 'TestExchange', 2, 'B', posted_at))
+        self.assertEqual((fill.volume, fill.fill_cost, fill.price), (2., 101. + 102., 101.5))
+        self.assertAlmostEqual(fill.commission, 0.2)
+        # the first order took that liquidity, and the limit stops the walk
+        fill = broker.execute_order(Order('BTC', 'LMT', 'TestExchange', 5, 'B', posted_at, price=102.))
+        self.assertEqual((fill.volume, fill.fill_cost), (1., 102.))
+
+
+class LimitOnceStrategy(Strategy):
+
+    def __init__(self, price, side='B', expires_at=None):
+        self.price = price
+        self.side = side
+        self.expires_at = expires_at
+        self.placed = False
+
+    def make_offers(self, bars, signals):
+        if self.placed:
+            return []
+        self.placed = True
+        return [Order(symbol='BTC', order_type='LMT', exchange='TestExchange', volume=1, side=self.side,
+                      posted_at=bars['Datetime'], price=self.price, expires_at=self.expires_at)]
+
+
+class testPendingOrders(unittest.TestCase):
+
+    def order(self, side, price, expires_at=None):
+        return Order('BTC', 'LMT', 'TestExchange', 1, side, datetime.datetime(2017, 1, 1), price=price,
+                     expires_at=expires_at)
+
+    def test_priority_cancel_replace(self):
+        pending = PendingOrders()
+        first, second, third = self.order('B', 10.), self.order('B', 11.), self.order('B', 10.)
+        for order in [first, second, third]:
+            pending.add(order)
+        sell = self.order('S', 12.)
+        pending.add(sell)
+        self.assertEqual(pending.match(bid=9., ask=10.5), [second])
+        pending.cancel(first.order_id)
+        self.assertEqual(pending.match(bid=9., ask=10.), [third])
+        pending.replace(sell.order_id, price=11.)
+        self.assertEqual(pending.match(bid=11., ask=12.), [sell])
+        self.assertEqual(len(pending), 0)
+        self.assertRaises(KeyError, pending.replace, first.order_id, 9.)
+
+    def test_expiry(self):
+        pending = PendingOrders()
+        expiring = self.order('B', 10., expires_at=datetime.datetime(2017, 1, 1, 2))
+        pending.add(expiring)
+        pending.add(self.order('B', 10.))
+        self.assertEqual(len(pending.match(20., 21., now=datetime.datetime(2017, 1, 1, 2))), 0)
+        self.assertEqual(len(pending), 1)
+
+    def test_expired_orders_are_compacted(self):
+        pending = PendingOrders()
+        for i in range(1000):
+            pending.add(self.order('B' if i % 2 else 'S', 50. if i % 2 else 150.,
+                                   expires_at=datetime.datetime(2017, 1, 1, 1)))
+        pending.expire(datetime.datetime(2017, 1, 1, 1))
+        self.assertEqual(len(pending), 0)
+        self.assertEqual(len(pending.buys) + len(pending.sells) + len(pending.expiries), 0)
+
+    def falling_bars(self):
+        prices = 110 - np.arange(10.)
+        dates = pd.date_range('2017-01-01', periods=len(prices), freq='H')
+        return BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': prices, 'Ask': prices + 1}))
+
+    def run_strategy(self, strategy):
+        bars = self.falling_bars()
+        events = EventHandler()
+        stream = HistoricBarStream(events, bars)
+        broker = BacktestingBroker(stream, events, 0.)
+        simulator = Simulator(stream, broker, strategy, Portfolio(broker, 1000), SignalCollector({}))
+        simulator.run()
+        return simulator, broker
+
+    def test_resting_order_fills_in_simulator(self):
+        simulator, broker = self.run_strategy(LimitOnceStrategy(105.))
+        frame = simulator.trade_log.to_frame()
+        self.assertEqual(list(frame['Price']), [105.])
+        # the ask reaches 105 on the seventh bar
+        self.assertEqual(frame['Datetime'].iloc[0], pd.Timestamp('2017-01-01 06:00:00'))
+        self.assertEqual(len(broker.pending[('BTC', 'TestExchange')]), 0)
+
+    def test_resting_order_expires(self):
+        simulator, broker = self.run_strategy(
+            LimitOnceStrategy(105., expires_at=datetime.datetime(2017, 1, 1, 3)))
+        self.assertEqual(len(simulator.trade_log), 0)
+
+
+class testCosts(unittest.TestCase):
+
+    def bars(self):
+        prices = 100 + np.arange(20.)
+        dates = pd.date_range('2017-01-01', periods=len(prices), freq='H')
+        return BarStore.from_frame(pd.DataFrame({'Datetime': dates, 'Bid': prices, 'Ask': prices + 1,
+                                                 'Volume': 10. + np.arange(20.)}))
+
+    def test_models(self):
+        self.assertAlmostEqual(FixedBpsSlippage(10).fill_price(100., 5, 'S'), 99.9)
+        # sides read from JSON are unicode
+        self.assertAlmostEqual(FixedBpsSlippage(10).fill_price(100., 5, u'B'), 100.1)
+        self.assertAlmostEqual(ParticipationSlippage(0.1).slippage(100., 5, 50.), 1.)
+        self.assertAlmostEqual(SquareRootImpact(0.02).slippage(100., 25, 100.), 1.)
+        self.assertRaises(ValueError, SquareRootImpact(0.02).slippage, 100., 25)
+        np.testing.assert_allclose(ParticipationSlippage(0.1).fill_price(
+            np.array([100., 100.]), np.array([5., 10.]), np.array([5., -10.]), np.array([50., 50.])),
+            [101., 98.])
+
+    def test_tiered_fees(self):
+        prices, volumes = np.array([10., 10., 10., 10.]), np.array([50., 60., 10., 10.])
+        fees = TieredFee([(0, 10), (1000, 5)])
+        self.assertAlmostEqual(fees.fee(10., 50.), 0.5)
+        np.testing.assert_allclose([fees.fee(10., 60.), fees.fee(10., 10.), fees.fee(10., 10.)],
+                                   [0.6, 0.05, 0.05])
+        np.testing.assert_allclose(TieredFee([(0, 10), (1000, 5)]).fees(prices, volumes),
+                                   [0.5, 0.6, 0.05, 0.05])
+
+    def test_broker_matches_vectorized(self):
+        bars = self.bars()
+        stream = HistoricBarStream(Queue.Queue(), bars)
+        broker = BacktestingBroker(stream, Queue.Queue(), 0., slippage=ParticipationSlippage(0.1),
+                                   fees=TieredFee([(0, 10), (5000, 5)]))
+        simulator = Simulator(stream, broker, VolumeStrategy(5), NullPortfolio(), SignalCollector({}))
+        simulator.run()
+        result = run_vectorized(bars, 5 * np.arange(1, len(bars) + 1), 0., 1000,
+                                slippage=ParticipationSlippage(0.1), fees=TieredFee([(0, 10), (5000, 5)]))
+        np.testing.assert_allclose(simulator.trade_log.column('Price'), result.fill_price)
+        np.testing.assert_allclose(simulator.trade_log.column('Commission'), result.commission)
+        self.assertTrue(np.all(result.fill_price > bars.column('Ask')))
+
+
+class FailingStrategy(Strategy):
+
+    def __init__(self, fail_at):
+        self.bars_seen = 0
+        self.fail_at = fail_at
+
+    def make_offers(self, bars, signals):
+        self.bars_seen += 1
+        if self.bars_seen == self.fail_at:
+            raise RuntimeError("strategy failed")
+        return [Order(symbol='BTC', order_type='MKT', exchange='TestExchange', volume=1,
+                      side='B', posted_at=bars['Datetime'])]
+
+
+class testResults(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_streamed_results_match_memory(self):
+        in_memory = buying_simulator(sweep_bars(), 2, 0.)
+        in_memory.run()
+        streamed = buying_simulator(sweep_bars(), 2, 0.)
+        streamed.results = ResultsWriter(self.directory, chunk_size=3)
+        streamed.run()
+        self.assertEqual(len(streamed.pnls), 0)
+        # the chunks are joined into one file per column when the run ends
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'pnl'))),
+                         ['Datetime.npy', 'Realised_PnL.npy', 'Unrealised_PnL.npy'])
+        results = read_results(self.directory)
+        np.testing.assert_array_equal(results['bars']['Bid'], sweep_bars().column('Bid'))
+        datetimes = sorted(in_memory.pnls)
+        np.testing.assert_array_equal(results['pnl']['Datetime'], pd.to_datetime(datetimes))
+        np.testing.assert_array_equal(results['pnl']['Realised_PnL'],
+                                      [in_memory.pnls[dt]['realised'] for dt in datetimes])
+        pd.util.testing.assert_frame_equal(results['fills'], in_memory.trade_log.to_frame())
+
+    def test_save_results(self):
+        simulator = buying_simulator(sweep_bars(), 2, 0.)
+        simulator.run()
+        path = os.path.join(self.directory, 'saved')
+        simulator.save_results(path)
+        reader = ResultsReader(path)
+        self.assertEqual(reader.tables, ['bars', 'fills', 'pnl'])
+        realised = reader.column('pnl', 'Realised_PnL', start='2017-01-01 05:00', end='2017-01-01 07:00')
+        self.assertTrue(isinstance(realised, np.memmap))
+        datetimes = sorted(simulator.pnls)[5:8]
+        np.testing.assert_array_equal(realised, [simulator.pnls[dt]['realised'] for dt in datetimes])
+        fills = reader.table('fills', ['Datetime', 'Price'], start='2017-01-01 18:00')
+        self.assertEqual(list(fills['Price']), [119., 120.])
+
+    def test_save_results_replaces_only_results(self):
+        simulator = buying_simulator(sweep_bars(), 1, 0.)
+        simulator.run()
+        path = os.path.join(self.directory, 'saved')
+        simulator.save_results(path)
+        simulator.save_results(path)
+        self.assertEqual(ResultsReader(path).tables, ['bars', 'fills', 'pnl'])
+        other = os.path.join(self.directory, 'data')
+        os.makedirs(other)
+        with open(os.path.join(other, 'prices.csv'), 'w') as fp:
+            fp.write('keep me')
+        self.assertRaises(ValueError, simulator.save_results, other)
+        self.assertEqual(os.listdir(other), ['prices.csv'])
+        # nothing is left behind next to the targets
+        self.assertEqual(sorted(os.listdir(self.directory)), ['data', 'saved'])
+
+    def test_newer_format_is_rejected(self):
+        import json
+        buying_simulator(sweep_bars(), 1, 0.).save_results(self.directory)
+        with open(os.path.join(self.directory, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        manifest['version'] += 1
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as fp:
+            json.dump(manifest, fp)
+        self.assertRaises(ValueError, ResultsReader, self.directory)
+
+    def test_results_survive_a_failed_run(self):
+        stream = HistoricBarStream(Queue.Queue(), sweep_bars())
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+        simulator = Simulator(stream, broker, FailingStrategy(5), Portfolio(broker, 100),
+                              SignalCollector({}), results=ResultsWriter(self.directory, chunk_size=3))
+        self.assertRaises(RuntimeError, simulator.run)
+        results = read_results(self.directory)
+        self.assertEqual(len(results['fills']), 4)
+        self.assertEqual(len(results['pnl']), 4)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class testRunLog(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        logging.getLogger('backtester').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('backtester').removeHandler(self.handler)
+
+    def test_levels_and_ring_buffer(self):
+        log = RunLog(level=logging.WARNING, capacity=3)
+        for i in range(5):
+            log.debug("bar %d", i)
+        log.warning("something odd")
+        self.assertEqual([record.getMessage() for record in self.handler.records], ["something odd"])
+        self.assertEqual(log.format_recent(), ["DEBUG bar 3", "DEBUG bar 4", "WARNING something odd"])
+
+    def test_sampler(self):
+        sampler = Sampler(every=3)
+        self.assertEqual([sampler.due() for _ in range(6)], [False, False, True, False, False, True])
+        self.assertFalse(any(Sampler().due() for _ in range(10)))
+
+    def test_dump_on_failure(self):
+        stream = HistoricBarStream(Queue.Queue(), sweep_bars())
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+        portfolio = Portfolio(broker, 100)
+        simulator = Simulator(stream, broker, FailingStrategy(3), portfolio, SignalCollector({}),
+                              log=RunLog(capacity=4))
+        portfolio._modify_position(FillEvent(timeindex=None, symbol='ETH', exchange='TestExchange', volume=1,
+                                             side='B', fill_cost=1., price=1., commission=0.))
+        self.assertRaises(RuntimeError, simulator.run)
+        dump = self.handler.records[-1].getMessage()
+        self.assertTrue(dump.startswith("last 4 events:"))
+        self.assertTrue("INFO Filled Order for Symbol BTC; B 1 at price 102.0" in dump)
+        self.assertTrue(dump.endswith("ERROR run failed at 2017-01-01 02:00:00"))
+
+    def test_component_warnings_are_recorded(self):
+        stream = HistoricBarStream(Queue.Queue(), sweep_bars())
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+        portfolio = Portfolio(broker, 100)
+        log = RunLog()
+        log.attach()
+        try:
+            portfolio._modify_position(FillEvent(timeindex=None, symbol='ETH', exchange='TestExchange',
+                                                 volume=1, side='B', fill_cost=1., price=1., commission=0.))
+        finally:
+            log.detach()
+        self.assertEqual(len(log.recent), 1)
+        self.assertTrue("backtester.portfolio: Ticker ETH not in the current position list" in
+                        log.format_recent()[0])
+
+
+class testTradeLog(unittest.TestCase):
+
+    def fill(self, i, side='B'):
+        return FillEvent(timeindex=datetime.datetime(2017, 1, 1, i), symbol='BTC', exchange='TestExchange',
+                         volume=i + 1, side=side, fill_cost=10. * (i + 1), price=10., commission=0.5)
+
+    def test_append_and_grow(self):
+        log = TradeLog(capacity=2)
+        for i in range(5):
+            log.append(self.fill(i, 'B' if i % 2 else 'S'))
+        self.assertEqual(len(log), 5)
+        np.testing.assert_array_equal(log.signed_volume(), [-1, 2, -3, 4, -5])
+        frame = log.to_frame()
+        self.assertEqual(list(frame['Side']), ['S', 'B', 'S', 'B', 'S'])
+        self.assertEqual(list(frame['Symbol']), ['BTC'] * 5)
+        self.assertEqual(frame['Datetime'].iloc[4], pd.Timestamp('2017-01-01 04:00:00'))
+        np.testing.assert_array_equal(frame['Fill Cost'], [10., 20., 30., 40., 50.])
+
+    def test_slotted_events_pickle(self):
+        import cPickle as pickle
+        fill = self.fill(1)
+        self.assertFalse(hasattr(fill, '__dict__'))
+        for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+            copied = pickle.loads(pickle.dumps(fill, protocol))
+            self.assertEqual((copied.type, copied.volume, copied.price), ('FILL', 2, 10.))
+        order = pickle.loads(pickle.dumps(Order('BTC', 'MKT', 'TestExchange', 1, 'B', fill.timeindex)))
+        self.assertEqual(order.type, 'ORDER')
+        self.assertFalse(hasattr(order, 'price'))
+
+
+class testTiming(unittest.TestCase):
+
+    def test_stage_statistics(self):
+        ticks = iter([0., 1., 1., 4., 10., 12.])
+        timer = Timer(clock=lambda: next(ticks))
+        double = timer.wrap('double', lambda x: 2 * x)
+        self.assertEqual([double(i) for i in range(3)], [0, 2, 4])
+        row = timer.summary()[0]
+        self.assertEqual((row['stage'], row['calls'], row['total_s']), ('double', 3, 6.))
+        self.assertEqual((row['p50_us'], row['max_us']), (2e6, 3e6))
+        self.assertEqual(json.loads(timer.to_json())[0]['calls'], 3)
+
+    def test_simulator_stages(self):
+        stream = HistoricBarStream(Queue.Queue(), sweep_bars())
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+        signals = SignalCollector({"EMA": ExponentialMovingAverage(span=3)})
+        timer = Timer()
+        simulator = Simulator(stream, broker, VolumeStrategy(1), Portfolio(broker, 1000), signals,
+                              timer=timer)
+        simulator.run()
+        calls = dict((row['stage'], row['calls']) for row in timer.summary())
+        self.assertEqual(calls, {'signals.update': 20, 'strategy.make_offers': 20,
+                                 'broker.execute_order': 20, 'broker.on_bar': 20,
+                                 'portfolio.update': 20, 'signal EMA': 20})
+        self.assertEqual(list(timer.to_frame()['stage'])[:2], ['signals.update', 'strategy.make_offers'])
+        # without a timer the components are called directly
+        simulator = buying_simulator(sweep_bars(), 1, 0.)
+        self.assertTrue(simulator._execute_order == simulator.broker.execute_order)
+
+
+class testBenchmarks(unittest.TestCase):
+
+    def test_synthetic_bars(self):
+        bars = synthetic_bars(500, volatility=0.5, seed=3)
+        self.assertEqual(len(bars), 500)
+        np.testing.assert_array_equal(bars.column('Bid'), synthetic_bars(500, volatility=0.5, seed=3).column('Bid'))
+        np.testing.assert_allclose(bars.column('Ask') - bars.column('Bid'), 0.6)
+        self.assertEqual((bars.column('Bid')[0] + bars.column('Ask')[0]) / 2., 1000.)
+        log_returns = np.diff(np.log(synthetic_bars(20000, volatility=0.5).column('Bid') + 0.3))
+        self.assertAlmostEqual(log_returns.std() * np.sqrt(365 * 24), 0.5, places=1)
+
+    def test_baseline_comparison(self):
+        rates = run_benchmarks(n_bars=200, repeat=1)
+        self.assertEqual(list(rates), ['simulator', 'stream', 'csv_load', 'csv_load_cached',
+                                       'moving_average_update', 'broker_execute_order', 'portfolio_update'])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'baseline.json')
+            save_baseline(rates, path)
+            baseline = load_baseline(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertFalse(compare(rates, baseline)['regression'].any())
+        slower = dict((name, rate * 0.5) for name, rate in rates.items())
+        slower['stream'] = rates['stream']
+        comparison = compare(slower, baseline, tolerance=0.2)
+        self.assertEqual(sorted(comparison['benchmark'][comparison['regression']]),
+                         sorted(name for name in rates if name != 'stream'))
+
+
+class testBacktesterCLI(unittest.TestCase):
+
+    def test_run_from_config(self):
+        directory = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(directory, 'bars.csv')
+            write_csv(synthetic_bars(300), csv_path)
+            config_path = os.path.join(directory, 'config.json')
+            with open(config_path, 'w') as fp:
+                json.dump({'data': {'csv_path': csv_path, 'use_cache': False},
+                           # TestStrategy trades on the signal named 'Moving Average'
+                           'signals': {'Moving Average': {'type': 'ExponentialMovingAverage', 'span': 12}},
+                           'strategy': {'type': 'TestStrategy', 'volume': 2},
+                           'broker': {'fees': {'type': 'BpsFee', 'bps': 10}}}, fp)
+            config = backtester.load_config(config_path)
+            self.assertEqual(config['broker']['commission'], 0.01)
+            self.assertEqual(config['signals']['Moving Average']['type'], 'ExponentialMovingAverage')
+            simulator = backtester.build_simulator(config)
+            self.assertEqual(simulator.strategy.volume, 2)
+            self.assertEqual(simulator.broker.fees.bps, 10)
+            output = os.path.join(directory, 'results')
+            self.assertEqual(backtester.main([config_path, '--output', output]), 0)
+            self.assertEqual(len(read_results(output)['pnl']), 300)
+        finally:
+            shutil.rmtree(directory)
+        self.assertFalse('coinbase.wallet.client' in sys.modules)
+
+    def test_timedelta_arguments(self):
+        signal = backtester._component(signals, {'type': 'MovingAverage', 'lookback_period': {'hours': 6}})
+        self.assertEqual(signal.lookback_period, datetime.timedelta(hours=6))
+        self.assertRaises(ValueError, backtester._component, signals, {'type': 'NoSuchSignal'})
+
+    def test_invalid_log_level(self):
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertRaises(SystemExit, backtester.main, ['--log-level', 'basicConfig'])
+            self.assertRaises(SystemExit, backtester.main, ['--log-level', 'LOUD'])
+        finally:
+            sys.stderr = stderr
+
+
+class QuoteServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A stand-in for the Coinbase price endpoints plus a push stream of
+    newline-delimited quotes; every price request takes `delay` seconds.
+    """
+    delay = 0.2
+
+    def do_GET(self):
+        if self.path == '/stream':
+            self.send_response(200)
+            self.end_headers()
+            for i in range(3):
+                self.wfile.write(json.dumps({'time': '2017-01-01T00:0{}:00Z'.format(i),
+                                             'bid': 100. + i, 'ask': 101. + i}) + '\n')
+                self.wfile.flush()
+            return
+        time.sleep(self.delay)
+        data = {'/v2/prices/BTC-USD/buy': {'amount': '101.5'},
+                '/v2/prices/BTC-USD/sell': {'amount': '100.5'},
+                '/v2/time': {'iso': '2017-01-01T00:00:00Z'}}.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({'data': data}))
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingQuoteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class testLiveStream(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingQuoteServer(('127.0.0.1', 0), QuoteServerHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cadence(self):
+        clock = [0.]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+        cadence = Cadence(1., clock=lambda: clock[0], sleep=sleep)
+        self.assertEqual(cadence.wait(), 0.)
+        clock[0] += 0.3  # a request
+        self.assertEqual(cadence.wait(), 1.)
+        self.assertEqual(sleeps, [0.7])
+        clock[0] += 2.5  # a slow request misses the ticks at 2 and 3
+        self.assertEqual(cadence.wait(), 3.)
+        self.assertEqual((cadence.skipped, len(sleeps)), (1, 1))
+
+    def test_concurrent_polling(self):
+        source = CoinbaseQuoteSource(HTTPQuoteClient(self.url))
+        start = time.time()
+        self.assertEqual(source.fetch(), (datetime.datetime(2017, 1, 1), 100.5, 101.5))
+        # three requests of 0.2s each, made at once
+        self.assertTrue(time.time() - start < 0.5)
+        stream = LiveQuoteStream(Queue.Queue(), source=source, interval=0.01, max_ticks=2)
+        bars = list(stream._data_streamer())
+        self.assertEqual([(bar['Bid'], bar['Ask']) for bar in bars], [(100.5, 101.5)] * 2)
+        self.assertEqual(stream.quotes.bid_ask('BTC', 'Coinbase'), (100.5, 101.5))
+        self.assertIsNone(source.pool)
+
+    def test_push_feed_through_simulator(self):
+        stream = LiveQuoteStream(Queue.Queue(), feed=HTTPStreamFeed(self.url + '/stream'),
+                                 exchange='TestExchange')
+        broker = BacktestingBroker(stream, Queue.Queue(), 0.)
+        simulator = Simulator(stream, broker, VolumeStrategy(1), Portfolio(broker, 1000), SignalCollector({}))
+        simulator.run()
+        np.testing.assert_array_equal(simulator.trade_log.column('Price'), [101., 102., 103.])
+        self.assertEqual(list(stream.get_latest_bars(2)['Bid']), [101., 102.])
+        self.assertFalse(stream.continue_backtest)
+
+
 if __name__ == "__main__":
-    test_classes_to_run = [testSignals, testBroker, testPortfolio, testSimulator]
+    test_classes_to_run = [testSignals, testData, testBroker, testPortfolio, testSimulator, testEventHandler, testVectorized, testSweep, testWalkForward, testTradeLog, testArrayPortfolio, testOrderBook, testPendingOrders, testCosts, testResults, testRunLog, testTiming, testBenchmarks, testBacktesterCLI, testLiveStream]
 
     loader = unittest.TestLoader()
 
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+
+class VectorizedResult(object):
+    """
+    Per-bar results of a vectorized backtest. All attributes are arrays
+    aligned with the bars that were run.
+    """
+
+    def __init__(self, datetime, position, trades, fill_price, commission,
+                 cash, equity, realised_pnl, unrealised_pnl):
+        self.datetime = datetime
+        self.position = position
+        self.trades = trades
+        self.fill_price = fill_price
+        self.commission = commission
+        self.cash = cash
+        self.equity = equity
+        self.realised_pnl = realised_pnl
+        self.unrealised_pnl = unrealised_pnl
+
+    @property
+    def trade_count(self):
+        return int(np.count_nonzero(self.trades))
+
+    def to_frame(self):
+        return pd.DataFrame({'Datetime': self.datetime.view('M8[ns]'),
+                             'Position': self.position,
+                             'Trade': self.trades,
+                             'Fill Price': self.fill_price,
+                             'Commission': self.commission,
+                             'Cash': self.cash,
+                             'Equity': self.equity,
+                             'Realised_PnL': self.realised_pnl,
+                             'Unrealised_PnL': self.unrealised_pnl},
+                            columns=['Datetime', 'Position', 'Trade', 'Fill Price', 'Commission',
+                                     'Cash', 'Equity', 'Realised_PnL', 'Unrealised_PnL'])
+
+
+def run_vectorized(bars, target_position, commission, init_cash, slippage=None, fees=None):
+    """
+    Backtests a position-target strategy with array operations instead of
+    the bar by bar Simulator loop.
+
+    On every bar the position is moved to the target with a market order:
+    buys fill at the bar's Ask, sells at its Bid, and the commission is
+    volume * commission, as in BacktestingBroker; slippage and fee models
+    from costs.py are evaluated over all trades at once, the same way the
+    broker applies them per order. Positions are marked to
+    the mid price. The average entry price needed to split the PnL into
+    realised and unrealised parts is tracked over the trades only, so
+    bars without a trade cost nothing beyond the array operations.
+
+    Parameters:
+    bars - a BarStore with Bid and Ask columns.
+    target_position - signed volume to hold after each bar (array-like).
+    commission - commission per traded unit (if no fee model is given).
+    init_cash - the starting cash.
+    slippage - optional costs.SlippageModel.
+    fees - optional costs.FeeModel.
+    """
+    bid = bars.column('Bid')
+    ask = bars.column('Ask')
+    position = np.asarray(target_position, dtype=np.float64)
+    assert(len(position) == len(bars)), "need one target position per bar"
+    trades = np.diff(np.concatenate([[0.], position]))
+    fill_price, commissions = trade_costs(bars, trades, commission, slippage, fees)
+    cash = init_cash - np.cumsum(trades * fill_price) - np.cumsum(commissions)
+    mid = (bid + ask) / 2.
+    equity = cash + position * mid
+    cost_basis = _cost_basis(position, trades, fill_price)
+    # equity = init_cash + realised + unrealised, with the open position
+    # valued at its average entry price for the realised part
+    unrealised = position * mid - cost_basis
+    realised = cash + cost_basis - init_cash
+    return VectorizedResult(bars.datetime, position, trades, fill_price, commissions,
+                            cash, equity, realised, unrealised)
+
+
+def trade_costs(bars, trades, commission, slippage=None, fees=None):
+    """
+    Fill prices and commissions of per-bar trades (signed volumes): buys
+    fill at the Ask and sells at the Bid, moved by the slippage model,
+    and the fee model (or `commission` per unit) is applied to the fills
+    in order. Bars without a trade get a fill price and commission of 0.
+    This is the cost part of run_vectorized, so different cost models can
+    be compared on the same trades without running anything again.
+    """
+    bid = bars.column('Bid')
+    ask = bars.column('Ask')
+    fill_price = np.where(trades > 0, ask, np.where(trades < 0, bid, 0.))
+    traded = np.flatnonzero(trades)
+    volume = np.abs(trades[traded])
+    if slippage is not None:
+        bar_volume = bars.column('Volume')[traded] if 'Volume' in bars.data else None
+        fill_price[traded] = slippage.fill_price(fill_price[traded], volume, trades[traded], bar_volume)
+    commissions = np.zeros(len(trades))
+    if fees is None:
+        commissions[traded] = volume * commission
+    else:
+        commissions[traded] = fees.fees(fill_price[traded], volume)
+    return fill_price, commissions
+
+
+def _cost_basis(position, trades, fill_price):
+    """
+    Signed cost basis (volume * average entry price) of the open position
+    after each bar. Increasing a position adds the trade at its fill price,
+    reducing it keeps the average price and flipping it starts a new
+    average at the fill price.
+    """
+    trade_idx = np.flatnonzero(trades)
+    basis_at_trades = np.zeros(len(trade_idx))
+    basis = 0.
+    old = 0.
+    for i, (new, price) in enumerate(zip(position[trade_idx].tolist(),
+                                         fill_price[trade_idx].tolist())):
+        if new == 0:
+            basis = 0.
+        elif old == 0 or (old > 0) != (new > 0):
+            basis = new * price
+        elif abs(new) > abs(old):
+            basis += (new - old) * price
+        else:
+            basis *= new / old
+        basis_at_trades[i] = basis
+        old = new
+    # carry the basis forward to the bars without trades
+    cost_basis = np.zeros(len(position))
+    if len(trade_idx):
+        last_trade = np.maximum.accumulate(
+            np.where(trades != 0, np.arange(len(position)), -1))
+        traded = last_trade >= 0
+        cost_basis[traded] = basis_at_trades[np.searchsorted(trade_idx, last_trade[traded])]
+    return cost_basis
+
+
+def threshold_orders(bid, ask, signal, volume):
+    """
+    The order flow of TestStrategy-style rules as an array: buy `volume`
+    on bars where the ask is below the signal, sell `volume` where the bid
+    is above it. np.cumsum of the result gives the target positions.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where(ask < signal, volume, np.where(bid > signal, -volume, 0.))
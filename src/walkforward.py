@@ -0,0 +1,122 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+from bars import publish_bars, attach_bars, unpublish_bars
+from sweep import build_simulator, parameter_grid, run_tasks
+
+
+def walk_forward_windows(datetimes, train_period, test_period, step=None):
+    """
+    Splits a timeline into rolling train/test windows. Each train window is
+    train_period long and directly followed by a test window of
+    test_period; the windows move forward by step (test_period by default,
+    so that the test windows tile the timeline).
+
+    Returns a list of (train_start, train_stop, test_start, test_stop) row
+    ranges into datetimes (int64 nanoseconds, sorted).
+    """
+    train_ns = int(pd.Timedelta(train_period).value)
+    test_ns = int(pd.Timedelta(test_period).value)
+    step_ns = test_ns if step is None else int(pd.Timedelta(step).value)
+    windows = []
+    if not len(datetimes):
+        return windows
+    train_begin = datetimes[0]
+    while train_begin + train_ns <= datetimes[-1]:
+        edges = np.searchsorted(datetimes, [train_begin, train_begin + train_ns,
+                                            train_begin + train_ns + test_ns])
+        if edges[2] > edges[1] and edges[1] > edges[0]:
+            windows.append((int(edges[0]), int(edges[1]), int(edges[1]), int(edges[2])))
+        train_begin += step_ns
+    return windows
+
+
+def run_walk_forward(bars, param_grid, train_period, test_period, step=None,
+                     factory=build_simulator, score='final_equity', init_cash=100,
+                     processes=None):
+    """
+    Walk-forward optimisation: on every train window the parameter grid is
+    run and the parameters with the highest score are picked, then those
+    parameters are run on the following test window. All train runs and
+    then all test runs are spread over a process pool.
+
+    The bars are published once (bars.publish_bars) and every worker
+    attaches to them, and runs are restricted to their window with the
+    start/stop arguments of the factory, so nothing is re-read or copied
+    per window. Signals are precomputed once per worker over the whole
+    history and shared by all of its runs through a signal cache, which
+    also gives every window its warm-up history.
+
+    Parameters:
+    bars - a BarStore.
+    param_grid - dict of parameter name -> list of values.
+    train_period, test_period, step - window lengths (timedeltas).
+    factory - picklable callable (bars, start, stop, signal_cache,
+              init_cash, **params) -> Simulator.
+    score - the summary column to maximise on the train windows.
+    init_cash - the starting cash of every run.
+    processes - number of worker processes (1 runs inline).
+
+    Returns (folds, equity): a DataFrame with one row per fold (windows,
+    chosen parameters, in-sample score and out-of-sample summary) and the
+    stitched out-of-sample equity curve as a Series.
+    """
+    windows = walk_forward_windows(bars.datetime, train_period, test_period, step)
+    grid = parameter_grid(param_grid)
+    path = publish_bars(bars)
+    try:
+        loader = functools.partial(attach_bars, path)
+        train_tasks = [(factory, dict(params, start=train_start, stop=train_stop, init_cash=init_cash),
+                        {'signal_cache': True})
+                       for train_start, train_stop, _, _ in windows for params in grid]
+        train_summaries = run_tasks(train_tasks, loader, processes)
+        best = []
+        for fold in range(len(windows)):
+            scores = [summary[score] for summary in
+                      train_summaries[fold * len(grid):(fold + 1) * len(grid)]]
+            best_idx = int(np.argmax(scores))
+            best.append((grid[best_idx], scores[best_idx]))
+        test_tasks = [(factory, dict(params, start=test_start, stop=test_stop, init_cash=init_cash),
+                       {'signal_cache': True, 'equity_curve': True})
+                      for (_, _, test_start, test_stop), (params, _) in zip(windows, best)]
+        test_results = run_tasks(test_tasks, loader, processes)
+    finally:
+        unpublish_bars(path)
+
+    rows = []
+    for (train_start, train_stop, test_start, test_stop), (params, in_sample), (summary, _) in \
+            zip(windows, best, test_results):
+        row = {'train_start': bars.datetime[train_start], 'train_stop': bars.datetime[train_stop - 1],
+               'test_start': bars.datetime[test_start], 'test_stop': bars.datetime[test_stop - 1],
+               'in_sample_' + score: in_sample}
+        row.update(params)
+        row.update(summary)
+        rows.append(row)
+    folds = pd.DataFrame(rows)
+    for column in ['train_start', 'train_stop', 'test_start', 'test_stop']:
+        if column in folds:
+            folds[column] = pd.to_datetime(folds[column])
+    return folds, stitch_equity_curves([curve for _, curve in test_results], init_cash)
+
+
+def stitch_equity_curves(curves, init_cash):
+    """
+    Chains (datetimes, equity) curves that each start from init_cash into
+    one curve: every segment continues from the equity the previous one
+    ended with.
+    """
+    datetimes, equity = [], []
+    capital = init_cash
+    for segment_datetimes, segment_equity in curves:
+        if not len(segment_equity):
+            continue
+        datetimes.append(segment_datetimes)
+        equity.append(segment_equity - init_cash + capital)
+        capital = equity[-1][-1]
+    if not equity:
+        return pd.Series([], index=pd.DatetimeIndex([]), name='Equity')
+    return pd.Series(np.concatenate(equity),
+                     index=pd.DatetimeIndex(np.concatenate(datetimes).view('M8[ns]')),
+                     name='Equity')